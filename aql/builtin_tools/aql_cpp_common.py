@@ -1,6 +1,7 @@
 import os
 import itertools
 
+from aql.util_types import get_work_dir, abs_path
 from aql.utils import find_file_in_paths
 
 from aql.options import StrOptionType, BoolOptionType, VersionOptionType, ListOptionType,\
@@ -413,7 +414,7 @@ class CommonCompiler (FileBuilder):
         ext_cpppath += options.sys_cpppath.get()
 
         self.ext_cpppath = tuple(set(os.path.normcase(
-            os.path.abspath(folder)) + os.path.sep for folder in ext_cpppath))
+            abs_path(folder)) + os.path.sep for folder in ext_cpppath))
 
     # -----------------------------------------------------------
 
@@ -571,7 +572,7 @@ class CommonCppLinkerBase(FileBuilder):
 
     def replace(self, options, source_entities):
 
-        cwd = os.getcwd()
+        cwd = get_work_dir()
 
         def _add_sources():
             if current_builder is None:
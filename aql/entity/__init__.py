@@ -22,4 +22,5 @@
 from .aql_file_entity import *
 from .aql_entity import *
 from .aql_entity_pickler import *
+from .aql_entity_codec import *
 from .aql_entities_file import *
@@ -21,10 +21,13 @@
 
 
 import operator
+import threading
 
-from aql.utils import DataFile, SqlDataFile, FileLock
+from aql.util_types import encode_str
+from aql.utils import DataFile, SqlDataFile, LogDataFile, FileLock,\
+    get_signature_algorithm
 
-from .aql_entity_pickler import EntityPickler
+from .aql_entity_codec import EntityCodec
 
 __all__ = (
     'EntitiesFile',
@@ -32,6 +35,11 @@ __all__ = (
 
 # ==============================================================================
 
+# id of the record with a name of the signature algorithm
+_SIGNATURE_ALGORITHM_ID = b".AQL.SIGNATURE.."
+
+# ==============================================================================
+
 
 class ErrorEntitiesFileUnknownEntity(Exception):
 
@@ -50,13 +58,18 @@ class EntitiesFile (object):
         'file_lock',
         'cache',
         'pickler',
+        'lock',
     )
 
-    def __init__(self, filename, use_sqlite=False, force=False):
+    def __init__(self, filename, use_sqlite=False, use_log_db=False,
+                 force=False, use_codec=False):
         self.cache = {}
+        self.lock = threading.RLock()
         self.data_file = None
-        self.pickler = EntityPickler()
-        self.open(filename, use_sqlite=use_sqlite, force=force)
+        # records of both formats are decoded regardless of the option
+        self.pickler = EntityCodec(compact=use_codec)
+        self.open(filename, use_sqlite=use_sqlite, use_log_db=use_log_db,
+                  force=force)
 
     # -------------------------------------------------------------------------------
 
@@ -71,16 +84,42 @@ class EntitiesFile (object):
 
     # -------------------------------------------------------------------------------
 
-    def open(self, filename, use_sqlite=False, force=False):
+    def open(self, filename, use_sqlite=False, use_log_db=False,
+             force=False):
 
         self.file_lock = FileLock(filename)
         self.file_lock.write_lock(wait=False, force=force)
 
         if use_sqlite:
             self.data_file = SqlDataFile(filename, force=force)
+        elif use_log_db:
+            self.data_file = LogDataFile(filename, force=force)
         else:
             self.data_file = DataFile(filename, force=force)
 
+        self._check_signature_algorithm()
+
+    # -------------------------------------------------------------------------------
+
+    def _check_signature_algorithm(self):
+        """
+        Clears the file if it was built with another signature algorithm
+        """
+
+        data_file = self.data_file
+
+        algorithm = encode_str(get_signature_algorithm())
+        stored_algorithm = data_file.read(_SIGNATURE_ALGORITHM_ID)
+
+        if stored_algorithm == algorithm:
+            return
+
+        # files without the algorithm were built with md5
+        if (stored_algorithm is not None) or (algorithm != b'md5'):
+            data_file.clear()
+
+        data_file.write(_SIGNATURE_ALGORITHM_ID, algorithm)
+
     # -------------------------------------------------------------------------------
 
     def close(self):
@@ -96,44 +135,83 @@ class EntitiesFile (object):
 
     # -------------------------------------------------------------------------------
 
+    def flush(self):
+        with self.lock:
+            if self.data_file is not None:
+                self.data_file.flush()
+
+    # -------------------------------------------------------------------------------
+
     def clear(self):
 
         if self.data_file is not None:
             self.data_file.clear()
+            self._check_signature_algorithm()
 
         self.cache.clear()
 
     # -------------------------------------------------------------------------------
 
-    def find_node_entity(self, entity):
+    def _load_entities(self, entity_ids):
+        """
+        Decodes entities directly from data of the file.
+        Returns None for unknown entities, broken entities are removed.
+        """
 
-        entity_id = entity.id
+        entities = []
+        broken_ids = []
 
-        dump = self.data_file.read(entity_id)
-        if dump is None:
-            return None
+        loads = self.pickler.loads
+        views = self.data_file.read_views(entity_ids)
 
         try:
-            entity = self.pickler.loads(dump)
-            entity.id = entity_id
-        except Exception:
-            self.data_file.remove((entity_id,))
+            for entity_id, data in zip(entity_ids, views):
+                entity = None
 
-            return None
+                if data is not None:
+                    try:
+                        entity = loads(data)
+                        entity.id = entity_id
+                    except Exception:
+                        broken_ids.append(entity_id)
+                        entity = None
 
-        return entity
+                entities.append(entity)
+        finally:
+            views.close()
+
+        if broken_ids:
+            self.data_file.remove(broken_ids)
+
+        return entities
+
+    # -------------------------------------------------------------------------------
+
+    def find_node_entity(self, entity):
+        with self.lock:
+            return self._load_entities((entity.id,))[0]
 
     # -------------------------------------------------------------------------------
 
     def add_node_entity(self, entity):
-        dump = self.pickler.dumps(entity)
-        self.data_file.write(entity.id, dump)
+        with self.lock:
+            dump = self.pickler.dumps(entity)
+            self.data_file.write(entity.id, dump)
+
+    # -------------------------------------------------------------------------------
+
+    def add_node_entities(self, entities):
+        with self.lock:
+            dumps = self.pickler.dumps
+            items = [(entity.id, dumps(entity)) for entity in entities]
+            self.data_file.write_many(items)
 
     # -------------------------------------------------------------------------------
 
     def remove_node_entities(self, entities):
-        entity_ids = map(operator.attrgetter('id'), entities)
-        self.data_file.remove(entity_ids)
+        with self.lock:
+            entity_ids = map(operator.attrgetter('id'), entities)
+            self.data_file.remove(entity_ids)
 
     # -------------------------------------------------------------------------------
 
@@ -143,16 +221,8 @@ class EntitiesFile (object):
         except KeyError:
             pass
 
-        data = self.data_file.read(entity_id)
-        if data is None:
-            raise ValueError()
-
-        try:
-            entity = self.pickler.loads(data)
-            entity.id = entity_id
-        except Exception:
-            self.data_file.remove((entity_id,))
-
+        entity = self._load_entities((entity_id,))[0]
+        if entity is None:
             raise ValueError()
 
         self.cache[entity_id] = entity
@@ -160,78 +230,150 @@ class EntitiesFile (object):
 
     # -------------------------------------------------------------------------------
 
+    def _find_entities_by_ids(self, entity_ids):
+        cache = self.cache
+
+        unknown_ids = [entity_id for entity_id in entity_ids
+                       if entity_id not in cache]
+        if unknown_ids:
+            entities = self._load_entities(unknown_ids)
+
+            for entity_id, entity in zip(unknown_ids, entities):
+                if entity is None:
+                    raise ValueError()
+
+                cache[entity_id] = entity
+
+        return [cache[entity_id] for entity_id in entity_ids]
+
+    # -------------------------------------------------------------------------------
+
     def find_entities_by_key(self, keys):
-        entity_ids = self.data_file.get_ids(keys)
-        if entity_ids is None:
-            return None
+        with self.lock:
+            entity_ids = self.data_file.get_ids(keys)
+            if entity_ids is None:
+                return None
 
-        try:
-            return list(map(self._find_entity_by_id, entity_ids))
-        except Exception:
-            return None
+            try:
+                return self._find_entities_by_ids(entity_ids)
+            except Exception:
+                return None
 
     # -------------------------------------------------------------------------------
 
     def find_entities(self, entities):
-        try:
-            return list(map(self._find_entity_by_id,
-                            map(operator.attrgetter('id'), entities)))
-        except Exception:
-            return None
+        with self.lock:
+            try:
+                return self._find_entities_by_ids(
+                    tuple(map(operator.attrgetter('id'), entities)))
+            except Exception:
+                return None
 
     # -------------------------------------------------------------------------------
 
     def add_entities(self, entities):
+        """
+        Writes changed entities in one batch.
+        Returns keys of all entities in the same order.
+        """
 
-        keys = []
-        entity_ids = []
-        key_append = keys.append
-        entity_append = entity_ids.append
+        with self.lock:
+            entity_ids = []
+            items = []
 
-        for entity in entities:
+            cache = self.cache
+            dumps = self.pickler.dumps
 
-            entity_id = entity.id
+            for entity in entities:
 
-            try:
-                stored_entity = self._find_entity_by_id(entity_id)
-                if stored_entity == entity:
-                    entity_append(entity_id)
-                    continue
+                entity_id = entity.id
+                entity_ids.append(entity_id)
 
-            except Exception:
-                pass
+                try:
+                    stored_entity = self._find_entity_by_id(entity_id)
+                    if stored_entity == entity:
+                        continue
+
+                except Exception:
+                    pass
 
-            key = self.update_entity(entity)
-            key_append(key)
+                cache[entity_id] = entity
+                items.append((entity_id, dumps(entity)))
 
-        keys.extend(self.data_file.get_keys(entity_ids))
+            if items:
+                self.data_file.write_with_keys(items)
 
-        return keys
+            return list(self.data_file.get_keys(entity_ids))
 
     # -------------------------------------------------------------------------------
 
     def update_entity(self, entity):
+        with self.lock:
+            entity_id = entity.id
 
-        entity_id = entity.id
-
-        self.cache[entity_id] = entity
-        data = self.pickler.dumps(entity)
-        key = self.data_file.write_with_key(entity_id, data)
+            self.cache[entity_id] = entity
+            data = self.pickler.dumps(entity)
+            key = self.data_file.write_with_key(entity_id, data)
 
-        return key
+            return key
 
     # -------------------------------------------------------------------------------
 
     def remove_entities(self, entities):
-        remove_ids = tuple(map(operator.attrgetter('id'), entities))
+        with self.lock:
+            remove_ids = tuple(map(operator.attrgetter('id'), entities))
 
-        for entity_id in remove_ids:
-            try:
-                del self.cache[entity_id]
-            except KeyError:
-                pass
+            for entity_id in remove_ids:
+                try:
+                    del self.cache[entity_id]
+                except KeyError:
+                    pass
+
+            self.data_file.remove(remove_ids)
+
+    # -------------------------------------------------------------------------------
+
+    def import_entities(self, other):
+        """
+        Copies all entities of other file.
+        Keys of implicit dependencies of node entities are remapped.
+        """
+
+        with self.lock, other.lock:
+            other_file = other.data_file
+
+            entity_ids = [entity_id for entity_id in other_file.get_all_ids()
+                          if entity_id != _SIGNATURE_ALGORITHM_ID]
+
+            entities = []
+            node_entities = []
+
+            for entity in other._load_entities(entity_ids):
+                if entity is None:
+                    continue
+
+                if getattr(entity, 'idep_keys', None) is None:
+                    entities.append(entity)
+                else:
+                    node_entities.append(entity)
+
+            keys = self.add_entities(entities)
+            other_keys = other_file.get_keys(
+                map(operator.attrgetter('id'), entities))
+
+            key_map = dict(zip(other_keys, keys))
+
+            actual_node_entities = []
+            for node_entity in node_entities:
+                try:
+                    node_entity.idep_keys = [key_map[key]
+                                             for key in node_entity.idep_keys]
+                except KeyError:
+                    continue
+
+                actual_node_entities.append(node_entity)
 
-        self.data_file.remove(remove_ids)
+            self.add_node_entities(actual_node_entities)
 
     # -------------------------------------------------------------------------------
 
@@ -0,0 +1,566 @@
+#
+# Copyright (c) 2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import zlib
+import struct
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from aql.util_types import u_str
+
+from .aql_entity_pickler import EntityPickler, _pickle_type_name, \
+    _KNOWN_TYPE_NAMES, _KNOWN_TYPE_IDS
+
+__all__ = (
+    'EntityCodec',
+)
+
+# ==============================================================================
+
+# A record starts with a header byte: 0xA0 | version,
+# 0x08 is set if the rest of the record is compressed by zlib.
+# Pickle records of EntityPickler start with 0x80.
+# Each value is a tag byte followed by fields of the value,
+# lengths and integers are stored as varints.
+# A directory of paths is stored once per record,
+# next paths refer to it by its offset from the start of values.
+
+_VERSION = 2
+_HEADER = 0xA0 | _VERSION
+_HEADER_COMPRESSED = _HEADER | 0x08
+
+# headers of all supported versions
+_HEADERS = frozenset([0xA1, _HEADER])
+_HEADERS_COMPRESSED = frozenset([0xA9, _HEADER_COMPRESSED])
+
+# the first byte of records of EntityPickler
+_PICKLE_HEADER = b'\x80'
+
+# tags of values
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_INT = 3
+_NEG_INT = 4
+_FLOAT = 5
+_STR = 6
+_BYTES = 7
+_TUPLE = 8
+_LIST = 9
+_FROZENSET = 10
+_ENTITY = 11
+_PICKLE = 12
+_PATH = 13
+_PATH_REF = 14
+
+_FLOAT_STRUCT = struct.Struct(">d")
+_TYPE_ID_STRUCT = struct.Struct(">L")
+
+# type id of types which are not pickleable entities
+_NOT_ENTITY = -1
+
+# ids of entity types by type objects
+_ENTITY_TYPE_IDS = {}
+
+# ==============================================================================
+
+
+class ErrorEntityCodecInvalidData(Exception):
+
+    def __init__(self, details):
+        msg = "Invalid format of entity data: %s" % (details,)
+        super(ErrorEntityCodecInvalidData, self).__init__(msg)
+
+# ==============================================================================
+
+
+def _to_view_py2(data):
+    # items of bytes and memoryview are strings
+    return bytearray(data)
+
+
+def _to_view_py3(data):
+    if type(data) is bytes:
+        return data
+
+    return memoryview(data)
+
+
+try:
+    memoryview(b'0')[0] + 0
+    _to_view = _to_view_py3
+except TypeError:
+    _to_view = _to_view_py2
+
+# ==============================================================================
+
+
+class _Output (bytearray):
+    """
+    Encoded record with positions of already stored directories
+    """
+
+    __slots__ = ('dirs',)
+
+    def __init__(self):
+        super(_Output, self).__init__()
+        self.dirs = {}
+
+# ==============================================================================
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+# ==============================================================================
+
+
+def _read_varint(data, pos):
+    value = data[pos]
+    pos += 1
+    if value < 0x80:
+        return value, pos
+
+    value &= 0x7F
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+
+        shift += 7
+
+# ==============================================================================
+
+
+def _encode_none(out, value):
+    out.append(_NONE)
+
+
+def _encode_bool(out, value):
+    out.append(_TRUE if value else _FALSE)
+
+
+def _encode_int(out, value):
+    if value < 0:
+        out.append(_NEG_INT)
+        _write_varint(out, -1 - value)
+    else:
+        out.append(_INT)
+        _write_varint(out, value)
+
+
+def _encode_float(out, value, pack=_FLOAT_STRUCT.pack):
+    out.append(_FLOAT)
+    out += pack(value)
+
+
+def _encode_bytes(out, value):
+    out.append(_BYTES)
+    _write_varint(out, len(value))
+    out += value
+
+
+def _encode_path(out, value, sep=os.sep):
+    dir_name, sep, name = value.rpartition(sep)
+
+    dirs = out.dirs
+    try:
+        dir_pos = dirs[dir_name]
+    except KeyError:
+        out.append(_PATH)
+        # offset from the start of values, the header is skipped
+        dirs[dir_name] = len(out) - 1
+
+        dir_name = dir_name.encode('utf-8')
+        _write_varint(out, len(dir_name))
+        out += dir_name
+    else:
+        out.append(_PATH_REF)
+        _write_varint(out, dir_pos)
+
+    name = name.encode('utf-8')
+    _write_varint(out, len(name))
+    out += name
+
+
+def _encode_str(out, value, _sep=os.sep):
+    if value.rfind(_sep) > 0:
+        _encode_path(out, value)
+        return
+
+    value = value.encode('utf-8')
+    out.append(_STR)
+    _write_varint(out, len(value))
+    out += value
+
+
+def _encode_items(out, tag, values, _u_str=u_str, _sep=os.sep):
+    out.append(tag)
+    _write_varint(out, len(values))
+
+    # strings are encoded inline as the most frequent values
+    for value in values:
+        value_type = type(value)
+
+        if value_type is _u_str:
+            if value.rfind(_sep) > 0:
+                _encode_path(out, value)
+                continue
+
+            value = value.encode('utf-8')
+            tag = _STR
+
+        elif value_type is bytes:
+            tag = _BYTES
+
+        elif value is None:
+            out.append(_NONE)
+            continue
+
+        else:
+            _encode(out, value)
+            continue
+
+        out.append(tag)
+
+        size = len(value)
+        if size < 0x80:
+            out.append(size)
+        else:
+            _write_varint(out, size)
+
+        out += value
+
+
+def _encode_tuple(out, value):
+    _encode_items(out, _TUPLE, value)
+
+
+def _encode_list(out, value):
+    _encode_items(out, _LIST, value)
+
+
+def _encode_frozenset(out, value):
+    _encode_items(out, _FROZENSET, value)
+
+# ==============================================================================
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    bytes: _encode_bytes,
+    u_str: _encode_str,
+    tuple: _encode_tuple,
+    list: _encode_list,
+    frozenset: _encode_frozenset,
+}
+
+try:
+    _ENCODERS[long] = _encode_int   # noqa
+except NameError:
+    pass
+
+# ==============================================================================
+
+
+def _get_entity_type_id(value_type,
+                        entity_type_ids=_ENTITY_TYPE_IDS,
+                        known_type_names=_KNOWN_TYPE_NAMES):
+    try:
+        return entity_type_ids[value_type]
+    except KeyError:
+        pass
+
+    type_name = _pickle_type_name(value_type)
+    type_id = known_type_names.get(type_name, _NOT_ENTITY)
+
+    return entity_type_ids.setdefault(value_type, type_id)
+
+# ==============================================================================
+
+
+def _encode(out, value,
+            encoders=_ENCODERS,
+            type_id_pack=_TYPE_ID_STRUCT.pack):
+
+    value_type = type(value)
+
+    try:
+        encoder = encoders[value_type]
+    except KeyError:
+        pass
+    else:
+        encoder(out, value)
+        return
+
+    type_id = _get_entity_type_id(value_type)
+    if type_id != _NOT_ENTITY:
+        out.append(_ENTITY)
+        out += type_id_pack(type_id)
+        _encode_tuple(out, value.__getnewargs__())
+
+    else:
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        out.append(_PICKLE)
+        _write_varint(out, len(value))
+        out += value
+
+# ==============================================================================
+
+
+def _decode_none(data, pos):
+    return None, pos
+
+
+def _decode_true(data, pos):
+    return True, pos
+
+
+def _decode_false(data, pos):
+    return False, pos
+
+
+def _decode_int(data, pos):
+    return _read_varint(data, pos)
+
+
+def _decode_neg_int(data, pos):
+    value, pos = _read_varint(data, pos)
+    return -1 - value, pos
+
+
+def _decode_float(data, pos, unpack_from=_FLOAT_STRUCT.unpack_from):
+    return unpack_from(data, pos)[0], pos + 8
+
+
+def _decode_bytes(data, pos):
+    size, pos = _read_varint(data, pos)
+    end = pos + size
+    return bytes(data[pos: end]), end
+
+
+def _decode_str(data, pos):
+    size, pos = _read_varint(data, pos)
+    end = pos + size
+    return bytes(data[pos: end]).decode('utf-8'), end
+
+
+def _decode_path(data, pos, sep=os.sep):
+    dir_name, pos = _decode_str(data, pos)
+    name, pos = _decode_str(data, pos)
+    return dir_name + sep + name, pos
+
+
+def _decode_path_ref(data, pos, sep=os.sep):
+    dir_pos, pos = _read_varint(data, pos)
+    dir_name = _decode_str(data, dir_pos)[0]
+
+    name, pos = _decode_str(data, pos)
+    return dir_name + sep + name, pos
+
+
+def _decode_items(data, pos):
+    count, pos = _read_varint(data, pos)
+
+    values = []
+    append = values.append
+
+    decoders = _DECODERS
+
+    for i in range(count):
+        tag = data[pos]
+
+        try:
+            decoder = decoders[tag]
+        except IndexError:
+            raise ErrorEntityCodecInvalidData("unknown tag: %s" % (tag,))
+
+        value, pos = decoder(data, pos + 1)
+        append(value)
+
+    return values, pos
+
+
+def _decode_tuple(data, pos):
+    values, pos = _decode_items(data, pos)
+    return tuple(values), pos
+
+
+def _decode_list(data, pos):
+    return _decode_items(data, pos)
+
+
+def _decode_frozenset(data, pos):
+    values, pos = _decode_items(data, pos)
+    return frozenset(values), pos
+
+
+def _decode_entity(data, pos,
+                   type_id_unpack_from=_TYPE_ID_STRUCT.unpack_from,
+                   known_type_ids=_KNOWN_TYPE_IDS):
+
+    type_id = type_id_unpack_from(data, pos)[0]
+
+    try:
+        entity_type = known_type_ids[type_id]
+    except KeyError:
+        raise ErrorEntityCodecInvalidData("unknown type id: %s" % (type_id,))
+
+    if data[pos + 4] != _TUPLE:
+        raise ErrorEntityCodecInvalidData("invalid entity arguments")
+
+    new_args, pos = _decode_items(data, pos + 5)
+
+    return entity_type.__new__(entity_type, *new_args), pos
+
+
+def _decode_pickle(data, pos):
+    size, pos = _read_varint(data, pos)
+    end = pos + size
+    return pickle.loads(bytes(data[pos: end])), end
+
+# ==============================================================================
+
+
+_DECODERS = (
+    _decode_none,
+    _decode_true,
+    _decode_false,
+    _decode_int,
+    _decode_neg_int,
+    _decode_float,
+    _decode_str,
+    _decode_bytes,
+    _decode_tuple,
+    _decode_list,
+    _decode_frozenset,
+    _decode_entity,
+    _decode_pickle,
+    _decode_path,
+    _decode_path_ref,
+)
+
+# ==============================================================================
+
+
+def _decode(data, pos, decoders=_DECODERS):
+    tag = data[pos]
+
+    try:
+        decoder = decoders[tag]
+    except IndexError:
+        raise ErrorEntityCodecInvalidData("unknown tag: %s" % (tag,))
+
+    return decoder(data, pos + 1)
+
+# ==============================================================================
+
+
+class EntityCodec (object):
+    """
+    Encodes entities into compact binary records.
+    Records of EntityPickler are decoded as well.
+    If compact is False then entities are encoded by EntityPickler,
+    it's faster to decode them.
+    """
+
+    __slots__ = ('pickler', 'compact')
+
+    # records bigger than this size are compressed
+    COMPRESS_SIZE = 512
+
+    # -----------------------------------------------------------
+
+    def __init__(self, compact=True):
+        self.pickler = EntityPickler()
+        self.compact = compact
+
+    # -----------------------------------------------------------
+
+    def dumps(self, entity):
+        if not self.compact:
+            return self.pickler.dumps(entity)
+
+        out = _Output()
+        out.append(_HEADER)
+
+        _encode(out, entity)
+
+        if len(out) > self.COMPRESS_SIZE:
+            compressed = zlib.compress(bytes(out[1:]), 1)
+
+            if (len(compressed) + 1) < len(out):
+                out = bytearray()
+                out.append(_HEADER_COMPRESSED)
+                out += compressed
+
+        return bytes(out)
+
+    # -----------------------------------------------------------
+
+    def loads(self, data):
+        """
+        Decodes an entity from bytes or any buffer like memoryview
+        """
+
+        if data[:1] == _PICKLE_HEADER:
+            return self.pickler.loads(data)
+
+        data = _to_view(data)
+
+        header = data[0]
+
+        if header in _HEADERS_COMPRESSED:
+            data = _to_view(zlib.decompress(bytes(data[1:])))
+
+        elif header in _HEADERS:
+            # offsets of directories are counted from the start of values
+            data = data[1:]
+
+        elif header & 0xF0 == 0xA0:
+            raise ErrorEntityCodecInvalidData(
+                "unsupported version: %s" % (header & 0x07,))
+
+        else:
+            return self.pickler.loads(data)
+
+        entity, pos = _decode(data, 0)
+
+        if pos != len(data):
+            raise ErrorEntityCodecInvalidData("unexpected data at the end")
+
+        return entity
@@ -42,20 +42,16 @@ _KNOWN_TYPE_IDS = {}
 
 class EntityPickler (object):
 
-    __slots__ = ('pickler', 'unpickler', 'buffer')
+    __slots__ = ('pickler', 'buffer')
 
     def __init__(self):
 
         membuf = io.BytesIO()
 
         pickler = pickle.Pickler(membuf, protocol=pickle.HIGHEST_PROTOCOL)
-        unpickler = pickle.Unpickler(membuf)
-
         pickler.persistent_id = self.persistent_id
-        unpickler.persistent_load = self.persistent_load
 
         self.pickler = pickler
-        self.unpickler = unpickler
         self.buffer = membuf
 
     # -----------------------------------------------------------
@@ -101,13 +97,12 @@ class EntityPickler (object):
     # -----------------------------------------------------------
 
     def loads(self, bytes_object):
-        buf = self.buffer
-        buf.seek(0)
-        buf.truncate(0)
-        buf.write(bytes_object)
-        buf.seek(0)
+        # memo of an unpickler can't be cleared,
+        # so a reused unpickler resolves references of a record incorrectly
+        unpickler = pickle.Unpickler(io.BytesIO(bytes_object))
+        unpickler.persistent_load = self.persistent_load
 
-        return self.unpickler.load()
+        return unpickler.load()
 
 # ==============================================================================
 
@@ -21,11 +21,13 @@
 
 
 import os
+import operator
 
 from .aql_entity import EntityBase
 from .aql_entity_pickler import pickleable
 
-from aql.utils import file_signature, file_time_signature
+from aql.util_types import get_work_dir
+from aql.utils import cached_file_signature, file_time_signature
 
 __all__ = (
     'FileEntityBase',
@@ -33,6 +35,9 @@ __all__ = (
     'FilePartChecksumEntity',
     'FileTimestampEntity',
     'DirEntity',
+    'prefetch_signatures',
+    'share_file_entities',
+    'reset_shared_file_entities',
 )
 
 # ==============================================================================
@@ -45,10 +50,86 @@ class ErrorFileEntityNoName(Exception):
         super(ErrorFileEntityNoName, self).__init__(msg)
 
 
+# ==============================================================================
+class _FilePathTable (object):
+    """
+    Memoized normalization of file paths.
+    Each normalized path is stored once and shared by all entities of the file.
+    """
+
+    __slots__ = (
+        'abs_paths',
+        'rel_paths',
+        'paths',
+    )
+
+    # max number of stored paths
+    MAX_SIZE = 0x40000
+
+    # -----------------------------------------------------------
+
+    def __init__(self):
+        self.abs_paths = {}
+        self.rel_paths = {}
+        self.paths = {}
+
+    # -----------------------------------------------------------
+
+    def clear(self):
+        self.abs_paths.clear()
+        self.rel_paths.clear()
+        self.paths.clear()
+
+    # -----------------------------------------------------------
+
+    def normalize(self, path,
+                  _isabs=os.path.isabs,
+                  _join=os.path.join,
+                  _normpath=os.path.normpath,
+                  _normcase=os.path.normcase):
+        """
+        The same as os.path.normcase(abs_path(path))
+        """
+
+        try:
+            return self.abs_paths[path]
+        except KeyError:
+            pass
+
+        if _isabs(path):
+            key = path
+            cache = self.abs_paths
+            norm_path = _normpath(path)
+        else:
+            key = (get_work_dir(), path)
+            cache = self.rel_paths
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+
+            norm_path = _normpath(_join(key[0], path))
+
+        norm_path = _normcase(norm_path)
+
+        paths = self.paths
+        if len(paths) >= self.MAX_SIZE:
+            self.clear()
+
+        norm_path = paths.setdefault(norm_path, norm_path)
+        cache[key] = norm_path
+
+        return norm_path
+
+
+_FILE_PATHS = _FilePathTable()
+
+
 # ==============================================================================
 class FileEntityBase (EntityBase):
 
-    def __new__(cls, name, signature=NotImplemented, tags=None):
+    def __new__(cls, name, signature=NotImplemented, tags=None,
+                _normalize=_FILE_PATHS.normalize):
 
         if isinstance(name, FileEntityBase):
             name = name.name
@@ -59,7 +140,7 @@ class FileEntityBase (EntityBase):
         if not name:
             raise ErrorFileEntityNoName()
 
-        name = os.path.normcase(os.path.abspath(name))
+        name = _normalize(name)
 
         self = super(FileEntityBase, cls).__new__(cls, name,
                                                   signature, tags=tags)
@@ -112,11 +193,21 @@ class FileEntityBase (EntityBase):
 
         return False
 
+    # -----------------------------------------------------------
+
+    def _get_signature_key(self):
+        return self.id
+
+    # -----------------------------------------------------------
+
+    def _get_share_key(self):
+        return self.__class__, self.name, self.tags
+
 
 # ==============================================================================
 def _get_file_checksum(path, offset=0):
     try:
-        signature = file_signature(path, offset)
+        signature = cached_file_signature(path, offset)
     except (OSError, IOError):
         try:
             signature = file_time_signature(path)
@@ -188,6 +279,16 @@ class FilePartChecksumEntity (FileEntityBase):
     def get_signature(self):
         return _get_file_checksum(self.name, self.offset)
 
+    # -----------------------------------------------------------
+
+    def _get_signature_key(self):
+        return self.id, self.offset
+
+    # ----------------------------------------------------------
+
+    def _get_share_key(self):
+        return self.__class__, self.name, self.tags, self.offset
+
     # ----------------------------------------------------------
 
     def get_actual(self):
@@ -208,3 +309,87 @@ class FilePartChecksumEntity (FileEntityBase):
     def __eq__(self, other):
         return super(FilePartChecksumEntity, self).__eq__(other) and \
             (self.offset == other.offset)
+
+
+# ==============================================================================
+def prefetch_signatures(entities, thread_pool=None,
+                        _get_known_signature=EntityBase.signature.__get__,
+                        _get_signature=operator.methodcaller('get_signature')):
+    """
+    Calculates not yet known signatures of file entities at once,
+    in threads of the pool if it's specified.
+    Returns number of already known and calculated signatures.
+    """
+
+    hits = 0
+    unknown_entities = {}
+
+    for entity in entities:
+        if not isinstance(entity, FileEntityBase):
+            continue
+
+        try:
+            _get_known_signature(entity)
+            hits += 1
+        except AttributeError:
+            key = entity._get_signature_key()
+            unknown_entities.setdefault(key, []).append(entity)
+
+    groups = list(unknown_entities.values())
+    misses = len(groups)
+    if not misses:
+        return hits, misses
+
+    hits += sum(map(len, groups)) - misses
+
+    group_entities = [group[0] for group in groups]
+
+    if (thread_pool is None) or (misses < 2):
+        signatures = map(_get_signature, group_entities)
+    else:
+        signatures = thread_pool.map(_get_signature, group_entities)
+
+    for group, signature in zip(groups, signatures):
+        for entity in group:
+            entity.signature = signature
+
+    return hits, misses
+
+
+# ==============================================================================
+# file entities shared by nodes of the current build
+_SHARED_FILE_ENTITIES = {}
+
+
+def share_file_entities(entities,
+                        _shared_entities=_SHARED_FILE_ENTITIES,
+                        _get_known_signature=EntityBase.signature.__get__):
+    """
+    Replaces new file entities by the same ones used by other nodes,
+    so id and signature of a file are calculated only once per build.
+    Returns list of entities.
+    """
+
+    shared_entities = []
+
+    for entity in entities:
+        if isinstance(entity, FileEntityBase):
+            try:
+                _get_known_signature(entity)
+            except AttributeError:
+                # entities may be shared in several threads,
+                # so the first entity wins
+                entity = _shared_entities.setdefault(entity._get_share_key(),
+                                                     entity)
+
+        shared_entities.append(entity)
+
+    return shared_entities
+
+
+# ==============================================================================
+def reset_shared_file_entities(_shared_entities=_SHARED_FILE_ENTITIES):
+    """
+    Forgets shared file entities as files may change after the build
+    """
+    _shared_entities.clear()
@@ -22,4 +22,5 @@
 from .aql_info import *
 from .aql_tools_manager import *
 from .aql_project import *
+from .aql_build_server import *
 from .aql_main import *
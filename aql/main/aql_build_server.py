@@ -0,0 +1,449 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+
+from aql.util_types import encode_str, to_unicode
+from aql.utils import event_status, event_warning, log_info, log_warning,\
+    set_log_stream, Chdir, send_message, recv_message
+
+__all__ = (
+    'BuildServer', 'build_on_server', 'get_build_server_address',
+    'is_build_server_running',
+    'ErrorBuildServerNotSupported', 'ErrorBuildServerRunning',
+)
+
+# ==============================================================================
+
+# The client sends a build request, the server replies by output messages
+# and the exit status of the build.
+_REQUEST = 1
+_OUTPUT = 2
+_STATUS = 3
+_RESTART = 4
+
+# how long the client waits for a restarting server
+_RESTART_TIMEOUT = 30
+
+
+# ==============================================================================
+@event_status
+def event_build_server_started(settings, address):
+    log_info("Build server is listening on '%s'", address)
+
+
+# ==============================================================================
+@event_status
+def event_build_server_restarting(settings):
+    log_info("Modules have been changed, restarting the build server...")
+
+
+# ==============================================================================
+@event_warning
+def event_build_server_not_running(settings, address):
+    log_warning("Build server '%s' is not running, building locally",
+                address)
+
+
+# ==============================================================================
+class ErrorBuildServerNotSupported(Exception):
+
+    def __init__(self):
+        msg = "Build server requires support of Unix domain sockets"
+        super(ErrorBuildServerNotSupported, self).__init__(msg)
+
+
+class ErrorBuildServerRunning(Exception):
+
+    def __init__(self, address):
+        msg = "Build server '%s' is already running" % (address,)
+        super(ErrorBuildServerRunning, self).__init__(msg)
+
+
+# ==============================================================================
+def get_build_server_address(directory):
+    """
+    Returns path to the socket of the build server of the directory
+    """
+    directory = os.path.normcase(os.path.abspath(directory))
+    name = hashlib.md5(encode_str(directory)).hexdigest()[:16]
+
+    try:
+        user_id = os.getuid()
+    except AttributeError:
+        user_id = 0
+
+    return os.path.join(tempfile.gettempdir(),
+                        'aql-%s-%s.sock' % (user_id, name))
+
+
+# ==============================================================================
+def _connect(address, timeout=0):
+    """
+    Returns connected socket or None if the server is not available
+    """
+    end_time = time.time() + timeout
+
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(address)
+            return conn
+
+        except socket.error:
+            conn.close()
+
+            if time.time() >= end_time:
+                return None
+
+            time.sleep(0.1)
+
+
+# ==============================================================================
+def is_build_server_running(directory):
+    """
+    Returns True if the build server of the directory accepts connections
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+
+    conn = _connect(get_build_server_address(directory))
+    if conn is None:
+        return False
+
+    conn.close()
+    return True
+
+
+# ==============================================================================
+def _get_modules_state(state):
+    """
+    Adds modification times of files of new loaded modules
+    """
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if filename and (filename not in state):
+            try:
+                state[filename] = os.stat(filename).st_mtime
+            except OSError:
+                pass
+
+    return state
+
+
+def _is_modules_changed(state):
+    for filename, mtime in state.items():
+        try:
+            if os.stat(filename).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+
+    return False
+
+
+# ==============================================================================
+class _ClientStream (object):
+    """
+    File-like object which sends the written text to the client
+    """
+
+    __slots__ = ('conn', 'lock', 'closed')
+
+    encoding = 'utf-8'
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.closed = False
+
+    # -----------------------------------------------------------
+
+    def write(self, text):
+        if not text:
+            return
+
+        data = to_unicode(text).encode('utf-8')
+
+        with self.lock:
+            if self.closed:
+                return
+
+            try:
+                send_message(self.conn, _OUTPUT, data)
+            except socket.error:
+                # the client has gone, but the build goes on
+                self.closed = True
+
+    # -----------------------------------------------------------
+
+    def flush(self):
+        pass
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def isatty():
+        return False
+
+
+# ==============================================================================
+class BuildServer (object):
+    """
+    Runs builds requested by clients in the same long living process.
+    So all imported modules, loaded tools and caches stay warm between builds.
+    """
+
+    __slots__ = (
+        'address',
+        'handler',
+        'socket',
+        'modules',
+    )
+
+    # -----------------------------------------------------------
+
+    def __init__(self, directory, handler):
+        """
+        handler(args) runs the build with CLI arguments and returns its status
+        """
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ErrorBuildServerNotSupported()
+
+        self.address = get_build_server_address(directory)
+        self.handler = handler
+        self.modules = {}
+        self.socket = self._listen(self.address)
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _listen(address):
+        if os.path.exists(address):
+            conn = _connect(address)
+            if conn is not None:
+                conn.close()
+                raise ErrorBuildServerRunning(address)
+
+            # the socket of a killed server
+            os.remove(address)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # only the owner is allowed to run builds
+            umask = os.umask(0o177)
+            try:
+                sock.bind(address)
+            finally:
+                os.umask(umask)
+
+            sock.listen(16)
+
+        except Exception:
+            sock.close()
+            raise
+
+        return sock
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        sock = self.socket
+        if sock is not None:
+            self.socket = None
+
+            # wakes up accept() waiting in another thread
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            sock.close()
+
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def _run_build(self, cwd, args, stream):
+        prev_log_stream = set_log_stream(stream)
+        prev_stdout = sys.stdout
+        prev_stderr = sys.stderr
+
+        sys.stdout = sys.stderr = stream
+        try:
+            with Chdir(cwd):
+                return self.handler(args)
+        finally:
+            sys.stdout = prev_stdout
+            sys.stderr = prev_stderr
+            set_log_stream(prev_log_stream)
+
+    # -----------------------------------------------------------
+
+    def _serve_request(self, conn, data):
+        stream = _ClientStream(conn)
+
+        try:
+            request = json.loads(data.decode('utf-8'))
+            cwd = request['cwd']
+            args = request['args']
+        except Exception as ex:
+            stream.write("Invalid build request: %s\n" % (ex,))
+            status = 1
+        else:
+            status = self._run_build(cwd, args, stream)
+
+        try:
+            send_message(conn, _STATUS, str(status).encode('ascii'))
+        except socket.error:
+            pass
+
+    # -----------------------------------------------------------
+
+    def serve(self):
+        """
+        Serves build requests one by one.
+        Returns True if modules of the process have been changed
+        and the process should be restarted,
+        returns False if the server has been closed.
+        """
+
+        event_build_server_started(self.address)
+
+        sock = self.socket
+        modules = _get_modules_state(self.modules)
+
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except socket.error:
+                if self.socket is None:
+                    return False
+                raise
+
+            try:
+                kind, data = recv_message(conn)
+                if kind != _REQUEST:
+                    continue
+
+                if _is_modules_changed(modules):
+                    event_build_server_restarting()
+
+                    # next clients will wait for the restarted server
+                    self.close()
+                    send_message(conn, _RESTART)
+                    return True
+
+                self._serve_request(conn, data)
+
+            except socket.error:
+                pass
+
+            finally:
+                conn.close()
+
+            # tools and other modules may be loaded by builds
+            _get_modules_state(modules)
+
+
+# ==============================================================================
+def _request_build(conn, request, output):
+    try:
+        send_message(conn, _REQUEST, request)
+        kind, data = recv_message(conn)
+
+    except socket.error:
+        # the connection has been reset by the restarting server
+        return None
+
+    if kind is None:
+        return None
+
+    while True:
+        if kind == _OUTPUT:
+            output.write(data.decode('utf-8'))
+            output.flush()
+
+        elif kind == _STATUS:
+            return int(data)
+
+        elif kind == _RESTART:
+            return None
+
+        else:
+            raise socket.error("Build server has closed the connection")
+
+        kind, data = recv_message(conn)
+
+
+# ==============================================================================
+def build_on_server(directory, args, output=None):
+    """
+    Runs the build by the build server of the directory.
+    Returns exit status of the build or None if there is no running server.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    if output is None:
+        output = sys.stdout
+
+    address = get_build_server_address(directory)
+
+    request = {'cwd': os.getcwd(), 'args': list(args)}
+    request = json.dumps(request).encode('utf-8')
+
+    timeout = 0
+    while True:
+        conn = _connect(address, timeout)
+        if conn is None:
+            event_build_server_not_running(address)
+            return None
+
+        try:
+            status = _request_build(conn, request, output)
+        finally:
+            conn.close()
+
+        if status is not None:
+            return status
+
+        # wait for the restarted server
+        timeout = _RESTART_TIMEOUT
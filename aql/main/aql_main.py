@@ -22,6 +22,8 @@
 import gc
 import os
 import sys
+import time
+import signal
 import pstats
 import cProfile
 import traceback
@@ -31,10 +33,15 @@ from aql.util_types import to_unicode
 from aql.utils import event_status, event_error, EventSettings,\
     set_event_settings, Chrono, Chdir, memory_usage,\
     split_path, expand_file_path,\
-    log_info, log_error, set_log_level, LOG_WARNING
+    log_info, log_error, set_log_level, LOG_WARNING, LOG_DEBUG, FileWatcher,\
+    get_files_state, get_changed_files,\
+    open_trace_file, close_trace_file, trace_span
+from aql.nodes import NodeEntity, BuildWorker, close_kept_db_files
 
 from .aql_project import Project, ProjectConfig
 from .aql_info import get_aql_info, dump_aql_info
+from .aql_build_server import BuildServer, build_on_server,\
+    is_build_server_running
 
 __all__ = ('main', )
 
@@ -76,6 +83,21 @@ def event_build_summary(settings, elapsed):
     log_info("Total time: %s", elapsed)
 
 
+# ==============================================================================
+@event_status
+def event_watching_files(settings, count):
+    log_info("Watching %s files for changes...", count)
+
+
+# ==============================================================================
+@event_status
+def event_files_changed(settings, filenames):
+    if settings.brief:
+        log_info("Changed files: %s", len(filenames))
+    else:
+        log_info("Changed files: %s", ', '.join(sorted(filenames)))
+
+
 # ==============================================================================
 def _find_make_script(script):
 
@@ -195,7 +217,8 @@ def _read_make_script(prj):
     event_reading_scripts()
 
     with Chrono() as elapsed:
-        prj.read_script(makefile)
+        with trace_span('Reading scripts', 'main'):
+            prj.read_script(makefile)
 
     event_reading_scripts_done(elapsed)
 
@@ -221,7 +244,8 @@ def _build(prj):
     event_building()
 
     with Chrono() as elapsed:
-        success = prj.build()
+        with trace_span('Building', 'main'):
+            success = prj.build()
 
     event_building_done(success, elapsed)
 
@@ -233,6 +257,17 @@ def _build(prj):
 
 # ==============================================================================
 def _main(prj_cfg):
+    if prj_cfg.trace_file:
+        open_trace_file(prj_cfg.trace_file)
+
+    try:
+        return _main_impl(prj_cfg)
+    finally:
+        close_trace_file()
+
+
+# ==============================================================================
+def _main_impl(prj_cfg):
     with Chrono() as total_elapsed:
 
         ev_settings = EventSettings(brief=not prj_cfg.verbose,
@@ -318,6 +353,145 @@ def _log_error(ex, with_backtrace):
     event_aql_error(err)
 
 
+# ==============================================================================
+def _run_warm_build(args, used_files=None, built_files=None):
+    # It's called by the build server for each build request
+    # and by the watch mode for each rebuild
+
+    with_backtrace = True
+    try:
+        prj_cfg = ProjectConfig(args)
+        with_backtrace = prj_cfg.debug_backtrace
+
+        prj_cfg.keep_db_open = True
+        prj_cfg.used_files = used_files
+        prj_cfg.built_files = built_files
+
+        if prj_cfg.show_version:
+            log_info(dump_aql_info())
+            return 0
+
+        set_log_level(LOG_WARNING if prj_cfg.silent else LOG_DEBUG)
+
+        # each build has to check implicit dependencies again
+        NodeEntity.reset_actual_ideps()
+
+        status = _run_main(prj_cfg)
+
+    except Exception as ex:
+        _log_error(ex, with_backtrace)
+        status = 1
+
+    return status
+
+
+# ==============================================================================
+def _stop_server(signum, frame):
+    raise KeyboardInterrupt()
+
+
+# ==============================================================================
+def _run_server(prj_cfg):
+    signal.signal(signal.SIGTERM, _stop_server)
+
+    try:
+        with BuildServer(prj_cfg.directory, _run_warm_build) as server:
+            if not server.serve():
+                return 0
+
+    except KeyboardInterrupt:
+        return 0
+
+    finally:
+        close_kept_db_files()
+
+    # modules have been changed, so restart the server
+    argv = getattr(sys, 'orig_argv', None) or [sys.executable] + sys.argv
+    os.execv(sys.executable, argv)
+
+
+# ==============================================================================
+def _run_build_worker(prj_cfg):
+    # builders sent by clients are instances of classes of tools
+    Project(prj_cfg)
+
+    cache_size = prj_cfg.cache_size * 1024 * 1024
+
+    try:
+        with BuildWorker(prj_cfg.build_worker, jobs=prj_cfg.jobs,
+                         cache_dir=prj_cfg.cache_dir,
+                         cache_size=cache_size,
+                         secret=prj_cfg.build_secret) as worker:
+            # worker processes are already started with default handlers
+            signal.signal(signal.SIGTERM, _stop_server)
+            worker.serve()
+
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+# ==============================================================================
+def _run_watch(args):
+    used_files = set()
+
+    try:
+        while True:
+            # files may be changed while they are being built
+            files_state = get_files_state(used_files)
+            start_time = time.time()
+
+            used_files = set()
+            built_files = set()
+            status = _run_warm_build(args, used_files, built_files)
+
+            if not used_files:
+                return status
+
+            with FileWatcher(used_files) as watcher:
+                changed_files = get_changed_files(used_files, files_state,
+                                                  start_time, built_files)
+                if not changed_files:
+                    event_watching_files(len(used_files))
+                    changed_files = watcher.wait()
+
+            event_files_changed(changed_files)
+
+    except KeyboardInterrupt:
+        return 0
+
+    finally:
+        close_kept_db_files()
+
+
+# ==============================================================================
+def _run_mode(prj_cfg):
+    """
+    Runs the build server, the watch mode, a build worker or a build
+    """
+    if prj_cfg.server:
+        return _run_server(prj_cfg)
+
+    if prj_cfg.watch:
+        return _run_watch(sys.argv[1:])
+
+    if prj_cfg.build_worker:
+        return _run_build_worker(prj_cfg)
+
+    status = None
+
+    # the running server keeps DB files locked, so the build goes there
+    if prj_cfg.use_server or \
+       is_build_server_running(prj_cfg.directory):
+        status = build_on_server(prj_cfg.directory, sys.argv[1:])
+
+    if status is None:
+        status = _run_main(prj_cfg)
+
+    return status
+
+
 # ==============================================================================
 def main():
     with_backtrace = True
@@ -334,7 +508,7 @@ def main():
         if prj_cfg.silent:
             set_log_level(LOG_WARNING)
 
-        status = _run_main(prj_cfg)
+        status = _run_mode(prj_cfg)
 
     except (Exception, KeyboardInterrupt) as ex:
         _log_error(ex, with_backtrace)
@@ -33,7 +33,8 @@ import io
 
 from aql.utils import CLIConfig, CLIOption, get_function_args, exec_file,\
     flatten_list, find_files, cpu_count, Chdir, expand_file_path,\
-    event_status, event_warning, log_info, log_warning
+    event_status, event_warning, log_info, log_warning,\
+    set_signature_algorithm, trace_span
 
 from aql.util_types import AbsFilePath, FilePath, value_list_type, UniqueList,\
     to_sequence, is_sequence
@@ -234,6 +235,15 @@ def _get_default_tools_path(info=get_aql_info()):
     return tool_dirs
 
 
+# ==============================================================================
+def _read_build_secret(secret_file):
+    if not secret_file:
+        return None
+
+    with open(secret_file, 'rb') as f:
+        return f.read().strip()
+
+
 # ==============================================================================
 def _read_config(config_file, cli_config, options):
 
@@ -259,8 +269,14 @@ class ProjectConfig(object):
                  'list_targets',
                  'debug_profile', 'debug_profile_top', 'debug_memory',
                  'debug_explain', 'debug_backtrace',
-                 'debug_exec',
-                 'use_sqlite', 'force_lock',
+                 'debug_exec', 'trace_file',
+                 'use_sqlite', 'use_log_db', 'use_codec', 'single_db',
+                 'force_lock',
+                 'signature_algorithm',
+                 'server', 'use_server', 'keep_db_open',
+                 'watch', 'used_files', 'built_files',
+                 'cache_dir', 'cache_size',
+                 'build_worker', 'build_workers', 'build_secret',
                  'show_version',
                  )
 
@@ -345,6 +361,12 @@ class ProjectConfig(object):
             CLIOption(None, "--debug-exec", "debug_exec", bool, False,
                       "Full trace of all executed commands."),
 
+            CLIOption(None, "--trace-file", "trace_file",
+                      AbsFilePath, None,
+                      "Save a timeline of the build in the specified file "
+                      "in Chrome trace event format.",
+                      'FILE PATH'),
+
             CLIOption("--bt", "--debug-backtrace", "debug_backtrace",
                       bool, False, "Show call stack back traces for errors."),
 
@@ -354,6 +376,68 @@ class ProjectConfig(object):
             CLIOption(None, "--use-sqlite", "use_sqlite", bool, False,
                       "Use SQLite DB."),
 
+            CLIOption(None, "--use-log-db", "use_log_db", bool, False,
+                      "Use append-only DB."),
+
+            CLIOption(None, "--use-entity-codec", "use_codec", bool, False,
+                      "Store entities in DB in compact binary format "
+                      "instead of pickle. "
+                      "It makes DB smaller but slower to load."),
+
+            CLIOption(None, "--single-db", "single_db", bool, False,
+                      "Use one DB for the whole project "
+                      "instead of one DB per build directory."),
+
+            CLIOption(None, "--signature-algorithm", "signature_algorithm",
+                      str, 'md5',
+                      "Hash algorithm of signatures: md5, sha1, blake2b, "
+                      "blake2s or any other supported by hashlib. "
+                      "Changing of it invalidates all built targets.",
+                      'NAME'),
+
+            CLIOption(None, "--server", "server", bool, False,
+                      "Run a build server of the directory. "
+                      "It keeps loaded modules, tools, caches and DB files "
+                      "between builds requested by --use-server.",
+                      cli_only=True),
+
+            CLIOption(None, "--use-server", "use_server", bool, False,
+                      "Build by the running build server of the directory. "
+                      "Build locally if there is no server."),
+
+            CLIOption(None, "--cache-dir", "cache_dir", AbsFilePath, None,
+                      "Directory of a cache of built targets. "
+                      "It can be shared by several projects and machines.",
+                      'DIR PATH'),
+
+            CLIOption(None, "--cache-size", "cache_size", int, 4096,
+                      "Maximum size of the cache of built targets "
+                      "in megabytes.", 'NUMBER'),
+
+            CLIOption(None, "--build-workers", "build_workers",
+                      strings_type, [],
+                      "Addresses of build workers: HOST:PORT or a path "
+                      "to Unix domain socket. Nodes built in processes "
+                      "and expensive nodes are sent to the workers.",
+                      'ADDRESS'),
+
+            CLIOption(None, "--build-worker", "build_worker", str, None,
+                      "Run a build worker on the address: HOST:PORT or "
+                      "a path to Unix domain socket. "
+                      "It loads the same tools as builds.",
+                      'ADDRESS', cli_only=True),
+
+            CLIOption(None, "--build-secret-file", "build_secret_file",
+                      AbsFilePath, None,
+                      "File of a secret shared by build workers and "
+                      "their clients. It's required for TCP addresses.",
+                      'FILE PATH'),
+
+            CLIOption(None, "--watch", "watch", bool, False,
+                      "Rebuild targets on changes of source files, "
+                      "implicit dependencies and build scripts.",
+                      cli_only=True),
+
             CLIOption("-V", "--version", "version", bool, False,
                       "Show version and exit.", cli_only=True),
         )
@@ -421,12 +505,30 @@ class ProjectConfig(object):
         self.jobs = cli_config.jobs
         self.force_lock = cli_config.force_lock
         self.use_sqlite = cli_config.use_sqlite
+        self.use_log_db = cli_config.use_log_db
+        self.use_codec = cli_config.use_codec
+        self.single_db = cli_config.single_db
+        self.signature_algorithm = cli_config.signature_algorithm
+        self.server = cli_config.server
+        self.use_server = cli_config.use_server
+        # set by the build server to keep DB files open between builds
+        self.keep_db_open = False
+        self.watch = cli_config.watch
+        # set by the watch mode to collect files used by a build
+        self.used_files = None
+        self.built_files = None
+        self.cache_dir = cli_config.cache_dir
+        self.cache_size = cli_config.cache_size
+        self.build_worker = cli_config.build_worker
+        self.build_workers = cli_config.build_workers
+        self.build_secret = _read_build_secret(cli_config.build_secret_file)
         self.debug_profile = cli_config.debug_profile
         self.debug_profile_top = cli_config.debug_profile_top
         self.debug_memory = cli_config.debug_memory
         self.debug_explain = cli_config.debug_explain
         self.debug_backtrace = cli_config.debug_backtrace
         self.debug_exec = cli_config.debug_exec
+        self.trace_file = cli_config.trace_file
 
 # ==============================================================================
 
@@ -730,6 +832,9 @@ class Project(object):
         self.arguments = config.arguments
         self.config = config
         self.scripts_cache = {}
+
+        # signatures of all entities and builders depend on it
+        set_signature_algorithm(config.signature_algorithm)
         self.configs_cache = {}
         self.aliases = {}
         self.alias_descriptions = {}
@@ -760,7 +865,7 @@ class Project(object):
             'Tools':            self.tools.get_tools,
             'AddTool':          self.tools.add_tool,
             'LoadTools':        self.tools.tools.load_tools,
-            'FindFiles':        find_files,
+            'FindFiles':        self.find_files,
             'GetProject':       self.get_project,
             'GetProjectConfig': self.get_project_config,
             'GetBuildTargets':  self.get_build_targets,
@@ -780,6 +885,8 @@ class Project(object):
             'Default':          self.default_build,
             'AlwaysBuild':      self.always_build,
             'Expensive':        self.expensive,
+            'Priority':         self.priority,
+            'ProcessBuild':     self.process_build,
             'Build':            self.build,
             'Clear':            self.clear,
             'DirName':          self.node_dirname,
@@ -856,6 +963,37 @@ class Project(object):
 
     # -----------------------------------------------------------
 
+    def _add_used_file(self, filename):
+        used_files = self.config.used_files
+        if used_files is not None:
+            used_files.add(os.path.abspath(filename))
+
+    # -----------------------------------------------------------
+
+    def find_files(self, paths=".", mask=("*",), exclude_mask=('.*',),
+                   exclude_subdir_mask=('__*', '.*'), found_dirs=None):
+
+        used_files = self.config.used_files
+        if used_files is None:
+            return find_files(paths, mask, exclude_mask, exclude_subdir_mask,
+                              found_dirs)
+
+        # new files in found directories change the result
+        dirs = set()
+        files = find_files(paths, mask, exclude_mask, exclude_subdir_mask,
+                           dirs)
+
+        if found_dirs is not None:
+            found_dirs.update(dirs)
+
+        used_files.update(dirs)
+        used_files.update(os.path.abspath(path)
+                          for path in to_sequence(paths))
+
+        return files
+
+    # -----------------------------------------------------------
+
     def read_config(self, config, options=None):
 
         options = self._get_config_options(config, options)
@@ -865,9 +1003,12 @@ class Project(object):
 
         config_locals = {'options': options}
 
+        self._add_used_file(config)
+
         dir_name, file_name = os.path.split(config)
         with Chdir(dir_name):
-            result = exec_file(file_name, config_locals)
+            with trace_span(config, 'script'):
+                result = exec_file(file_name, config_locals)
 
         tools_path = result.pop('tools_path', None)
         if tools_path:
@@ -889,9 +1030,12 @@ class Project(object):
         if script_result is not None:
             return script_result
 
+        self._add_used_file(script)
+
         dir_name, file_name = os.path.split(script)
         with Chdir(dir_name):
-            script_result = exec_file(file_name, self.script_locals)
+            with trace_span(script, 'script'):
+                script_result = exec_file(file_name, self.script_locals)
 
         scripts_cache[script] = script_result
         return script_result
@@ -995,6 +1139,16 @@ class Project(object):
 
     # ----------------------------------------------------------
 
+    def priority(self, nodes, build_time):
+        self.build_manager.priority(nodes, build_time)
+
+    # ----------------------------------------------------------
+
+    def process_build(self, nodes):
+        self.build_manager.process_build(nodes)
+
+    # ----------------------------------------------------------
+
     def _add_alias_nodes(self, target_nodes, aliases):
         try:
             for alias in aliases:
@@ -1050,6 +1204,14 @@ class Project(object):
 
     # ----------------------------------------------------------
 
+    def _get_db_file(self):
+        if not self.config.single_db:
+            return None
+
+        return os.path.join(self.options.build_dir.get(), '.aql.db')
+
+    # ----------------------------------------------------------
+
     def build(self, jobs=None):
 
         jobs = self._get_jobs_count(jobs)
@@ -1065,6 +1227,19 @@ class Project(object):
         with_backtrace = config.debug_backtrace
         force_lock = config.force_lock
         use_sqlite = config.use_sqlite
+        use_log_db = config.use_log_db
+        use_codec = config.use_codec
+        db_file = self._get_db_file()
+        keep_db_open = config.keep_db_open
+        used_files = config.used_files
+        built_files = config.built_files
+        cache_dir = config.cache_dir
+        cache_size = config.cache_size * 1024 * 1024
+        build_workers = config.build_workers
+        build_secret = config.build_secret
+
+        build_dir = self.options.build_dir.get()
+        stat_cache_file = os.path.join(build_dir, '.aql.stat')
 
         is_ok = self.build_manager.build(jobs=jobs,
                                          keep_going=bool(keep_going),
@@ -1072,7 +1247,19 @@ class Project(object):
                                          explain=explain,
                                          with_backtrace=with_backtrace,
                                          use_sqlite=use_sqlite,
-                                         force_lock=force_lock)
+                                         use_log_db=use_log_db,
+                                         force_lock=force_lock,
+                                         stat_cache_file=stat_cache_file,
+                                         db_file=db_file,
+                                         keep_db_open=keep_db_open,
+                                         used_files=used_files,
+                                         built_files=built_files,
+                                         cache_dir=cache_dir,
+                                         cache_size=cache_size,
+                                         cache_root=config.directory,
+                                         build_workers=build_workers,
+                                         build_secret=build_secret,
+                                         use_codec=use_codec)
         return is_ok
 
     # ----------------------------------------------------------
@@ -1083,10 +1270,18 @@ class Project(object):
 
         force_lock = self.config.force_lock
         use_sqlite = self.config.use_sqlite
+        use_log_db = self.config.use_log_db
+        use_codec = self.config.use_codec
+        db_file = self._get_db_file()
+        keep_db_open = self.config.keep_db_open
 
         self.build_manager.clear(nodes=build_nodes,
                                  use_sqlite=use_sqlite,
-                                 force_lock=force_lock)
+                                 use_log_db=use_log_db,
+                                 force_lock=force_lock,
+                                 db_file=db_file,
+                                 keep_db_open=keep_db_open,
+                                 use_codec=use_codec)
 
     # ----------------------------------------------------------
 
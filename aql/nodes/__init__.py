@@ -20,5 +20,7 @@
 #  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from .aql_build_manager import *
+from .aql_artifact_cache import *
+from .aql_build_executor import *
 from .aql_builder import *
 from .aql_node import *
@@ -0,0 +1,640 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import json
+import errno
+import shutil
+import string
+import itertools
+import binascii
+import tempfile
+
+from aql.util_types import is_string
+from aql.utils import event_warning, log_warning, new_hash, file_signature,\
+    simple_object_signature, simplify_value
+from aql.entity import FileEntityBase, FileChecksumEntity,\
+    FileTimestampEntity, FilePartChecksumEntity, DirEntity, SimpleEntity,\
+    SignatureEntity
+
+__all__ = (
+    'ArtifactCache',
+    'ErrorArtifactCacheInvalidKey', 'ErrorArtifactCacheInvalidPath',
+)
+
+# ==============================================================================
+
+
+@event_warning
+def event_artifact_cache_failed(settings, path, error):
+    log_warning("Artifact cache '%s' failed: %s", path, error)
+
+# ==============================================================================
+
+
+class ErrorArtifactCacheInvalidKey(Exception):
+
+    def __init__(self, key):
+        msg = "Invalid key of artifact cache: %r" % (key,)
+        super(ErrorArtifactCacheInvalidKey, self).__init__(msg)
+
+# ==============================================================================
+
+
+class ErrorArtifactCacheInvalidPath(Exception):
+
+    def __init__(self, path):
+        msg = "Path is out of root of artifact cache: %r" % (path,)
+        super(ErrorArtifactCacheInvalidPath, self).__init__(msg)
+
+# ==============================================================================
+
+
+class _NotCacheable(Exception):
+    pass
+
+
+# ==============================================================================
+# entries keep only plain data, entities are restored by their kinds
+_ENTITY_TYPES = {
+    'checksum': FileChecksumEntity,
+    'timestamp': FileTimestampEntity,
+    'part': FilePartChecksumEntity,
+    'value': SimpleEntity,
+    'signature': SignatureEntity,
+}
+
+_ENTITY_KINDS = dict((entity_type, kind)
+                     for kind, entity_type in _ENTITY_TYPES.items())
+
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+_SIZE_FILE = 'size'
+
+# ==============================================================================
+
+
+def _make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+# ==============================================================================
+
+
+def _write_file(filename, data=None, src_file=None):
+    """
+    Writes the file atomically,
+    so concurrent builds never see a partially written file
+    """
+
+    dir_name = os.path.dirname(filename)
+    _make_dirs(dir_name)
+
+    fd, tmp_filename = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if src_file is None:
+                f.write(data)
+            else:
+                with open(src_file, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+
+        try:
+            os.rename(tmp_filename, filename)
+        except OSError:
+            # on Windows an existing file can't be replaced
+            os.remove(filename)
+            os.rename(tmp_filename, filename)
+
+    except Exception:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+# ==============================================================================
+
+
+def _touch(filename):
+    try:
+        os.utime(filename, None)
+    except OSError:
+        pass
+
+# ==============================================================================
+
+
+def _is_parent_path(path):
+    return path.split(os.path.sep, 1)[0] == os.path.pardir
+
+# ==============================================================================
+
+
+def _encode_signature(signature):
+    if signature is None:
+        return None
+
+    return binascii.hexlify(signature).decode()
+
+
+def _decode_signature(signature):
+    if signature is None:
+        return None
+
+    return binascii.unhexlify(signature.encode())
+
+# ==============================================================================
+
+
+class ArtifactCache (object):
+    """
+    Content-addressed cache of built targets shared between builds.
+    Targets of a node entity are stored under a key of its builder
+    and sources, file paths are relative to the root of a project,
+    so an identical node built elsewhere is restored instead of building.
+    """
+
+    __slots__ = (
+        'path',
+        'root',
+        'max_size',
+        'hits',
+        'misses',
+        'stored',
+        'stored_size',
+    )
+
+    def __init__(self, path, max_size=None, root=None):
+        self.path = os.path.abspath(path)
+        self.root = os.path.abspath(root or os.curdir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.stored_size = 0
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    # -----------------------------------------------------------
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def _get_relpath(self, path):
+        """
+        Returns the path relative to the root
+        or None if the path is out of the root
+        """
+        try:
+            path = os.path.relpath(path, self.root)
+        except ValueError:
+            # a path on another drive
+            return None
+
+        if os.path.isabs(path) or _is_parent_path(path):
+            return None
+
+        return path
+
+    # -----------------------------------------------------------
+
+    def _get_file_name(self, path):
+        relpath = self._get_relpath(path)
+        if relpath is None:
+            return path
+
+        return relpath
+
+    # -----------------------------------------------------------
+
+    def _get_root_path(self, path):
+        if os.path.isabs(path):
+            return path
+
+        return os.path.join(self.root, path)
+
+    # -----------------------------------------------------------
+
+    def _get_target_path(self, path):
+        if os.path.isabs(path) or _is_parent_path(os.path.normpath(path)):
+            raise ErrorArtifactCacheInvalidPath(path)
+
+        return os.path.join(self.root, path)
+
+    # -----------------------------------------------------------
+
+    def _get_value_key(self, value):
+        if is_string(value):
+            if os.path.isabs(value):
+                return self._get_file_name(value)
+
+        elif isinstance(value, (list, tuple)):
+            return [self._get_value_key(item) for item in value]
+
+        elif isinstance(value, dict):
+            return dict((key, self._get_value_key(item))
+                        for key, item in value.items())
+
+        return value
+
+    # -----------------------------------------------------------
+
+    def _get_builder_key(self, builder):
+        cls = type(builder)
+        key = [cls.__module__,
+               cls.__name__,
+               simplify_value(builder.build_path),
+               bool(builder.relative_build_paths)]
+
+        if builder.NAME_ATTRS:
+            key.extend(simplify_value(getattr(builder, attr_name))
+                       for attr_name in builder.NAME_ATTRS)
+
+        return simple_object_signature(self._get_value_key(key))
+
+    # -----------------------------------------------------------
+
+    def _get_entity_key(self, entity):
+        if isinstance(entity, FileEntityBase):
+            return simple_object_signature(
+                (self._get_file_name(entity.name), type(entity).__name__))
+
+        return entity.id
+
+    # -----------------------------------------------------------
+
+    def _get_entry_path(self, node_entity):
+        builder = node_entity.builder
+
+        builder_signature = builder.signature
+        if builder_signature is None:
+            return None
+
+        key = new_hash(builder_signature)
+        key.update(self._get_builder_key(builder))
+
+        for entity in itertools.chain(node_entity.deps_hash.dep_entities,
+                                      node_entity.source_entities):
+            signature = entity.signature
+            if not signature:
+                return None
+
+            key.update(self._get_entity_key(entity))
+            key.update(signature)
+
+        key = key.hexdigest()
+
+        return os.path.join(self.path, 'entries', key[:2], key)
+
+    # -----------------------------------------------------------
+
+    def _get_object_path(self, key):
+        if not key or not _HEX_DIGITS.issuperset(key):
+            raise ErrorArtifactCacheInvalidKey(key)
+
+        return os.path.join(self.path, 'objects', key[:2], key)
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def get_file_key(filename):
+        return binascii.hexlify(file_signature(filename)).decode()
+
+    # -----------------------------------------------------------
+
+    def _add_stored(self, size):
+        self.stored += 1
+        self.stored_size += size
+
+    # -----------------------------------------------------------
+
+    def store_file(self, filename):
+        """
+        Stores content of the file, returns the key of the content
+        """
+        key = self.get_file_key(filename)
+
+        object_path = self._get_object_path(key)
+
+        if os.path.isfile(object_path):
+            _touch(object_path)
+        else:
+            _write_file(object_path, src_file=filename)
+            self._add_stored(os.path.getsize(object_path))
+
+        return key
+
+    # -----------------------------------------------------------
+
+    def store_data(self, key, data):
+        object_path = self._get_object_path(key)
+
+        if os.path.isfile(object_path):
+            _touch(object_path)
+        else:
+            _write_file(object_path, data=data)
+            self._add_stored(len(data))
+
+    # -----------------------------------------------------------
+
+    def restore_file(self, key, filename):
+        """
+        Writes the content of the key into the file.
+        Returns False if the content is not cached.
+        """
+        object_path = self._get_object_path(key)
+
+        if not os.path.isfile(object_path):
+            return False
+
+        _write_file(filename, src_file=object_path)
+        _touch(object_path)
+
+        return True
+
+    # -----------------------------------------------------------
+
+    def _encode_entity(self, entity):
+        kind = _ENTITY_KINDS.get(type(entity), None)
+        if kind is None:
+            raise _NotCacheable()
+
+        signature = entity.signature
+
+        if isinstance(entity, FileEntityBase):
+            name = self._get_file_name(entity.name)
+            data = getattr(entity, 'offset', None)
+
+        else:
+            name = entity.name
+            if name == signature:
+                name = None
+            elif not is_string(name):
+                raise _NotCacheable()
+
+            data = None
+            if kind == 'value':
+                data = entity.data
+                if not is_string(data):
+                    raise _NotCacheable()
+
+        return (kind, name, _encode_signature(signature),
+                sorted(entity.tags), data)
+
+    # -----------------------------------------------------------
+
+    def _decode_entity(self, value):
+        kind, name, signature, tags, data = value
+
+        entity_type = _ENTITY_TYPES[kind]
+        signature = _decode_signature(signature)
+        tags = tags or None
+
+        if kind == 'value':
+            return entity_type(data, name, signature, tags)
+
+        if kind == 'signature':
+            return entity_type(signature, name, tags)
+
+        name = self._get_root_path(name)
+
+        if kind == 'part':
+            return entity_type(name, signature, tags, offset=data)
+
+        return entity_type(name, signature, tags)
+
+    # -----------------------------------------------------------
+
+    def _store(self, node_entity):
+
+        entry_path = self._get_entry_path(node_entity)
+        if entry_path is None:
+            return
+
+        targets = node_entity.target_entities
+        itargets = node_entity.itarget_entities
+
+        files = []
+
+        for entity in itertools.chain(targets, itargets):
+            if isinstance(entity, FileEntityBase):
+                # contents of directories are unknown
+                if isinstance(entity, DirEntity):
+                    return
+
+                filename = entity.get()
+
+                # only targets inside the root can be restored elsewhere
+                relpath = self._get_relpath(filename)
+                if relpath is None:
+                    return
+
+                files.append((relpath, self.store_file(filename)))
+
+        encode = self._encode_entity
+
+        try:
+            record = {
+                'targets': [encode(entity) for entity in targets],
+                'itargets': [encode(entity) for entity in itargets],
+                'ideps': [encode(entity)
+                          for entity in node_entity.idep_entities],
+                'build_time': node_entity.build_time,
+                'files': files,
+            }
+        except _NotCacheable:
+            return
+
+        data = json.dumps(record, sort_keys=True).encode('utf-8')
+
+        _write_file(entry_path, data=data)
+
+        self._add_stored(len(data))
+
+    # -----------------------------------------------------------
+
+    def store(self, node_entity):
+        if not node_entity.signature:
+            return
+
+        try:
+            self._store(node_entity)
+        except Exception as ex:
+            event_artifact_cache_failed(self.path, ex)
+
+    # -----------------------------------------------------------
+
+    def _restore(self, node_entity):
+
+        entry_path = self._get_entry_path(node_entity)
+        if entry_path is None:
+            return False
+
+        try:
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+        except (OSError, IOError):
+            return False
+
+        record = json.loads(data.decode('utf-8'))
+
+        decode = self._decode_entity
+
+        ideps = [decode(value) for value in record['ideps']]
+
+        for entity in ideps:
+            if not entity.is_actual():
+                return False
+
+        targets = [decode(value) for value in record['targets']]
+        itargets = [decode(value) for value in record['itargets']]
+
+        for relpath, key in record['files']:
+            if not self.restore_file(key, self._get_target_path(relpath)):
+                return False
+
+        _touch(entry_path)
+
+        node_entity.target_entities = [entity.get_actual()
+                                       for entity in targets]
+        node_entity.itarget_entities = [entity.get_actual()
+                                        for entity in itargets]
+        node_entity.idep_entities = ideps
+        node_entity.build_time = record['build_time']
+
+        return True
+
+    # -----------------------------------------------------------
+
+    def restore(self, node_entity):
+        """
+        Restores targets of the node entity.
+        Returns False if the node entity is not cached.
+        """
+        if not node_entity.signature:
+            return False
+
+        try:
+            restored = self._restore(node_entity)
+        except Exception as ex:
+            event_artifact_cache_failed(self.path, ex)
+            restored = False
+
+        if restored:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return restored
+
+    # -----------------------------------------------------------
+
+    def _get_files(self):
+        files = []
+        for folder in ('entries', 'objects'):
+            for root, folders, names in os.walk(os.path.join(self.path,
+                                                             folder)):
+                for name in names:
+                    filename = os.path.join(root, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+
+                    files.append((stat.st_mtime, stat.st_size, filename))
+
+        return files
+
+    # -----------------------------------------------------------
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.path, _SIZE_FILE), 'rb') as f:
+                return int(f.read())
+        except (OSError, IOError, ValueError):
+            return None
+
+    # -----------------------------------------------------------
+
+    def _write_size(self, size):
+        _write_file(os.path.join(self.path, _SIZE_FILE),
+                    data=str(size).encode())
+
+    # -----------------------------------------------------------
+
+    def evict(self):
+        """
+        Removes least recently used files until the cache fits its size.
+        The whole cache is scanned only when its indexed size exceeds
+        the maximum size.
+        """
+        max_size = self.max_size
+        if not max_size:
+            return
+
+        stored_size = self.stored_size
+        self.stored_size = 0
+
+        size = self._read_size()
+        if size is not None:
+            size += stored_size
+            if size <= max_size:
+                self._write_size(size)
+                return
+
+        files = self._get_files()
+
+        size = sum(file_size for mtime, file_size, filename in files)
+
+        if size > max_size:
+            files.sort()
+
+            for mtime, file_size, filename in files:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+
+                size -= file_size
+                if size <= max_size:
+                    break
+
+        self._write_size(size)
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        if self.stored:
+            self.stored = 0
+            try:
+                self.evict()
+            except Exception as ex:
+                event_artifact_cache_failed(self.path, ex)
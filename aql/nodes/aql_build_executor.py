@@ -0,0 +1,828 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import hmac
+import shutil
+import pickle
+import socket
+import hashlib
+import tempfile
+import threading
+import itertools
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # python 2
+
+from aql.utils import event_status, event_warning, log_info, log_warning,\
+    read_bin_file, write_bin_file, get_signature_algorithm,\
+    send_message, recv_message, parse_socket_address
+from aql.entity import FileEntityBase, DirEntity
+
+from .aql_node import _build_node_entities
+from .aql_artifact_cache import ArtifactCache
+
+__all__ = (
+    'ProcessExecutor', 'RemoteExecutor', 'BuildWorker',
+    'ErrorBuildWorkerUnavailable', 'ErrorBuildWorkerFailed',
+    'ErrorBuildWorkerNoSecret', 'ErrorBuildWorkerAuthenticationFailed',
+)
+
+# ==============================================================================
+
+# The worker greets a client by a random challenge.
+# The client replies by HMAC of the challenge with the shared secret
+# and its own challenge. The worker accepts the client by HMAC
+# of the client's challenge and the number of its jobs.
+# Nothing is unpickled until both sides are authenticated.
+#
+# The client sends a build request with keys of contents of input files,
+# the worker restores input files into a sandbox directory of the job,
+# asks contents of missing input files, builds the node
+# and replies by built targets with keys of contents of target files.
+# The client asks contents of target files which differ from local files.
+_HELLO = 1
+_BUILD = 2
+_NEED_FILES = 3
+_FILES = 4
+_RESULT = 5
+_ERROR = 6
+_GET_FILES = 7
+_AUTH = 8
+_WELCOME = 9
+
+_NONCE_SIZE = 32
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+# the worker removes least recently used input files
+# after storing of this number of new files
+_EVICT_STORED_FILES = 256
+
+
+# ==============================================================================
+@event_status
+def event_build_worker_started(settings, address, jobs):
+    log_info("Build worker is listening on '%s', jobs: %s", address, jobs)
+
+
+# ==============================================================================
+@event_warning
+def event_build_worker_unavailable(settings, address, error):
+    log_warning("Build worker '%s' is not available: %s", address, error)
+
+
+# ==============================================================================
+@event_warning
+def event_build_worker_failed(settings, error):
+    log_warning("Build worker connection failed: %s", error)
+
+
+# ==============================================================================
+class ErrorBuildWorkerUnavailable(Exception):
+
+    def __init__(self, address):
+        msg = "Build worker '%s' is not available" % (address,)
+        super(ErrorBuildWorkerUnavailable, self).__init__(msg)
+
+
+class ErrorBuildWorkerFailed(Exception):
+
+    def __init__(self, error):
+        msg = "Build worker failed: %s" % (error,)
+        super(ErrorBuildWorkerFailed, self).__init__(msg)
+
+
+class ErrorBuildWorkerNoSecret(Exception):
+
+    def __init__(self, address):
+        msg = "Build worker '%s' requires a shared secret" % (address,)
+        super(ErrorBuildWorkerNoSecret, self).__init__(msg)
+
+
+class ErrorBuildWorkerAuthenticationFailed(Exception):
+
+    def __init__(self, address):
+        msg = "Authentication of build worker '%s' failed" % (address,)
+        super(ErrorBuildWorkerAuthenticationFailed, self).__init__(msg)
+
+
+# ==============================================================================
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+_loads = pickle.loads
+
+
+# ==============================================================================
+def _get_digest(secret, role, nonce):
+    return hmac.new(secret, role + nonce, hashlib.sha256).digest()
+
+
+def _check_digest(digest, secret, role, nonce):
+    return hmac.compare_digest(digest, _get_digest(secret, role, nonce))
+
+
+# ==============================================================================
+def _get_sandbox_path(sandbox, path):
+    """
+    Maps an absolute path of a client into the sandbox directory.
+    """
+    path = os.path.splitdrive(path)[1]
+    path = os.path.normpath(os.path.join(os.path.sep, path))
+
+    return os.path.join(sandbox, path.lstrip(os.path.sep))
+
+
+def _get_client_path(sandbox, path):
+    prefix = os.path.join(sandbox, '')
+    if not path.startswith(prefix):
+        return path
+
+    return os.path.sep + path[len(prefix):]
+
+
+# ==============================================================================
+def _map_entity(entity, map_path, sandbox):
+    if not isinstance(entity, FileEntityBase):
+        return entity
+
+    args = list(entity.__getnewargs__())
+    args[0] = map_path(sandbox, entity.get())
+
+    return type(entity)(*args)
+
+
+def _map_entities(entities, map_path, sandbox, mapped):
+    result = []
+    for entity in entities:
+        try:
+            mapped_entity = mapped[id(entity)]
+        except KeyError:
+            mapped_entity = _map_entity(entity, map_path, sandbox)
+            mapped[id(entity)] = mapped_entity
+
+        result.append(mapped_entity)
+
+    return result
+
+
+# ==============================================================================
+def _remove_dir(path):
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# ==============================================================================
+def _get_file_keys(filenames):
+    keys = []
+    for filename in filenames:
+        try:
+            key = ArtifactCache.get_file_key(filename)
+        except (OSError, IOError):
+            key = None
+
+        keys.append((filename, key))
+
+    return keys
+
+
+# ==============================================================================
+def _get_target_files(results):
+    for targets, itargets, ideps in results:
+        for entity in itertools.chain(targets, itargets):
+            if isinstance(entity, FileEntityBase) and \
+               not isinstance(entity, DirEntity):
+                yield entity.get()
+
+
+# ==============================================================================
+def _write_file(filename, data):
+    dir_name = os.path.dirname(filename)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    write_bin_file(filename, data)
+
+
+# ==============================================================================
+class ProcessExecutor (object):
+    """
+    Builds nodes in local worker processes
+    """
+
+    __slots__ = ('pool',)
+
+    def __init__(self, jobs=None):
+        self.pool = multiprocessing.Pool(jobs or None)
+
+    # -----------------------------------------------------------
+
+    def build(self, builder, source_entities, source_groups, input_files,
+              signature_algorithm=None):
+
+        if signature_algorithm is None:
+            signature_algorithm = get_signature_algorithm()
+
+        return self.pool.apply(_build_node_entities,
+                               (builder, source_entities, source_groups,
+                                signature_algorithm))
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        pool = self.pool
+        if pool is not None:
+            self.pool = None
+            pool.terminate()
+            pool.join()
+
+
+# ==============================================================================
+class RemoteExecutor (object):
+    """
+    Builds nodes by build workers connected via TCP or Unix domain sockets.
+    Input files are sent to workers unless they have the same contents.
+    Only builders with SANDBOX_SAFE are sent, because implicit
+    dependencies of other builders (e.g. included headers)
+    are not known before the build and are missing in the sandbox.
+    """
+
+    __slots__ = ('jobs', 'slots', 'idle_conns', 'failed', 'lock', 'secret')
+
+    def __init__(self, addresses, secret=None):
+        self.jobs = 0
+        self.secret = secret or b''
+        self.slots = queue.Queue()
+        self.idle_conns = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+
+        for address in addresses:
+            try:
+                conn, jobs = self._connect(address)
+            except Exception as ex:
+                event_build_worker_unavailable(address, ex)
+                continue
+
+            self.idle_conns[address] = [conn]
+            self.jobs += jobs
+
+            # each job of a worker is served by a separate connection
+            for i in range(jobs):
+                self.slots.put(address)
+
+    # -----------------------------------------------------------
+
+    def _authenticate(self, conn, address):
+        kind, nonce = recv_message(conn)
+        if kind != _HELLO:
+            raise ErrorBuildWorkerUnavailable(address)
+
+        secret = self.secret
+        client_nonce = os.urandom(_NONCE_SIZE)
+
+        send_message(conn, _AUTH,
+                     _get_digest(secret, b'client', nonce) + client_nonce)
+
+        kind, data = recv_message(conn)
+        if kind != _WELCOME:
+            raise ErrorBuildWorkerAuthenticationFailed(address)
+
+        digest, jobs = data[:_DIGEST_SIZE], data[_DIGEST_SIZE:]
+        if not _check_digest(digest, secret, b'worker', client_nonce):
+            raise ErrorBuildWorkerAuthenticationFailed(address)
+
+        return int(jobs)
+
+    # -----------------------------------------------------------
+
+    def _connect(self, address):
+        family, sock_address = parse_socket_address(address)
+        if family is None:
+            raise ErrorBuildWorkerUnavailable(address)
+
+        conn = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            conn.connect(sock_address)
+            jobs = self._authenticate(conn, address)
+
+        except Exception:
+            conn.close()
+            raise
+
+        if family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return conn, jobs
+
+    # -----------------------------------------------------------
+
+    def _acquire(self):
+        """
+        Returns an address and a connection of a free job of a worker
+        or (None, None) if all workers failed
+        """
+        while True:
+            address = self.slots.get()
+            if address is None:
+                # the mark is kept for other waiting threads
+                self.slots.put(None)
+                return None, None
+
+            with self.lock:
+                is_failed = address in self.failed
+                conns = self.idle_conns.get(address)
+                conn = conns.pop() if conns else None
+
+            if is_failed:
+                self._drop_slot()
+                continue
+
+            if conn is not None:
+                return address, conn
+
+            try:
+                return address, self._connect(address)[0]
+            except Exception as ex:
+                self._fail(address, ex)
+
+    # -----------------------------------------------------------
+
+    def _drop_slot(self):
+        with self.lock:
+            self.jobs -= 1
+            no_jobs = not self.jobs
+
+        if no_jobs:
+            # wake up threads waiting for a job
+            self.slots.put(None)
+
+    # -----------------------------------------------------------
+
+    def _fail(self, address, error):
+        """
+        Stops using jobs of a failed worker,
+        their nodes are built locally
+        """
+        with self.lock:
+            is_failed = address in self.failed
+            self.failed.add(address)
+            conns = self.idle_conns.pop(address, ())
+
+        if not is_failed:
+            event_build_worker_unavailable(address, error)
+
+        for conn in conns:
+            conn.close()
+
+        self._drop_slot()
+
+    # -----------------------------------------------------------
+
+    def _release(self, address, conn):
+        if conn is not None:
+            with self.lock:
+                self.idle_conns.setdefault(address, []).append(conn)
+
+        self.slots.put(address)
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _send_files(conn, keys, inputs):
+        filenames = dict((key, filename) for filename, key in inputs)
+
+        files = [(key, read_bin_file(filenames[key])) for key in keys]
+
+        send_message(conn, _FILES, _dumps(files))
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _fetch_files(conn, address, outputs):
+        """
+        Receives target files which differ from local files.
+        Returns True if any file is received.
+        """
+        missing = {}
+        for filename, local_key in _get_file_keys(outputs):
+            key = outputs[filename]
+            if local_key != key:
+                missing.setdefault(key, []).append(filename)
+
+        if not missing:
+            return False
+
+        send_message(conn, _GET_FILES, _dumps(list(missing)))
+
+        kind, data = recv_message(conn)
+        if kind != _FILES:
+            raise ErrorBuildWorkerUnavailable(address)
+
+        for key, content in _loads(data):
+            for filename in missing[key]:
+                _write_file(filename, content)
+
+        return True
+
+    # -----------------------------------------------------------
+
+    def _build(self, conn, address, request, inputs):
+
+        send_message(conn, _BUILD, request)
+
+        while True:
+            kind, data = recv_message(conn)
+
+            if kind == _NEED_FILES:
+                self._send_files(conn, _loads(data), inputs)
+
+            elif kind == _RESULT:
+                output, build_time, results, outputs = _loads(data)
+
+                if self._fetch_files(conn, address, outputs):
+                    # signatures of received files may differ
+                    results = tuple(
+                        ([entity.get_actual() for entity in targets],
+                         [entity.get_actual() for entity in itargets],
+                         ideps)
+                        for targets, itargets, ideps in results)
+
+                return (output, build_time, results), None
+
+            elif kind == _ERROR:
+                return None, _loads(data)
+
+            else:
+                raise ErrorBuildWorkerUnavailable(address)
+
+    # -----------------------------------------------------------
+
+    def build(self, builder, source_entities, source_groups, input_files):
+        """
+        Returns None if the node can't be sent to workers
+        or workers failed, then the node is built locally
+        """
+        if not builder.SANDBOX_SAFE:
+            return None
+
+        inputs = [(filename, key)
+                  for filename, key in _get_file_keys(input_files)
+                  if key is not None]
+
+        try:
+            request = _dumps((get_signature_algorithm(), builder,
+                              source_entities, source_groups, inputs))
+        except Exception:
+            # the builder can't be sent, so it's built locally
+            return None
+
+        address, conn = self._acquire()
+        if conn is None:
+            return None
+
+        try:
+            result, error = self._build(conn, address, request, inputs)
+        except (socket.error, ErrorBuildWorkerUnavailable) as ex:
+            conn.close()
+            self._fail(address, ex)
+            return None
+
+        except Exception:
+            conn.close()
+            self._release(address, None)
+            raise
+
+        self._release(address, conn)
+
+        if error is not None:
+            raise error
+
+        return result
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        with self.lock:
+            idle_conns = self.idle_conns
+            self.idle_conns = {}
+
+        for conns in idle_conns.values():
+            for conn in conns:
+                conn.close()
+
+
+# ==============================================================================
+class BuildWorker (object):
+    """
+    Serves build requests of remote executors.
+    Builder classes must be loadable by the worker,
+    so the worker should load the same tools as clients.
+    Clients are authenticated by the shared secret,
+    it's required for TCP sockets.
+    """
+
+    __slots__ = ('address', 'jobs', 'executor', 'cache', 'sock', 'lock',
+                 'secret')
+
+    def __init__(self, address, jobs=None, cache_dir=None, cache_size=None,
+                 secret=None):
+
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'aql-worker-cache')
+
+        self.secret = secret or b''
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.cache = ArtifactCache(cache_dir, cache_size)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.executor = None
+
+        family, sock_address = parse_socket_address(address)
+        if family is None:
+            raise ErrorBuildWorkerUnavailable(address)
+
+        if (family == socket.AF_INET) and not self.secret:
+            raise ErrorBuildWorkerNoSecret(address)
+
+        sock = self._listen(family, sock_address)
+
+        if family == socket.AF_INET:
+            address = "%s:%s" % sock.getsockname()[:2]
+
+        self.address = address
+        self.sock = sock
+        self.executor = ProcessExecutor(self.jobs)
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _listen(family, sock_address):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(sock_address)
+            else:
+                if os.path.exists(sock_address):
+                    os.remove(sock_address)
+
+                # only the owner is allowed to connect
+                umask = os.umask(0o177)
+                try:
+                    sock.bind(sock_address)
+                finally:
+                    os.umask(umask)
+
+            sock.listen(16)
+
+        except Exception:
+            sock.close()
+            raise
+
+        return sock
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    # -----------------------------------------------------------
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        sock = self.sock
+        if sock is not None:
+            self.sock = None
+
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            sock.close()
+
+            if parse_socket_address(self.address)[0] != socket.AF_INET:
+                try:
+                    os.remove(self.address)
+                except OSError:
+                    pass
+
+        executor = self.executor
+        if executor is not None:
+            self.executor = None
+            executor.close()
+
+        self.cache.close()
+
+    # -----------------------------------------------------------
+
+    def serve(self):
+        event_build_worker_started(self.address, self.jobs)
+
+        while True:
+            sock = self.sock
+            if sock is None:
+                return
+
+            try:
+                conn, client_address = sock.accept()
+            except socket.error:
+                if self.sock is None:
+                    return
+                raise
+
+            thread = threading.Thread(target=self._serve_connection,
+                                      args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    # -----------------------------------------------------------
+
+    def _authenticate(self, conn):
+        secret = self.secret
+        nonce = os.urandom(_NONCE_SIZE)
+
+        send_message(conn, _HELLO, nonce)
+
+        kind, data = recv_message(conn)
+
+        digest, client_nonce = data[:_DIGEST_SIZE], data[_DIGEST_SIZE:]
+
+        if (kind != _AUTH) or (len(client_nonce) != _NONCE_SIZE) or \
+           not _check_digest(digest, secret, b'client', nonce):
+            raise ErrorBuildWorkerAuthenticationFailed(self.address)
+
+        send_message(conn, _WELCOME,
+                     _get_digest(secret, b'worker', client_nonce) +
+                     str(self.jobs).encode())
+
+    # -----------------------------------------------------------
+
+    def _serve_connection(self, conn):
+
+        outputs = {}
+        sandbox = None
+
+        try:
+            self._authenticate(conn)
+
+            while True:
+                kind, data = recv_message(conn)
+
+                if kind == _BUILD:
+                    # each job is built in its own sandbox directory
+                    _remove_dir(sandbox)
+                    sandbox = os.path.normcase(
+                        tempfile.mkdtemp(prefix='aql-job-'))
+
+                    outputs = self._build(conn, data, sandbox)
+
+                elif kind == _GET_FILES:
+                    files = [(key, read_bin_file(outputs[key]))
+                             for key in _loads(data)]
+
+                    send_message(conn, _FILES, _dumps(files))
+
+                else:
+                    break
+
+        except Exception as ex:
+            if self.sock is not None:
+                event_build_worker_failed(ex)
+        finally:
+            conn.close()
+            _remove_dir(sandbox)
+
+    # -----------------------------------------------------------
+
+    def _restore_inputs(self, conn, inputs, sandbox):
+        cache = self.cache
+
+        inputs = [(_get_sandbox_path(sandbox, filename), key)
+                  for filename, key in inputs]
+
+        missing = [(filename, key)
+                   for filename, key in inputs
+                   if not cache.restore_file(key, filename)]
+
+        if not missing:
+            return
+
+        send_message(conn, _NEED_FILES,
+                     _dumps(list(set(key for filename, key in missing))))
+
+        kind, data = recv_message(conn)
+        if kind != _FILES:
+            raise ErrorBuildWorkerUnavailable(self.address)
+
+        for key, content in _loads(data):
+            cache.store_data(key, content)
+
+        for filename, key in missing:
+            cache.restore_file(key, filename)
+
+        if cache.stored >= _EVICT_STORED_FILES:
+            with self.lock:
+                cache.close()
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _map_to_sandbox(sandbox, builder, source_entities, source_groups):
+
+        for attr in ('build_dir', 'build_path'):
+            path = getattr(builder, attr, None)
+            if path:
+                setattr(builder, attr, _get_sandbox_path(sandbox, path))
+
+        mapped = {}
+
+        source_entities = _map_entities(source_entities, _get_sandbox_path,
+                                        sandbox, mapped)
+
+        source_groups = [_map_entities(group, _get_sandbox_path,
+                                       sandbox, mapped)
+                         for group in source_groups]
+
+        return source_entities, source_groups
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _map_from_sandbox(sandbox, results):
+        mapped = {}
+
+        return tuple(
+            tuple(_map_entities(entities, _get_client_path, sandbox, mapped)
+                  for entities in result)
+            for result in results)
+
+    # -----------------------------------------------------------
+
+    def _build(self, conn, data, sandbox):
+
+        try:
+            # classes of the builder may be unknown to the worker
+            algorithm, builder, source_entities, source_groups, inputs = \
+                _loads(data)
+
+            self._restore_inputs(conn, inputs, sandbox)
+
+            source_entities, source_groups = self._map_to_sandbox(
+                sandbox, builder, source_entities, source_groups)
+
+            output, build_time, results = self.executor.build(
+                builder, source_entities, source_groups, (),
+                signature_algorithm=algorithm)
+
+        except Exception as ex:
+            try:
+                error = _dumps(ex)
+            except Exception:
+                error = _dumps(ErrorBuildWorkerFailed(ex))
+
+            send_message(conn, _ERROR, error)
+            return {}
+
+        target_files = list(_get_target_files(results))
+
+        outputs = dict((filename, key)
+                       for filename, key in _get_file_keys(target_files)
+                       if key is not None)
+
+        results = self._map_from_sandbox(sandbox, results)
+
+        send_message(conn, _RESULT,
+                     _dumps((output, build_time, results,
+                             dict((_get_client_path(sandbox, filename), key)
+                                  for filename, key in outputs.items()))))
+
+        return dict((key, filename) for filename, key in outputs.items())
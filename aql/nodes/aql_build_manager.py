@@ -24,15 +24,23 @@ import os.path
 import operator
 import itertools
 
-from aql.util_types import to_sequence
+from multiprocessing.pool import ThreadPool
+from array import array
+
+from aql.util_types import to_sequence, is_string
 from aql.utils import simplify_value, event_status, event_warning, event_error,\
-    log_info, log_error, log_warning, TaskManager
-from aql.entity import EntitiesFile
+    log_info, log_error, log_warning, TaskManager,\
+    open_file_stat_cache, close_file_stat_cache,\
+    trace_span, trace_async_begin, trace_async_end
+from aql.entity import EntitiesFile, FileEntityBase, prefetch_signatures,\
+    reset_shared_file_entities
 
 from .aql_node import Node, NodeFilter
+from .aql_artifact_cache import ArtifactCache
+from .aql_build_executor import ProcessExecutor, RemoteExecutor
 
 __all__ = (
-    'BuildManager',
+    'BuildManager', 'close_kept_db_files',
     'ErrorNodeDependencyCyclic', 'ErrorNodeDependencyUnknown',
 )
 
@@ -82,6 +90,22 @@ def event_node_building_failed(settings, node, error):
     pass
 
 
+# ==============================================================================
+@event_status
+def event_node_restored(settings, node, progress):
+    msg = node.get_build_str(settings.brief)
+    log_info("(%s) Restored from cache: %s", progress, msg)
+
+
+# ==============================================================================
+@event_status
+def event_artifact_cache_stats(settings, hits, misses):
+    total = hits + misses
+    if total:
+        log_info("Artifact cache hits: %s of %s (%.1f%%)",
+                 hits, total, hits * 100.0 / total)
+
+
 # ==============================================================================
 @event_status
 def event_node_removed(settings, node, progress):
@@ -157,103 +181,348 @@ class InternalErrorRemoveUnknownTailNode(Exception):
 
 # ==============================================================================
 class _NodesTree (object):
+    """
+    Graph of nodes.
+    Nodes are mapped to dense integer ids and edges are stored in arrays.
+    Each edge is linked to the list of dependencies of its node and
+    to the list of dependent nodes of its dependency.
+    Nodes are kept in a topological order which is updated incrementally
+    (Pearce-Kelly algorithm) to detect cyclic dependencies.
+    """
 
     __slots__ = (
-        'node2deps',
-        'dep2nodes',
-        'tail_nodes',
+        'node2id',
+        'nodes',
+        'num_nodes',
+        'dep_counts',
+        'deps_heads',
+        'nodes_heads',
+        'edge_nodes',
+        'edge_deps',
+        'next_node_edges',
+        'next_dep_edges',
+        'tail_ids',
+        'paths',
+        'orders',
     )
 
     # -----------------------------------------------------------
 
     def __init__(self):
-        self.node2deps = {}
-        self.dep2nodes = {}
-        self.tail_nodes = set()
+        self.node2id = {}
+        self.nodes = []     # id -> node, None for removed nodes
+        self.num_nodes = 0
+
+        self.dep_counts = array('i')    # number of not removed dependencies
+        self.deps_heads = array('i')    # first edge of dependencies
+        self.nodes_heads = array('i')   # first edge of dependent nodes
+
+        self.edge_nodes = array('i')
+        self.edge_deps = array('i')
+        self.next_node_edges = array('i')
+        self.next_dep_edges = array('i')
+
+        self.tail_ids = set()
+
+        self.paths = array('d')     # critical paths, negative if unknown
+
+        # dependencies have lower orders than dependent nodes
+        self.orders = array('i')
 
     # -----------------------------------------------------------
 
     def __len__(self):
-        return len(self.node2deps)
+        return self.num_nodes
 
     def get_nodes(self):
-        return frozenset(self.node2deps)
+        return frozenset(self.node2id)
+
+    # -----------------------------------------------------------
+
+    def __add_node(self, node):
+        node_id = len(self.nodes)
+
+        self.node2id[node] = node_id
+        self.nodes.append(node)
+        self.num_nodes += 1
+
+        self.dep_counts.append(0)
+        self.deps_heads.append(-1)
+        self.nodes_heads.append(-1)
+        self.paths.append(-1.0)
+        self.orders.append(node_id)
+
+        self.tail_ids.add(node_id)
+
+    # -----------------------------------------------------------
+
+    def __add_edge(self, node_id, dep_id):
+        edge = len(self.edge_nodes)
+
+        self.edge_nodes.append(node_id)
+        self.edge_deps.append(dep_id)
+
+        self.next_node_edges.append(self.deps_heads[node_id])
+        self.deps_heads[node_id] = edge
+
+        self.next_dep_edges.append(self.nodes_heads[dep_id])
+        self.nodes_heads[dep_id] = edge
+
+    # -----------------------------------------------------------
+
+    def _get_dep_ids(self, node_id):
+        nodes = self.nodes
+        edge_deps = self.edge_deps
+        next_edges = self.next_node_edges
+
+        dep_ids = []
+        edge = self.deps_heads[node_id]
+        while edge != -1:
+            dep_id = edge_deps[edge]
+            if nodes[dep_id] is not None:
+                dep_ids.append(dep_id)
+
+            edge = next_edges[edge]
+
+        return dep_ids
 
     # -----------------------------------------------------------
 
-    def __has_cycle(self, node, new_deps):
+    def _get_node_ids(self, dep_id):
+        nodes = self.nodes
+        edge_nodes = self.edge_nodes
+        next_edges = self.next_dep_edges
+
+        node_ids = []
+        edge = self.nodes_heads[dep_id]
+        while edge != -1:
+            node_id = edge_nodes[edge]
+            if nodes[node_id] is not None:
+                node_ids.append(node_id)
+
+            edge = next_edges[edge]
+
+        return node_ids
+
+    # -----------------------------------------------------------
+
+    def __search_nodes(self, node_id, upper_order):
+        # dependent nodes affected by a new dependency of the node
+        # returns None if the dependency creates a cycle
+
+        orders = self.orders
+        get_node_ids = self._get_node_ids
 
-        if node in new_deps:
+        visited = set((node_id,))
+        node_ids = [node_id]
+        stack = [node_id]
+
+        while stack:
+            for dep_node_id in get_node_ids(stack.pop()):
+                order = orders[dep_node_id]
+                if order == upper_order:
+                    return None
+
+                if (order < upper_order) and (dep_node_id not in visited):
+                    visited.add(dep_node_id)
+                    node_ids.append(dep_node_id)
+                    stack.append(dep_node_id)
+
+        return node_ids
+
+    # -----------------------------------------------------------
+
+    def __search_deps(self, dep_id, lower_order):
+        # dependencies affected by a new dependent node of the dependency
+
+        orders = self.orders
+        get_dep_ids = self._get_dep_ids
+
+        visited = set((dep_id,))
+        dep_ids = [dep_id]
+        stack = [dep_id]
+
+        while stack:
+            for dep_dep_id in get_dep_ids(stack.pop()):
+                if (orders[dep_dep_id] > lower_order) and \
+                   (dep_dep_id not in visited):
+                    visited.add(dep_dep_id)
+                    dep_ids.append(dep_dep_id)
+                    stack.append(dep_dep_id)
+
+        return dep_ids
+
+    # -----------------------------------------------------------
+
+    def __reorder(self, node_id, dep_id):
+        # Pearce-Kelly: update the order to place the dependency
+        # before the node, returns False if the dependency creates a cycle
+
+        orders = self.orders
+
+        lower_order = orders[node_id]
+        upper_order = orders[dep_id]
+
+        if upper_order < lower_order:
             return True
 
-        deps = set(new_deps)
-        node2deps = self.node2deps
+        node_ids = self.__search_nodes(node_id, upper_order)
+        if node_ids is None:
+            return False
 
-        while deps:
-            dep = deps.pop()
+        dep_ids = self.__search_deps(dep_id, lower_order)
 
-            dep_deps = node2deps[dep]
+        get_order = orders.__getitem__
 
-            if node in dep_deps:
-                return True
+        dep_ids.sort(key=get_order)
+        node_ids.sort(key=get_order)
 
-            deps |= dep_deps
+        ids = dep_ids + node_ids
+        new_orders = sorted(map(get_order, ids))
 
-        return False
+        for node_id, order in zip(ids, new_orders):
+            orders[node_id] = order
+
+        return True
 
     # -----------------------------------------------------------
 
     def _depends(self, node, deps):
 
-        node2deps = self.node2deps
-        dep2nodes = self.dep2nodes
+        node2id = self.node2id
 
         try:
-            current_node_deps = node2deps[node]
+            node_id = node2id[node]
+            new_dep_ids = set(node2id[dep]
+                              for dep in deps if not dep.is_built())
 
-            deps = set(dep for dep in deps if not dep.is_built())
-            new_deps = deps - current_node_deps
+        except KeyError as dep_node:
+            raise ErrorNodeDependencyUnknown(node, dep_node.args[0])
 
-            if not new_deps:
-                return
+        new_dep_ids.difference_update(self._get_dep_ids(node_id))
 
-            if self.__has_cycle(node, new_deps):
+        if not new_dep_ids:
+            return
+
+        reorder = self.__reorder
+
+        for dep_id in new_dep_ids:
+            if (dep_id == node_id) or not reorder(node_id, dep_id):
+                nodes = self.nodes
+                new_deps = [nodes[dep_id] for dep_id in new_dep_ids]
                 raise ErrorNodeDependencyCyclic(node, new_deps)
 
-            self.tail_nodes.discard(node)
+        self.tail_ids.discard(node_id)
 
-            # -----------------------------------------------------------
+        add_edge = self.__add_edge
+        for dep_id in new_dep_ids:
+            add_edge(node_id, dep_id)
 
-            current_node_deps.update(new_deps)
+        self.dep_counts[node_id] += len(new_dep_ids)
 
-            # -----------------------------------------------------------
+        self.__reset_critical_paths(new_dep_ids)
 
-            for dep in new_deps:
-                dep2nodes[dep].add(node)
+    # -----------------------------------------------------------
 
-        except KeyError as dep_node:
-            raise ErrorNodeDependencyUnknown(node, dep_node.args[0])
+    def __reset_critical_paths(self, dep_ids):
+        # critical paths of the nodes and all their dependencies are changed
+
+        paths = self.paths
+        get_dep_ids = self._get_dep_ids
+
+        dep_ids = list(dep_ids)
+        while dep_ids:
+            dep_id = dep_ids.pop()
+            if paths[dep_id] >= 0:
+                paths[dep_id] = -1.0
+                dep_ids.extend(get_dep_ids(dep_id))
+
+    # -----------------------------------------------------------
+
+    def reset_critical_paths(self):
+        self.paths = array('d', [-1.0]) * len(self.nodes)
+
+    # -----------------------------------------------------------
+
+    def get_critical_path(self, node, get_build_time):
+        """
+        Returns estimated build time of the longest chain of nodes
+        starting from the node
+        """
+
+        node_id = self.node2id[node]
+
+        paths = self.paths
+        path = paths[node_id]
+        if path >= 0:
+            return path
+
+        nodes = self.nodes
+        get_node_ids = self._get_node_ids
+
+        stack = [node_id]
+        while stack:
+            top = stack[-1]
+            if paths[top] >= 0:
+                stack.pop()
+                continue
+
+            path = 0
+            pending = False
+            for dep_node_id in get_node_ids(top):
+                dep_path = paths[dep_node_id]
+                if dep_path < 0:
+                    stack.append(dep_node_id)
+                    pending = True
+
+                elif path < dep_path:
+                    path = dep_path
+
+            if pending:
+                continue
+
+            stack.pop()
+
+            paths[top] = path + get_build_time(nodes[top])
+
+        return paths[node_id]
 
     # -----------------------------------------------------------
 
     def add(self, nodes):
-        for node in nodes:
-            if node not in self.node2deps:
-                self.node2deps[node] = set()
-                self.dep2nodes[node] = set()
-                self.tail_nodes.add(node)
+        node2id = self.node2id
+        add_node = self.__add_node
+
+        new_nodes = {}
+        new_nodes_list = []
+
+        # nodes are added after their dependencies (post-order),
+        # so initial order of nodes is usually topological already
+        stack = list(nodes)
+        while stack:
+            node = stack[-1]
+            if node in node2id:
+                stack.pop()
+                continue
 
+            if node not in new_nodes:
                 node_srcnodes = node.get_source_nodes()
                 node_depnodes = node.get_dep_nodes()
 
-                # recursively add sources and depends
-                self.add(node_srcnodes)
-                # TODO: It would be better
-                # to rewrite this code to avoid the recursion
-                self.add(node_depnodes)
+                new_nodes[node] = (node_srcnodes, node_depnodes)
+
+                stack.extend(node_srcnodes)
+                stack.extend(node_depnodes)
+                continue
+
+            stack.pop()
+            add_node(node)
+            new_nodes_list.append(node)
 
-                self._depends(node, node_srcnodes)
-                self._depends(node, node_depnodes)
+        for node in new_nodes_list:
+            node_srcnodes, node_depnodes = new_nodes[node]
+            self._depends(node, node_srcnodes)
+            self._depends(node, node_depnodes)
 
     # -----------------------------------------------------------
 
@@ -264,101 +533,150 @@ class _NodesTree (object):
     # -----------------------------------------------------------
 
     def remove_tail(self, node):
-        node2deps = self.node2deps
+        node2id = self.node2id
 
         try:
-            deps = node2deps.pop(node)
-            if deps:
-                raise InternalErrorRemoveNonTailNode(node)
+            node_id = node2id[node]
         except KeyError as ex:
             raise InternalErrorRemoveUnknownTailNode(ex.args[0])
 
-        tail_nodes = self.tail_nodes
+        dep_counts = self.dep_counts
+        if dep_counts[node_id]:
+            raise InternalErrorRemoveNonTailNode(node)
 
-        for dep in self.dep2nodes.pop(node):
-            d = node2deps[dep]
-            d.remove(node)
-            if not d:
-                tail_nodes.add(dep)
+        del node2id[node]
+        self.nodes[node_id] = None
+        self.num_nodes -= 1
+
+        tail_ids = self.tail_ids
+        tail_ids.discard(node_id)
+
+        for dep_node_id in self._get_node_ids(node_id):
+            count = dep_counts[dep_node_id] - 1
+            dep_counts[dep_node_id] = count
+            if not count:
+                tail_ids.add(dep_node_id)
 
     # -----------------------------------------------------------
 
     def filter_unknown_deps(self, deps):
-        return [dep for dep in deps if dep in self.node2deps]
+        return [dep for dep in deps if dep in self.node2id]
 
     # -----------------------------------------------------------
 
     def pop_tails(self):
-        tails = self.tail_nodes
-        self.tail_nodes = set()
-        return tails
+        tail_ids = self.tail_ids
+        self.tail_ids = set()
+
+        nodes = self.nodes
+        return set(nodes[node_id] for node_id in tail_ids)
 
     # -----------------------------------------------------------
 
     def __get_all_nodes(self, nodes):
-        nodes = set(nodes)
-        all_nodes = set(nodes)
+        node2id = self.node2id
 
-        node2deps = self.node2deps
-        while nodes:
-            node = nodes.pop()
+        try:
+            node_ids = [node2id[node] for node in nodes]
+        except KeyError as node:
+            raise ErrorNodeUnknown(node.args[0])
 
-            try:
-                deps = node2deps[node] - all_nodes
-            except KeyError as node:
-                raise ErrorNodeUnknown(node.args[0])
+        all_ids = bytearray(len(self.nodes))
+        for node_id in node_ids:
+            all_ids[node_id] = 1
 
-            all_nodes.update(deps)
-            nodes.update(deps)
+        get_dep_ids = self._get_dep_ids
 
-        return all_nodes
+        while node_ids:
+            for dep_id in get_dep_ids(node_ids.pop()):
+                if not all_ids[dep_id]:
+                    all_ids[dep_id] = 1
+                    node_ids.append(dep_id)
+
+        return all_ids
 
     # -----------------------------------------------------------
 
     def shrink_to(self, nodes):
 
-        node2deps = self.node2deps
-        dep2nodes = self.dep2nodes
+        all_ids = self.__get_all_nodes(nodes)
 
-        ignore_nodes = set(node2deps) - self.__get_all_nodes(nodes)
+        node2id = self.node2id
+        nodes = self.nodes
 
-        self.tail_nodes -= ignore_nodes
+        for node_id, node in enumerate(nodes):
+            if (node is not None) and not all_ids[node_id]:
+                del node2id[node]
+                nodes[node_id] = None
+                self.num_nodes -= 1
 
-        for node in ignore_nodes:
-            del node2deps[node]
-            del dep2nodes[node]
+        self.tail_ids = set(node_id for node_id in self.tail_ids
+                            if all_ids[node_id])
 
-        for dep_nodes in dep2nodes.values():
-            dep_nodes.difference_update(ignore_nodes)
+        self.reset_critical_paths()
 
     # -----------------------------------------------------------
 
-    def self_test(self):
-        if set(self.node2deps) != set(self.dep2nodes):
-            raise AssertionError("Not all deps are added")
+    def self_test(self):    # noqa
+        nodes = self.nodes
+        node2id = self.node2id
 
-        all_dep_nodes = set()
+        if len(node2id) != self.num_nodes:
+            raise AssertionError("Invalid number of nodes")
 
-        for node in self.dep2nodes:
-            if node not in self.node2deps:
-                raise AssertionError("Missed node: %s" % (node,))
+        for node, node_id in node2id.items():
+            if nodes[node_id] is not node:
+                raise AssertionError("Invalid node id: %s" % (node,))
+
+        for node_id in self.tail_ids:
+            if nodes[node_id] is None:
+                raise AssertionError("Removed tail node: %s" % (node_id,))
 
-            node_deps = self.node2deps[node]
+        for node_id, node in enumerate(nodes):
+            if node is None:
+                continue
+
+            dep_ids = self._get_dep_ids(node_id)
+            if len(dep_ids) != self.dep_counts[node_id]:
+                raise AssertionError(
+                    "Invalid number of dependencies: %s" % (node,))
 
-            if node_deps:
-                if node in self.tail_nodes:
+            if dep_ids:
+                if node_id in self.tail_ids:
                     raise AssertionError("Invalid tail node: %s" % (node,))
 
-            all_dep_nodes |= node_deps
+                if len(set(dep_ids)) != len(dep_ids):
+                    raise AssertionError("Duplicate dependencies: %s" %
+                                         (node,))
 
-            for dep in node_deps:
-                if node not in self.dep2nodes[dep]:
+            for dep_id in dep_ids:
+                if node_id not in self._get_node_ids(dep_id):
                     raise AssertionError(
-                        "node not in self.dep2nodes[dep]: "
-                        "dep: %s, node: %s" % (dep, node))
+                        "node not in dependent nodes of dep: "
+                        "dep: %s, node: %s" % (nodes[dep_id], node))
+
+                if self.orders[dep_id] >= self.orders[node_id]:
+                    raise AssertionError(
+                        "Invalid order of dep: %s, node: %s" %
+                        (nodes[dep_id], node))
+
+
+# ==============================================================================
+
+# DB files kept open between builds by a long living process:
+# filename -> ((use_sqlite, use_log_db, use_codec), EntitiesFile)
+_KEPT_VFILES = {}
+
+
+def close_kept_db_files():
+    """
+    Closes DB files kept open by builds with keep_db_open option
+    """
+    kept_vfiles = list(_KEPT_VFILES.values())
+    _KEPT_VFILES.clear()
 
-        if all_dep_nodes - set(self.dep2nodes):
-            raise AssertionError("Not all deps are added")
+    for db_options, vfile in kept_vfiles:
+        vfile.close()
 
 
 # ==============================================================================
@@ -367,16 +685,25 @@ class _VFiles(object):
         'names',
         'handles',
         'use_sqlite',
+        'use_log_db',
+        'use_codec',
         'force_lock',
+        'db_file',
+        'keep_open',
     )
 
     # -----------------------------------------------------------
 
-    def __init__(self, use_sqlite=False, force_lock=False):
+    def __init__(self, use_sqlite=False, use_log_db=False, force_lock=False,
+                 db_file=None, keep_open=False, use_codec=False):
         self.handles = {}
         self.names = {}
         self.use_sqlite = use_sqlite
+        self.use_log_db = use_log_db
+        self.use_codec = use_codec
         self.force_lock = force_lock
+        self.db_file = db_file
+        self.keep_open = keep_open
 
     # -----------------------------------------------------------
 
@@ -385,9 +712,83 @@ class _VFiles(object):
 
     # -----------------------------------------------------------
 
+    def _pop_kept(self, vfilename):
+        try:
+            db_options, vfile = _KEPT_VFILES.pop(vfilename)
+        except KeyError:
+            return None
+
+        if self.keep_open and (db_options == self._get_db_options()):
+            return vfile
+
+        # the file is locked by the kept handle
+        vfile.close()
+        return None
+
+    # -----------------------------------------------------------
+
+    def _get_db_options(self):
+        return self.use_sqlite, self.use_log_db, self.use_codec
+
+    # -----------------------------------------------------------
+
+    def _open(self, vfilename):
+        try:
+            return self.handles[vfilename]
+
+        except KeyError:
+            vfile = self._pop_kept(vfilename)
+            if vfile is None:
+                vfile = EntitiesFile(vfilename,
+                                     use_sqlite=self.use_sqlite,
+                                     use_log_db=self.use_log_db,
+                                     force=self.force_lock,
+                                     use_codec=self.use_codec)
+
+            self.handles[vfilename] = vfile
+
+            return vfile
+
+    # -----------------------------------------------------------
+
+    def _migrate(self, vfile, vfilename):
+        """
+        Moves entities of a build directory DB into the project DB
+        """
+
+        if not os.path.isfile(vfilename):
+            return
+
+        kept_vfile = self._pop_kept(vfilename)
+        if kept_vfile is not None:
+            kept_vfile.close()
+
+        try:
+            with EntitiesFile(vfilename,
+                              use_sqlite=self.use_sqlite,
+                              use_log_db=self.use_log_db,
+                              force=self.force_lock,
+                              use_codec=self.use_codec) as build_dir_vfile:
+
+                vfile.import_entities(build_dir_vfile)
+
+        except Exception as ex:
+            log_warning("Unable to migrate DB '%s': %s", vfilename, ex)
+            return
+
+        # index files of DataFile and LogDataFile
+        for filename in (vfilename, vfilename + '.index', vfilename + '.idx'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    # -----------------------------------------------------------
+
     def __getitem__(self, builder):
 
         builder_name = builder.name
+        db_file = self.db_file
 
         try:
             vfilename = self.names[builder_name]
@@ -395,21 +796,27 @@ class _VFiles(object):
             vfilename = os.path.join(builder.get_build_dir(), '.aql.db')
             self.names[builder_name] = vfilename
 
-        try:
-            return self.handles[vfilename]
+            if (db_file is not None) and (vfilename != db_file):
+                self._migrate(self._open(db_file), vfilename)
 
-        except KeyError:
-            vfile = EntitiesFile(
-                vfilename, use_sqlite=self.use_sqlite, force=self.force_lock)
-            self.handles[vfilename] = vfile
+        if db_file is not None:
+            return self._open(db_file)
 
-            return vfile
+        return self._open(vfilename)
 
     # -----------------------------------------------------------
 
     def close(self):
-        for vfile in self.handles.values():
-            vfile.close()
+        with trace_span('Closing DB files', 'db'):
+            if self.keep_open:
+                db_options = self._get_db_options()
+
+                for vfilename, vfile in self.handles.items():
+                    vfile.flush()
+                    _KEPT_VFILES[vfilename] = (db_options, vfile)
+            else:
+                for vfile in self.handles.values():
+                    vfile.close()
 
         self.handles.clear()
         self.names.clear()
@@ -426,11 +833,17 @@ class _VFiles(object):
 
 
 # ==============================================================================
-def _build_node(node):
+def _build_node(node, executor=None):
+
+    trace_async_end(id(node), node.get_build_str, 'queue')
 
     event_node_building(node)
 
-    out = node.build()
+    with trace_span(node.get_build_str, 'build'):
+        if executor is None:
+            out = node.build()
+        else:
+            out = node.build_in_process(executor)
 
     if out:
         try:
@@ -441,6 +854,19 @@ def _build_node(node):
     return out
 
 
+# ==============================================================================
+def _check_node(args):
+
+    node, vfile, explain = args
+
+    split_nodes = node.build_split(vfile, explain)
+    if split_nodes:
+        return split_nodes, False
+
+    with trace_span(node.get_build_str, 'check'):
+        return None, node.check_actual(vfile, explain)
+
+
 # ==============================================================================
 def _get_module_nodes(node, module_cache, node_cache):
     try:
@@ -637,19 +1063,44 @@ class _NodesBuilder (object):
         'build_manager',
         'task_manager',
         'building_nodes',
+        'finished_names',
         'expensive_nodes',
+        'process_nodes',
+        'process_executor',
+        'remote_executor',
+        'check_pool',
+        'jobs',
+        'artifact_cache',
+        'recorded_entities',
     )
 
     # -----------------------------------------------------------
 
     def __init__(self, build_manager,
                  jobs=0, keep_going=False, with_backtrace=True,
-                 use_sqlite=False, force_lock=False):
-
-        self.vfiles = _VFiles(use_sqlite=use_sqlite, force_lock=force_lock)
+                 use_sqlite=False, use_log_db=False, force_lock=False,
+                 db_file=None, keep_db_open=False,
+                 cache_dir=None, cache_size=None, cache_root=None,
+                 build_workers=None, build_secret=None, use_codec=False):
+
+        self.vfiles = _VFiles(use_sqlite=use_sqlite, use_log_db=use_log_db,
+                              force_lock=force_lock, db_file=db_file,
+                              keep_open=keep_db_open, use_codec=use_codec)
         self.building_nodes = {}
+        self.finished_names = set()
         self.expensive_nodes = set(build_manager._expensive_nodes)
+        self.process_nodes = set(build_manager._process_nodes)
+        self.process_executor = None
+        self.check_pool = None
+        self.jobs = jobs
         self.build_manager = build_manager
+        self.recorded_entities = {}
+
+        if cache_dir:
+            self.artifact_cache = ArtifactCache(cache_dir, cache_size,
+                                                cache_root)
+        else:
+            self.artifact_cache = None
 
         tm = TaskManager()
 
@@ -662,6 +1113,17 @@ class _NodesBuilder (object):
         if not with_backtrace:
             tm.disable_backtrace()
 
+        remote_executor = None
+        if build_workers:
+            remote_executor = RemoteExecutor(build_workers, build_secret)
+            if remote_executor.jobs:
+                # threads wait for remote jobs
+                jobs += remote_executor.jobs
+            else:
+                remote_executor = None
+
+        self.remote_executor = remote_executor
+
         tm.start(jobs)
 
         self.task_manager = tm
@@ -726,19 +1188,119 @@ class _NodesBuilder (object):
 
     # -----------------------------------------------------------
 
+    def _get_executor(self, node):
+        is_process = (node in self.process_nodes) or \
+            node.builder.is_process_build()
+
+        is_expensive = node in self.expensive_nodes
+
+        remote_executor = self.remote_executor
+        if (remote_executor is not None) and (is_process or is_expensive) \
+           and node.builder.SANDBOX_SAFE:
+            return remote_executor
+
+        if not is_process:
+            return None
+
+        process_executor = self.process_executor
+        if process_executor is None:
+            self.process_executor = process_executor = ProcessExecutor(
+                self.jobs)
+
+        return process_executor
+
+    # -----------------------------------------------------------
+
     def add_build_task(self, node):
-        if node in self.expensive_nodes:
-            self.task_manager.add_expensive_task(node, _build_node, node)
+        executor = self._get_executor(node)
+
+        is_remote = (executor is not None) and \
+            (executor is self.remote_executor)
+
+        # time spent by the node in the queue of building tasks
+        trace_async_begin(id(node), node.get_build_str, 'queue')
+
+        # remote workers build expensive nodes along with other nodes
+        if (node in self.expensive_nodes) and not is_remote:
+            self.task_manager.add_expensive_task(node, _build_node,
+                                                 node, executor)
         else:
-            task_priority = -node.get_weight()  # less is higher
-            self.task_manager.add_task(task_priority, node, _build_node, node)
+            # less is higher, the longest chain of nodes goes first
+            critical_path = self.build_manager.get_critical_path(node)
+            task_priority = (-critical_path, -node.get_weight())
+            self.task_manager.add_task(task_priority, node, _build_node,
+                                       node, executor)
+
+    # -----------------------------------------------------------
+
+    def _find_recorded_entities(self, node):
+        recorded_entities = self.recorded_entities
+        try:
+            return recorded_entities[node]
+        except KeyError:
+            pass
+
+        # guard against recursion through the same node
+        recorded_entities[node] = None
+
+        try:
+            node_entities = node.find_recorded_entities(
+                self.vfiles, self._find_recorded_targets)
+        except Exception:
+            # the recorded build time is only a hint for scheduling
+            node_entities = None
+
+        recorded_entities[node] = node_entities
+        return node_entities
+
+    # -----------------------------------------------------------
+
+    def _find_recorded_targets(self, node):
+        target_entities = getattr(node, 'target_entities', None)
+        if target_entities is not None:
+            return target_entities
+
+        node_entities = self._find_recorded_entities(node)
+        if node_entities is None:
+            return None
+
+        targets = []
+        for node_entity in node_entities:
+            if node_entity.target_entities is None:
+                return None
+
+            targets += node_entity.target_entities
+
+        return targets
 
     # -----------------------------------------------------------
 
-    def build_node(self, node):
+    def find_recorded_build_time(self, node):
+        """
+        Returns the build duration of a node which is not checked yet
+        recorded by the previous build or None if unknown
+        """
+        if node.is_built():
+            return None
+
+        node_entities = self._find_recorded_entities(node)
+        if not node_entities:
+            return None
+
+        build_times = [node_entity.build_time
+                       for node_entity in node_entities
+                       if node_entity.build_time is not None]
+
+        if not build_times:
+            return None
+
+        return sum(build_times)
+
+    # -----------------------------------------------------------
+
+    def _prebuild_node(self, node, check_nodes):
 
         build_manager = self.build_manager
-        explain = build_manager.explain
 
         if not build_manager.lock_node(node):
             return False
@@ -756,39 +1318,172 @@ class _NodesBuilder (object):
             build_manager.depends(node, prebuit_nodes)
             return True
 
-        split_nodes = node.build_split(vfile, explain)
-        if split_nodes:
+        check_nodes.append((node, vfile, build_manager.explain))
+        return False
 
-            if node in self.expensive_nodes:
-                self.expensive_nodes.update(split_nodes)
+    # -----------------------------------------------------------
 
-            build_manager.depends(node, split_nodes)
+    def _get_check_pool(self):
+        if self.jobs < 2:
+            return None
 
-            # split nodes are not actual, check them for building conflicts
-            for split_node in split_nodes:
-                self._add_building_node(split_node)
+        check_pool = self.check_pool
+        if check_pool is None:
+            self.check_pool = check_pool = ThreadPool(self.jobs)
 
+        return check_pool
+
+    # -----------------------------------------------------------
+
+    def _prefetch_signatures(self, check_nodes):
+        """
+        Calculates signatures of source and dependency files
+        of all checking nodes at once.
+        """
+
+        entities = []
+
+        for node, vfile, explain in check_nodes:
+            if not node.split_called:
+                entities += node.source_entities
+                entities += node.dep_entities
+
+        hits, misses = prefetch_signatures(entities, self._get_check_pool())
+
+        build_manager = self.build_manager
+        build_manager.signature_hits += hits
+        build_manager.signature_misses += misses
+
+    # -----------------------------------------------------------
+
+    def _check_nodes(self, check_nodes):
+        """
+        Checks whether nodes are up to date.
+        Many nodes are checked in parallel threads.
+        """
+
+        self._prefetch_signatures(check_nodes)
+
+        check_pool = self._get_check_pool()
+
+        if (check_pool is None) or (len(check_nodes) < 2):
+            return list(map(_check_node, check_nodes))
+
+        chunk_size = max(1, len(check_nodes) // (self.jobs * 4))
+
+        return check_pool.map(_check_node, check_nodes, chunk_size)
+
+    # -----------------------------------------------------------
+
+    def _build_checked_node(self, node, split_nodes, actual):
+
+        build_manager = self.build_manager
+
+        if split_nodes:
+            self._add_split_nodes(node, split_nodes)
             return True
 
-        if node.check_actual(vfile, explain):
+        if actual or self._recheck_finished_node(node):
             build_manager.actual_node(node)
             return True
 
         if not self._add_building_node(node):
             return False
 
+        if self._restore_node(node):
+            return True
+
         self.add_build_task(node)
 
         return False
 
     # -----------------------------------------------------------
 
+    def _add_split_nodes(self, node, split_nodes):
+
+        if node in self.expensive_nodes:
+            self.expensive_nodes.update(split_nodes)
+
+        if node in self.process_nodes:
+            self.process_nodes.update(split_nodes)
+
+        self.build_manager.depends(node, split_nodes)
+
+        # split nodes are not actual, check them for building conflicts
+        for split_node in split_nodes:
+            if self._is_finished(split_node):
+                # it will be checked again before building
+                split_node.recheck_actual()
+            else:
+                self._add_building_node(split_node)
+
+    # -----------------------------------------------------------
+
+    def _is_finished(self, node):
+        """
+        Returns True if a node with the same names was built
+        after the node was checked
+        """
+        finished_names = self.finished_names
+        if not finished_names:
+            return False
+
+        return not finished_names.isdisjoint(node.get_names())
+
+    # -----------------------------------------------------------
+
+    def _recheck_finished_node(self, node):
+        if not self._is_finished(node):
+            return False
+
+        node.recheck_actual()
+        return node.check_actual(self.vfiles[node.builder],
+                                 self.build_manager.explain)
+
+    # -----------------------------------------------------------
+
+    def _restore_node(self, node):
+        artifact_cache = self.artifact_cache
+        if artifact_cache is None:
+            return False
+
+        if not node.restore(artifact_cache):
+            return False
+
+        self._remove_building_node(node)
+
+        with trace_span(node.get_build_str, 'db'):
+            node.save(self.vfiles[node.builder])
+
+        self.build_manager.restored_node(node)
+
+        return True
+
+    # -----------------------------------------------------------
+
     def build(self, nodes):
 
         node_tree_changed = False
 
-        for node in nodes:
-            if self.build_node(node):
+        # names of nodes built while other nodes are checked
+        self.finished_names.clear()
+
+        check_nodes = []
+
+        with trace_span('Prebuilding nodes', 'graph',
+                        {'nodes': len(nodes)}):
+            for node in nodes:
+                if self._prebuild_node(node, check_nodes):
+                    node_tree_changed = True
+
+        with trace_span('Checking nodes', 'graph',
+                        {'nodes': len(check_nodes)}):
+            results = self._check_nodes(check_nodes)
+
+        for check_args, (split_nodes, actual) in zip(check_nodes, results):
+            node = check_args[0]
+
+            if self._build_checked_node(node, split_nodes, actual):
                 node_tree_changed = True
 
             if len(self.building_nodes) > 10:
@@ -816,7 +1511,14 @@ class _NodesBuilder (object):
             vfile = vfiles[node.builder]
 
             if error is None:
-                node.save(vfile)
+                self.finished_names.update(node.get_names())
+
+                with trace_span(node.get_build_str, 'db'):
+                    node.save(vfile)
+
+                if self.artifact_cache is not None:
+                    node.store(self.artifact_cache)
+
                 build_manager.completed_node(node, task.result)
             else:
                 node.save_failed(vfile)
@@ -862,6 +1564,31 @@ class _NodesBuilder (object):
         finally:
             self.vfiles.close()
 
+            artifact_cache = self.artifact_cache
+            if artifact_cache is not None:
+                self.artifact_cache = None
+                artifact_cache.close()
+
+                build_manager = self.build_manager
+                build_manager.cache_hits += artifact_cache.hits
+                build_manager.cache_misses += artifact_cache.misses
+
+            process_executor = self.process_executor
+            if process_executor is not None:
+                self.process_executor = None
+                process_executor.close()
+
+            remote_executor = self.remote_executor
+            if remote_executor is not None:
+                self.remote_executor = None
+                remote_executor.close()
+
+            check_pool = self.check_pool
+            if check_pool is not None:
+                self.check_pool = None
+                check_pool.close()
+                check_pool.join()
+
 
 # ==============================================================================
 class _NodeCondition (object):
@@ -907,10 +1634,22 @@ class BuildManager (object):
         '_node_cache',
         '_node_conditions',
         '_expensive_nodes',
+        '_process_nodes',
+        '_node_build_times',
+        '_build_time_total',
+        '_build_time_count',
+        '_default_build_time',
+        '_find_recorded_build_time',
         'completed',
         'actual',
         'skipped',
+        'signature_hits',
+        'signature_misses',
+        'cache_hits',
+        'cache_misses',
         'explain',
+        '_used_files',
+        '_built_files',
     )
 
     # -----------------------------------------------------------
@@ -920,21 +1659,34 @@ class BuildManager (object):
         self._node_locker = None
         self._node_conditions = {}
         self._expensive_nodes = set()
+        self._process_nodes = set()
+        self._node_build_times = {}
         self.__reset()
 
     # -----------------------------------------------------------
 
-    def __reset(self, explain=False):
+    def __reset(self, explain=False, used_files=None, built_files=None):
 
         self._built_targets = {}
         self._failed_nodes = {}
         self._module_cache = {}
         self._node_cache = {}
 
+        self._build_time_total = 0
+        self._build_time_count = 0
+        self._default_build_time = 0
+        self._find_recorded_build_time = None
+
         self.completed = 0
         self.actual = 0
         self.skipped = 0
+        self.signature_hits = 0
+        self.signature_misses = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.explain = explain
+        self._used_files = used_files
+        self._built_files = built_files
 
     # -----------------------------------------------------------
 
@@ -978,6 +1730,63 @@ class BuildManager (object):
 
     # -----------------------------------------------------------
 
+    def process_build(self, nodes):
+        self._process_nodes.update(to_sequence(nodes))
+
+    # -----------------------------------------------------------
+
+    def priority(self, nodes, build_time):
+        """
+        Sets estimated build time of nodes which have not been built yet
+        """
+        set_build_time = self._node_build_times.__setitem__
+        for node in to_sequence(nodes):
+            set_build_time(node, build_time)
+
+    # -----------------------------------------------------------
+
+    def _get_node_build_time(self, node):
+        build_time = node.get_build_time()
+        if build_time is None:
+            # the node has not been checked yet
+            find_build_time = self._find_recorded_build_time
+            if find_build_time is not None:
+                build_time = find_build_time(node)
+
+            if build_time is None:
+                build_time = self._node_build_times.get(node, None)
+                if build_time is None:
+                    build_time = self._default_build_time
+
+        return build_time
+
+    # -----------------------------------------------------------
+
+    def __add_build_time(self, node):
+        build_time = node.get_build_time()
+        if build_time is None:
+            return
+
+        self._build_time_total += build_time
+        self._build_time_count += 1
+
+        average = self._build_time_total / self._build_time_count
+        default_build_time = self._default_build_time
+
+        # recalculate critical paths only on significant changes
+        if (average > default_build_time * 1.25) or \
+           (average < default_build_time * 0.8):
+
+            self._default_build_time = average
+            self._nodes.reset_critical_paths()
+
+    # -----------------------------------------------------------
+
+    def get_critical_path(self, node):
+        return self._nodes.get_critical_path(node, self._get_node_build_time)
+
+    # -----------------------------------------------------------
+
     def module_depends(self, node, deps):
         module_cache = self._module_cache
         node_cache = self._node_cache
@@ -1066,11 +1875,48 @@ class BuildManager (object):
 
     # -----------------------------------------------------------
 
+    def _add_used_files(self, node):
+        used_files = self._used_files
+        if used_files is None:
+            return
+
+        sources = getattr(node, 'sources', None)
+        if sources:
+            # the node has not been initiated yet
+            cwd = node.cwd
+            for src in sources:
+                if isinstance(src, FileEntityBase):
+                    used_files.add(src.get())
+                elif is_string(src):
+                    used_files.add(os.path.join(cwd, src))
+
+        for attr in ('source_entities', 'dep_entities', 'idep_entities'):
+            entities = getattr(node, attr, None)
+            if entities:
+                used_files.update(entity.get() for entity in entities
+                                  if isinstance(entity, FileEntityBase))
+
+    # -----------------------------------------------------------
+
+    def _add_built_files(self, node):
+        built_files = self._built_files
+        if built_files is None:
+            return
+
+        for entities in (node.target_entities, node.itarget_entities):
+            built_files.update(entity.get() for entity in entities
+                               if isinstance(entity, FileEntityBase))
+
+    # -----------------------------------------------------------
+
     def actual_node(self, node):
         self.unlock_node(node)
         self._nodes.remove_tail(node)
         self.actual += 1
 
+        self.__add_build_time(node)
+        self._add_used_files(node)
+
         node.shrink()
 
     # -----------------------------------------------------------
@@ -1082,9 +1928,13 @@ class BuildManager (object):
 
         self.completed += 1
 
+        self.__add_build_time(node)
+
         event_node_building_finished(node, builder_output,
                                      self.get_progress_str())
 
+        self._add_used_files(node)
+        self._add_built_files(node)
         node.shrink()
 
     # -----------------------------------------------------------
@@ -1092,11 +1942,27 @@ class BuildManager (object):
     def failed_node(self, node, error):
         self.unlock_node(node)
         self._failed_nodes[node] = error
+        self._add_used_files(node)
 
         event_node_building_failed(node, error)
 
     # -----------------------------------------------------------
 
+    def restored_node(self, node):
+        self._check_already_built(node)
+        self.unlock_node(node)
+        self._nodes.remove_tail(node)
+
+        self.completed += 1
+
+        event_node_restored(node, self.get_progress_str())
+
+        self._add_used_files(node)
+        self._add_built_files(node)
+        node.shrink()
+
+    # -----------------------------------------------------------
+
     def removed_node(self, node):
         self._nodes.remove_tail(node)
         self.completed += 1
@@ -1122,6 +1988,7 @@ class BuildManager (object):
         self._nodes = _NodesTree()
         self._node_locker = None
         self._node_conditions = {}
+        self._node_build_times = {}
 
     # -----------------------------------------------------------
 
@@ -1154,27 +2021,65 @@ class BuildManager (object):
     # -----------------------------------------------------------
 
     def build(self, jobs, keep_going, nodes=None, explain=False,
-              with_backtrace=True, use_sqlite=False, force_lock=False):
+              with_backtrace=True, use_sqlite=False, use_log_db=False,
+              force_lock=False, stat_cache_file=None, db_file=None,
+              keep_db_open=False, used_files=None, built_files=None,
+              cache_dir=None, cache_size=None, cache_root=None,
+              build_workers=None, build_secret=None, use_codec=False):
 
-        self.__reset(explain=explain)
+        self.__reset(explain=explain, used_files=used_files,
+                     built_files=built_files)
 
-        self.shrink(nodes)
+        with trace_span('Selecting nodes', 'graph'):
+            self.shrink(nodes)
 
-        with _NodesBuilder(self,
-                           jobs,
-                           keep_going,
-                           with_backtrace,
-                           use_sqlite=use_sqlite,
-                           force_lock=force_lock) as nodes_builder:
-            while True:
-                tails = self.get_next_nodes()
+        if stat_cache_file:
+            open_file_stat_cache(stat_cache_file)
 
-                if not tails and not nodes_builder.is_building():
-                    break
+        try:
+            with _NodesBuilder(self,
+                               jobs,
+                               keep_going,
+                               with_backtrace,
+                               use_sqlite=use_sqlite,
+                               use_log_db=use_log_db,
+                               force_lock=force_lock,
+                               db_file=db_file,
+                               keep_db_open=keep_db_open,
+                               cache_dir=cache_dir,
+                               cache_size=cache_size,
+                               cache_root=cache_root,
+                               build_workers=build_workers,
+                               build_secret=build_secret,
+                               use_codec=use_codec) as nodes_builder:
+
+                self._find_recorded_build_time = \
+                    nodes_builder.find_recorded_build_time
+
+                while True:
+                    tails = self.get_next_nodes()
+
+                    if not tails and not nodes_builder.is_building():
+                        break
+
+                    if not nodes_builder.build(tails):
+                        # no more processing threads
+                        break
+
+            if used_files is not None:
+                # files of nodes which were not built because of errors
+                for node in self.get_nodes():
+                    self._add_used_files(node)
+        finally:
+            self._find_recorded_build_time = None
 
-                if not nodes_builder.build(tails):
-                    # no more processing threads
-                    break
+            reset_shared_file_entities()
+
+            if stat_cache_file:
+                close_file_stat_cache()
+
+        if cache_dir:
+            event_artifact_cache_stats(self.cache_hits, self.cache_misses)
 
         return self.is_ok()
 
@@ -1201,10 +2106,16 @@ class BuildManager (object):
         log_info("Skipped nodes: %s", self.skipped)
         log_info("Completed nodes: %s", self.completed)
         log_info("Actual nodes: %s", self.actual)
+        log_info("Prefetched file signatures: %s, already known: %s",
+                 self.signature_misses, self.signature_hits)
+        log_info("Artifact cache hits: %s, misses: %s",
+                 self.cache_hits, self.cache_misses)
 
     # -----------------------------------------------------------
 
-    def clear(self, nodes=None, use_sqlite=False, force_lock=False):
+    def clear(self, nodes=None, use_sqlite=False, use_log_db=False,
+              force_lock=False, db_file=None, keep_db_open=False,
+              use_codec=False):
 
         self.__reset()
 
@@ -1212,7 +2123,11 @@ class BuildManager (object):
 
         with _NodesBuilder(self,
                            use_sqlite=use_sqlite,
-                           force_lock=force_lock) as nodes_builder:
+                           use_log_db=use_log_db,
+                           force_lock=force_lock,
+                           db_file=db_file,
+                           keep_db_open=keep_db_open,
+                           use_codec=use_codec) as nodes_builder:
             while True:
 
                 tails = self.get_next_nodes()
@@ -24,7 +24,7 @@ import os
 import errno
 import operator
 
-from aql.util_types import FilePath, to_sequence, to_string
+from aql.util_types import FilePath, to_sequence, to_string, abs_path
 from aql.utils import simple_object_signature, simplify_value, execute_command,\
     event_debug, log_debug, group_paths_by_dir, group_items, relative_join,\
     relative_join_list
@@ -214,6 +214,11 @@ def _get_file_signature_type(file_signature_type):
     return FileChecksumEntity
 
 
+# ==============================================================================
+def _new_builder(cls):
+    return object.__new__(cls)
+
+
 # ==============================================================================
 class BuilderInitiator(object):
 
@@ -304,6 +309,12 @@ class Builder (object):
     NAME_ATTRS = None
     SIGNATURE_ATTRS = None
 
+    # Builders which read only files of their sources and dependencies
+    # and have no other paths in attributes except build paths.
+    # Only such builders are sent to remote build workers,
+    # which build them in sandbox directories.
+    SANDBOX_SAFE = False
+
     # -----------------------------------------------------------
 
     def __new__(cls, options, *args, **kw):
@@ -313,6 +324,14 @@ class Builder (object):
 
     # -----------------------------------------------------------
 
+    def __reduce_ex__(self, protocol):
+        # an initiated builder is sent to worker processes,
+        # it must be restored without BuilderInitiator
+        reduce_value = super(Builder, self).__reduce_ex__(2)
+        return (_new_builder, (self.__class__,)) + reduce_value[2:]
+
+    # -----------------------------------------------------------
+
     def _init_attrs(self, options):
         self.build_dir = options.build_dir.get()
         self.build_path = options.build_path.get()
@@ -326,6 +345,8 @@ class Builder (object):
 
         self.env = options.env.get()
 
+        self.__is_process = options.process_build.get()
+
         is_batch = (options.batch_build.get() or not self.can_build()) and \
             self.can_build_batch()
 
@@ -351,6 +372,11 @@ class Builder (object):
 
     # -----------------------------------------------------------
 
+    def is_process_build(self):
+        return self.__is_process
+
+    # -----------------------------------------------------------
+
     def initiate(self):
         return self
 
@@ -566,10 +592,10 @@ class Builder (object):
                                             replace_ext=False)
 
         if target_dir.startswith((os.path.curdir, os.path.pardir)):
-            target_dir = os.path.abspath(target_dir)
+            target_dir = abs_path(target_dir)
         elif not os.path.isabs(target_dir):
-            target_dir = os.path.abspath(os.path.join(self.build_path,
-                                                      target_dir))
+            target_dir = abs_path(os.path.join(self.build_path,
+                                               target_dir))
 
         _make_build_path(target_dir)
 
@@ -594,11 +620,11 @@ class Builder (object):
             name = ''
 
         if target_dir.startswith((os.path.curdir, os.path.pardir)):
-            target_dir = os.path.abspath(target_dir)
+            target_dir = abs_path(target_dir)
 
         elif not os.path.isabs(target_dir):
-            target_dir = os.path.abspath(os.path.join(self.build_path,
-                                                      target_dir))
+            target_dir = abs_path(os.path.join(self.build_path,
+                                               target_dir))
 
         target_dir = os.path.join(target_dir, name)
 
@@ -22,10 +22,13 @@
 
 import os
 import operator
+import itertools
 
-from aql.util_types import to_sequence
-from aql.utils import new_hash, event_status, log_debug, log_info, log_error
-from aql.entity import EntityBase, SimpleEntity, pickleable
+from aql.util_types import to_sequence, get_work_dir
+from aql.utils import new_hash, event_status, log_debug, log_info, log_error,\
+    Chrono, WorkDir, set_signature_algorithm
+from aql.entity import EntityBase, SimpleEntity, FileEntityBase, DirEntity,\
+    pickleable, share_file_entities
 
 __all__ = (
     'Node', 'NodeEntity',
@@ -169,6 +172,60 @@ class NodeRebuildReasonTarget (NodeRebuildReason):
         return "Node's target '%s' has changed." % (self.entity,)
 
 
+# ==============================================================================
+class _DepsHash (object):
+    """
+    Hash of the builder signature and dependencies.
+    It's calculated once and shared by all node entities of a node.
+    """
+
+    __slots__ = (
+        'builder',
+        'dep_entities',
+        'hash_sum',
+    )
+
+    def __init__(self, builder, dep_entities):
+        self.builder = builder
+        self.dep_entities = dep_entities
+        self.hash_sum = NotImplemented
+
+    # -----------------------------------------------------------
+
+    def _get_hash(self):
+
+        builder_signature = self.builder.signature
+        if builder_signature is None:
+            return None
+
+        hash_sum = new_hash(builder_signature)
+
+        for entity in self.dep_entities:
+            ent_sign = entity.signature
+            if not ent_sign:
+                return None
+
+            hash_sum.update(entity.id)
+            hash_sum.update(ent_sign)
+
+        return hash_sum
+
+    # -----------------------------------------------------------
+
+    def get(self):
+        """
+        Returns a new copy of the hash or None if any signature is unknown
+        """
+        hash_sum = self.hash_sum
+        if hash_sum is NotImplemented:
+            self.hash_sum = hash_sum = self._get_hash()
+
+        if hash_sum is None:
+            return None
+
+        return hash_sum.copy()
+
+
 # ==============================================================================
 @pickleable
 class NodeEntity (EntityBase):
@@ -179,12 +236,14 @@ class NodeEntity (EntityBase):
 
         'builder',
         'source_entities',
-        'dep_entities',
+        'deps_hash',
 
         'target_entities',
         'itarget_entities',
         'idep_entities',
         'idep_keys',
+
+        'build_time',
     )
 
     # -----------------------------------------------------------
@@ -195,9 +254,11 @@ class NodeEntity (EntityBase):
                 targets=None,
                 itargets=None,
                 idep_keys=None,
+                build_time=None,
                 builder=None,
                 source_entities=None,
-                dep_entities=None):
+                dep_entities=None,
+                deps_hash=None):
 
         self = super(NodeEntity, cls).__new__(cls, name, signature)
 
@@ -208,7 +269,13 @@ class NodeEntity (EntityBase):
         else:
             self.builder = builder
             self.source_entities = source_entities
-            self.dep_entities = dep_entities
+
+            if deps_hash is None:
+                deps_hash = _DepsHash(builder, dep_entities)
+
+            self.deps_hash = deps_hash
+
+        self.build_time = build_time
 
         return self
 
@@ -224,7 +291,8 @@ class NodeEntity (EntityBase):
                 self.signature,
                 self.target_entities,
                 self.itarget_entities,
-                self.idep_keys)
+                self.idep_keys,
+                self.build_time)
 
     # -----------------------------------------------------------
 
@@ -255,20 +323,10 @@ class NodeEntity (EntityBase):
 
     def get_signature(self):
 
-        builder_signature = self.builder.signature
-        if builder_signature is None:
+        hash_sum = self.deps_hash.get()
+        if hash_sum is None:
             return None
 
-        hash_sum = new_hash(builder_signature)
-
-        for entity in self.dep_entities:
-            ent_sign = entity.signature
-            if not ent_sign:
-                return None
-
-            hash_sum.update(entity.id)
-            hash_sum.update(ent_sign)
-
         for entity in self.source_entities:
             entity_signature = entity.signature
             if entity_signature is None:
@@ -302,9 +360,16 @@ class NodeEntity (EntityBase):
 
     _ACTUAL_IDEPS_CACHE = {}
 
+    @classmethod
+    def reset_actual_ideps(cls):
+        """
+        Forgets checked implicit dependencies of previous builds
+        """
+        cls._ACTUAL_IDEPS_CACHE.clear()
+
     def _get_ideps(self, vfile, idep_keys,
                    ideps_cache_get=_ACTUAL_IDEPS_CACHE.__getitem__,
-                   ideps_cache_set=_ACTUAL_IDEPS_CACHE.__setitem__):
+                   ideps_cache_set=_ACTUAL_IDEPS_CACHE.setdefault):
 
         entities = vfile.find_entities_by_key(idep_keys)
         if entities is None:
@@ -316,8 +381,10 @@ class NodeEntity (EntityBase):
             try:
                 entities[i] = ideps_cache_get(entity_id)
             except KeyError:
-                actual_entity = entity.get_actual()
-                ideps_cache_set(entity_id, actual_entity)
+                # nodes may be checked in several threads,
+                # so the first actual entity wins
+                actual_entity = ideps_cache_set(entity_id,
+                                                entity.get_actual())
 
                 if entity is not actual_entity:
                     vfile.update_entity(actual_entity)
@@ -328,8 +395,8 @@ class NodeEntity (EntityBase):
 
     # -----------------------------------------------------------
 
-    def _save_ideps(self, vfile,
-                    _actual_ideps_cache_set=_ACTUAL_IDEPS_CACHE.setdefault):
+    def _get_actual_ideps(
+            self, _actual_ideps_cache_set=_ACTUAL_IDEPS_CACHE.setdefault):
 
         entities = []
         for entity in self.idep_entities:
@@ -342,10 +409,7 @@ class NodeEntity (EntityBase):
 
             entities.append(cached_entity)
 
-        keys = vfile.add_entities(entities)
-
-        self.idep_entities = entities
-        self.idep_keys = keys
+        return entities
 
     # -----------------------------------------------------------
 
@@ -357,6 +421,9 @@ class NodeEntity (EntityBase):
             if previous is None:
                 raise NodeRebuildReasonNew(self)
 
+            # keep the duration of the previous build for scheduling
+            self.build_time = previous.build_time
+
             if not self.signature:
                 raise NodeRebuildReasonAlways(self)
 
@@ -389,15 +456,15 @@ class NodeEntity (EntityBase):
     # -----------------------------------------------------------
 
     def save(self, vfile):
+        _save_node_entities(vfile, (self,))
+
+    # -----------------------------------------------------------
 
+    def _check_targets(self):
         for entity in self.target_entities:
             if entity.signature is None:
                 raise ErrorUnactualEntity(self, entity)
 
-        self._save_ideps(vfile)
-
-        vfile.add_node_entity(self)
-
     # -----------------------------------------------------------
 
     def clear(self, vfile):
@@ -465,19 +532,77 @@ class NodeEntity (EntityBase):
 
     # -----------------------------------------------------------
 
+    # implicit dependencies are usually shared by many nodes
+
     def add_implicit_deps(self, entities, tags=None):
-        self.idep_entities.extend(
-            self.builder.make_entities(entities, tags))
+        self.idep_entities.extend(share_file_entities(
+            self.builder.make_entities(entities, tags)))
 
     def add_implicit_dep_files(self, entities, tags=None):
-        self.idep_entities.extend(
-            self.builder.make_file_entities(entities, tags))
+        self.idep_entities.extend(share_file_entities(
+            self.builder.make_file_entities(entities, tags)))
 
     def add_implicit_dep_entity(self, entity):
-        self.idep_entities.append(entity)
+        self.idep_entities.extend(share_file_entities((entity,)))
 
     def add_implicit_dep_entities(self, entities):
-        self.idep_entities.extend(entities)
+        self.idep_entities.extend(share_file_entities(entities))
+
+
+# ==============================================================================
+def _make_node_entities(builder, source_entities):
+    if builder.is_batch():
+        groups = source_entities
+    else:
+        groups = builder.split(source_entities)
+        if not groups:
+            groups = [source_entities]
+
+    return [NodeEntity(builder=builder,
+                       source_entities=to_sequence(group),
+                       dep_entities=())
+            for group in groups]
+
+
+# ==============================================================================
+def _save_node_entities(vfile, node_entities):
+    """
+    Saves node entities and their implicit dependencies in two batches.
+    Entities with unactual targets or dependencies are not saved,
+    the first such error is raised after the other entities are saved.
+    """
+
+    error = None
+    actual_entities = []
+    ideps = []
+
+    for node_entity in node_entities:
+        try:
+            node_entity._check_targets()
+            entities = node_entity._get_actual_ideps()
+
+        except ErrorUnactualEntity as ex:
+            if error is None:
+                error = ex
+            continue
+
+        node_entity.idep_entities = entities
+        ideps.extend(entities)
+        actual_entities.append(node_entity)
+
+    if actual_entities:
+        keys = vfile.add_entities(ideps)
+
+        pos = 0
+        for node_entity in actual_entities:
+            next_pos = pos + len(node_entity.idep_entities)
+            node_entity.idep_keys = keys[pos: next_pos]
+            pos = next_pos
+
+        vfile.add_node_entities(actual_entities)
+
+    if error is not None:
+        raise error
 
 
 # ==============================================================================
@@ -602,6 +727,40 @@ class NodeBaseNameFilter(NodeFilter):
                      for entity in entities)
 
 
+# ==============================================================================
+def _build_node_entities(builder, source_entities, source_groups,
+                         signature_algorithm=None):
+    # It's called in a worker process
+
+    # the pool may be started before the algorithm is set
+    if signature_algorithm is not None:
+        set_signature_algorithm(signature_algorithm)
+
+    node_entities = tuple(NodeEntity(builder=builder,
+                                     source_entities=group,
+                                     dep_entities=())
+                          for group in source_groups)
+
+    node = object.__new__(Node)
+    node.builder = builder
+    node.source_entities = source_entities
+    node.node_entities = node_entities
+
+    if builder.is_batch():
+        node.node_entities_map = dict(
+            (node_entity.source_entities[0], node_entity)
+            for node_entity in node_entities)
+
+    output = node.build()
+
+    results = tuple((node_entity.target_entities,
+                     node_entity.itarget_entities,
+                     node_entity.idep_entities)
+                    for node_entity in node_entities)
+
+    return output, node.get_build_time(), results
+
+
 # ==============================================================================
 class Node (object):
 
@@ -638,7 +797,7 @@ class Node (object):
         self.options = getattr(builder, 'options', None)
 
         if cwd is None:
-            self.cwd = os.path.abspath(os.getcwd())
+            self.cwd = get_work_dir()
         else:
             self.cwd = cwd
 
@@ -753,42 +912,45 @@ class Node (object):
 
     # ----------------------------------------------------------
 
-    def initiate(self, chdir=os.chdir):
+    def initiate(self):
         if self.initiated:
             # reinitialize the replaced source entities
             if self.sources:
-                self._set_source_entities()
+                with WorkDir(self.cwd):
+                    self._set_source_entities()
         else:
-            chdir(self.cwd)
+            with WorkDir(self.cwd):
+                self.builder = self.builder.initiate()
+                self._set_source_entities()
 
-            self.builder = self.builder.initiate()
-            self._set_source_entities()
             self._update_dep_entities()
 
             self.initiated = True
 
     # ----------------------------------------------------------
 
-    def build_depends(self, chdir=os.chdir):
+    def build_depends(self):
         if self.depends_called:
             return None
 
         self.depends_called = True
 
-        chdir(self.cwd)
-        nodes = self.builder.depends(self.options, self.source_entities)
+        with WorkDir(self.cwd):
+            nodes = self.builder.depends(self.options, self.source_entities)
+
         return nodes
 
     # ----------------------------------------------------------
 
-    def build_replace(self, chdir=os.chdir):
+    def build_replace(self):
         if self.replace_called:
             return None
 
         self.replace_called = True
 
-        chdir(self.cwd)
-        sources = self.builder.replace(self.options, self.source_entities)
+        with WorkDir(self.cwd):
+            sources = self.builder.replace(self.options,
+                                           self.source_entities)
         if sources is None:
             return None
 
@@ -801,14 +963,14 @@ class Node (object):
 
     def _split_batch(self, vfile, explain):
         builder = self.builder
-        dep_entities = self.dep_entities
+        deps_hash = _DepsHash(builder, self.dep_entities)
         node_entities = []
         not_actual_nodes = {}
         not_actual_sources = []
         for src in self.source_entities:
             node_entity = NodeEntity(builder=builder,
                                      source_entities=(src,),
-                                     dep_entities=dep_entities)
+                                     deps_hash=deps_hash)
 
             if not node_entity.check_actual(vfile, explain):
                 not_actual_nodes[src] = node_entity
@@ -850,7 +1012,6 @@ class Node (object):
         self.check_actual = self._split_actual
 
         builder = self.builder
-        dep_entities = self.dep_entities
 
         if builder.is_batch():
             return self._split_batch(vfile, explain)
@@ -864,7 +1025,7 @@ class Node (object):
         if (not groups) or (len(groups) < 2):
             node_entity = NodeEntity(builder=builder,
                                      source_entities=sources,
-                                     dep_entities=dep_entities)
+                                     dep_entities=self.dep_entities)
 
             if not node_entity.check_actual(vfile, explain):
                 self.check_actual = self._not_actual
@@ -875,6 +1036,8 @@ class Node (object):
         # -----------------------------------------------------------
         # create split Nodes
 
+        deps_hash = _DepsHash(builder, self.dep_entities)
+
         node_entities = []
         split_nodes = []
         for group in groups:
@@ -883,7 +1046,7 @@ class Node (object):
 
             node_entity = NodeEntity(builder=builder,
                                      source_entities=group,
-                                     dep_entities=dep_entities)
+                                     deps_hash=deps_hash)
 
             if not node_entity.check_actual(vfile, explain):
                 node = self._split(group, (node_entity,))
@@ -902,6 +1065,7 @@ class Node (object):
         other = object.__new__(self.__class__)
 
         other.builder = self.builder
+        other.cwd = self.cwd
         other.dep_nodes = ()
         other.sources = ()
         other.source_entities = source_entities
@@ -997,12 +1161,57 @@ class Node (object):
 
         self._reset_targets()
 
-        if builder.is_batch():
-            targets = _NodeBatchTargets(self.node_entities_map)
-            output = builder.build_batch(self.source_entities, targets)
-        else:
-            targets = self.node_entities
-            output = builder.build(self.source_entities, targets[0])
+        with Chrono() as elapsed:
+            if builder.is_batch():
+                targets = _NodeBatchTargets(self.node_entities_map)
+                output = builder.build_batch(self.source_entities, targets)
+            else:
+                targets = self.node_entities
+                output = builder.build(self.source_entities, targets[0])
+
+        self._set_build_time(elapsed.get())
+
+        self._populate_targets()
+
+        return output
+
+    # ----------------------------------------------------------
+
+    def _get_input_files(self):
+        entities = itertools.chain(self.source_entities,
+                                   getattr(self, 'dep_entities', None) or ())
+
+        return tuple(entity.get() for entity in entities
+                     if isinstance(entity, FileEntityBase) and
+                     not isinstance(entity, DirEntity))
+
+    # ----------------------------------------------------------
+
+    def build_in_process(self, executor):
+        """
+        Builds the node by the executor in a worker process.
+        Builder and source entities are sent to the worker,
+        built targets are sent back to be saved by the main process.
+        """
+
+        source_groups = tuple(node_entity.source_entities
+                              for node_entity in self.node_entities)
+
+        result = executor.build(self.builder, self.source_entities,
+                                source_groups, self._get_input_files())
+
+        if result is None:
+            # the executor can't send the node to workers
+            return self.build()
+
+        output, build_time, results = result
+
+        for node_entity, result in zip(self.node_entities, results):
+            node_entity.target_entities, \
+                node_entity.itarget_entities, \
+                node_entity.idep_entities = result
+
+        self._set_build_time(build_time)
 
         self._populate_targets()
 
@@ -1010,10 +1219,56 @@ class Node (object):
 
     # ----------------------------------------------------------
 
+    def _set_build_time(self, build_time):
+        node_entities = self.node_entities
+        build_time /= len(node_entities)
+
+        for node_entity in node_entities:
+            node_entity.build_time = build_time
+
+    # ----------------------------------------------------------
+
+    def get_build_time(self):
+        """
+        Returns the recorded build duration of the node or None if unknown
+        """
+        node_entities = getattr(self, 'node_entities', None)
+        if not node_entities:
+            return None
+
+        build_times = [node_entity.build_time
+                       for node_entity in node_entities
+                       if node_entity.build_time is not None]
+
+        if not build_times:
+            return None
+
+        return sum(build_times)
+
+    # ----------------------------------------------------------
+
     def save(self, vfile):
+        _save_node_entities(vfile, self.node_entities)
+
+    # ----------------------------------------------------------
+
+    def restore(self, artifact_cache):
+        """
+        Restores targets of the node from the artifact cache
+        instead of building
+        """
+        for node_entity in self.node_entities:
+            if not artifact_cache.restore(node_entity):
+                return False
+
+        self._populate_targets()
+        return True
+
+    # ----------------------------------------------------------
 
+    def store(self, artifact_cache):
         for node_entity in self.node_entities:
-            node_entity.save(vfile)
+            artifact_cache.store(node_entity)
 
     # ----------------------------------------------------------
 
@@ -1024,37 +1279,76 @@ class Node (object):
         if len(node_entities) < 2:
             return
 
-        for node_entity in node_entities:
-            # only nodes with targets should be saved
-            if node_entity.target_entities:
-                # nodes without targets will be rebuilt next time
-                node_entity.save(vfile)
+        # only nodes with targets should be saved,
+        # nodes without targets will be rebuilt next time
+        _save_node_entities(vfile, [node_entity
+                                    for node_entity in node_entities
+                                    if node_entity.target_entities])
 
     # ----------------------------------------------------------
 
     def _clear_split(self):
+        self.node_entities = _make_node_entities(self.builder,
+                                                 self.source_entities)
 
-        builder = self.builder
+    # ----------------------------------------------------------
 
-        source_entities = self.source_entities
-        if builder.is_batch():
-            groups = source_entities
-        else:
-            groups = self.builder.split(source_entities)
-            if not groups:
-                groups = [source_entities]
+    def _find_source_entities(self, builder, find_targets):
+        if self.initiated:
+            if self.sources:
+                # replaced sources are not initiated yet
+                return None
 
-        node_entities = []
-        for group in groups:
-            group = to_sequence(group)
+            return self.source_entities
 
-            node_entity = NodeEntity(builder=builder,
-                                     source_entities=group,
-                                     dep_entities=())
+        entities = []
+
+        for src in self.sources:
+            if isinstance(src, Node):
+                targets = find_targets(src)
+                if targets is None:
+                    return None
+
+                entities += targets
+
+            elif isinstance(src, NodeFilter):
+                return None
+
+            elif isinstance(src, EntityBase):
+                entities.append(src)
+
+            else:
+                entities.append(builder.make_entity(src))
+
+        return entities
+
+    # ----------------------------------------------------------
+
+    def find_recorded_entities(self, vfiles, find_targets):
+        """
+        Finds node entities saved by the previous build of the node
+        which has not been checked yet.
+        Targets of source nodes which are not built yet are found by
+        find_targets(node). Returns None if the node was not built before.
+        """
+        with WorkDir(self.cwd):
+            builder = self.builder.initiate()
+            source_entities = self._find_source_entities(builder,
+                                                         find_targets)
+        if source_entities is None:
+            return None
+
+        vfile = vfiles[builder]
+
+        node_entities = []
+        for node_entity in _make_node_entities(builder, source_entities):
+            node_entity = vfile.find_node_entity(node_entity)
+            if node_entity is None:
+                return None
 
             node_entities.append(node_entity)
 
-        self.node_entities = node_entities
+        return node_entities
 
     # ----------------------------------------------------------
 
@@ -99,6 +99,9 @@ def _build_options():
         default=0,
         description="Preferred size of a batching group.")
 
+    options.process_build = BoolOptionType(
+        description="Build nodes in separate processes.")
+
     # -----------------------------------------------------------
 
     options.set_group("Build")
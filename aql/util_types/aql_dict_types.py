@@ -155,6 +155,12 @@ class _SplitDictBase(object):
         return self._separator.join(sorted("%s=%s" % (key, value)
                                            for key, value in self.items()))
 
+    # -----------------------------------------------------------
+
+    def __reduce__(self):
+        # dynamically created dict types can't be pickled by reference
+        return Dict, (dict(self),)
+
 # ==============================================================================
 
 
@@ -315,6 +321,12 @@ class _ValueDictBase(object):
     def __contains__(self, key):
         return super(_ValueDictBase, self).__contains__(self._key_type(key))
 
+    # -----------------------------------------------------------
+
+    def __reduce__(self):
+        # dynamically created dict types can't be pickled by reference
+        return Dict, (dict(self),)
+
 # ==============================================================================
 
 
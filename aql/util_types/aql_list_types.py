@@ -500,6 +500,12 @@ class _SplitListBase(object):
     def __str__(self):
         return self._separator.join(map(cast_str, iter(self)))
 
+    # -----------------------------------------------------------
+
+    def __reduce__(self):
+        # dynamically created list types can't be pickled by reference
+        return List, (list(self),)
+
 # ==============================================================================
 
 
@@ -598,6 +604,12 @@ class _ValueListBase(object):
         value = self._value_type(other)
         return super(_ValueListBase, self).__contains__(value)
 
+    # -----------------------------------------------------------
+
+    def __reduce__(self):
+        # dynamically created list types can't be pickled by reference
+        return List, (list(self),)
+
 # ==============================================================================
 
 
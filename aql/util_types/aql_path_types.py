@@ -21,12 +21,14 @@
 
 
 import os.path
+import threading
 
 from .aql_simple_types import String, IgnoreCaseString
 
 __all__ = (
     'FilePath',
     'AbsFilePath',
+    'get_work_dir', 'set_work_dir', 'abs_path',
 )
 
 # ==============================================================================
@@ -43,6 +45,48 @@ except AttributeError:
         return str(), path
 
 
+# ==============================================================================
+class _WorkDir (threading.local):
+    path = None
+
+
+_WORK_DIR = _WorkDir()
+
+
+# ==============================================================================
+def get_work_dir(work_dir=_WORK_DIR):
+    """
+    Returns working directory of the current thread.
+    By default it's the current directory of the process.
+    """
+    path = work_dir.path
+    if path is None:
+        return os.getcwd()
+
+    return path
+
+
+# ==============================================================================
+def set_work_dir(path, work_dir=_WORK_DIR):
+    """
+    Sets working directory of the current thread only.
+    Returns the previous one.
+    """
+    previous_path = work_dir.path
+    work_dir.path = path
+    return previous_path
+
+
+# ==============================================================================
+def abs_path(path,
+             _join=os.path.join,
+             _normpath=os.path.normpath):
+    """
+    The same as os.path.abspath but relative to the thread working directory
+    """
+    return _normpath(_join(get_work_dir(), path))
+
+
 # ==============================================================================
 class FilePath (FilePathBase):
 
@@ -73,7 +117,7 @@ class FilePath (FilePathBase):
     # -----------------------------------------------------------
 
     def abspath(self):
-        return FilePath(os.path.abspath(self))
+        return FilePath(abs_path(self))
 
     def normpath(self):
         return FilePath(os.path.normpath(self))
@@ -133,6 +177,6 @@ class AbsFilePath (FilePath):
         if value is None:
             value = ''
 
-        value = os.path.normcase(os.path.abspath(value))
+        value = os.path.normcase(abs_path(value))
 
         return super(AbsFilePath, cls).__new__(cls, value)
@@ -21,11 +21,16 @@
 
 from .aql_data_file import *
 from .aql_sql_data_file import *
+from .aql_log_data_file import *
 from .aql_event_manager import *
 from .aql_lock_file import *
+from .aql_file_watcher import *
 from .aql_logging import *
 from .aql_task_manager import *
 from .aql_temp_file import *
 from .aql_utils import *
+from .aql_stat_cache import *
 from .aql_path_utils import *
 from .aql_cli_config import *
+from .aql_socket_utils import *
+from .aql_trace import *
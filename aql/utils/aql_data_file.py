@@ -21,6 +21,7 @@
 
 
 import os
+import bisect
 import operator
 import struct
 import mmap
@@ -69,6 +70,28 @@ class ErrorDataFileCorrupted(Exception):
 # ==============================================================================
 
 
+def _madvise_will_need(memmap):
+    madvise = getattr(memmap, 'madvise', None)
+    advice = getattr(mmap, 'MADV_WILLNEED', None)
+
+    if (madvise is not None) and (advice is not None):
+        try:
+            madvise(advice)
+        except (OSError, ValueError):
+            pass
+
+# ==============================================================================
+
+
+def _release_view(view):
+    # memoryview of Python 2 doesn't have release()
+    release = getattr(view, 'release', None)
+    if release is not None:
+        release()
+
+# ==============================================================================
+
+
 class _MmapFile(object):
 
     def __init__(self, filename):
@@ -113,30 +136,43 @@ class _MmapFile(object):
 
     # -----------------------------------------------------------
 
-    def write(self, offset, data):
-        memmap = self.memmap
+    def read_view(self, offset, size):
+        """
+        Returns memoryview of data without copying.
+        The view must be released before the file is resized.
+        """
+        return memoryview(self.memmap)[offset: offset + size]
+
+    # -----------------------------------------------------------
+
+    def reserve(self, end_offset):
+        """
+        Grows the file geometrically to avoid resizing on each write
+        """
+
+        size = self.memmap.size()
+        if end_offset > size:
+            end_offset = max(end_offset, size + size // 2)
 
-        end_offset = offset + len(data)
-        if end_offset > memmap.size():
             page_size = mmap.ALLOCATIONGRANULARITY
             size = ((end_offset + (page_size - 1)) // page_size) * page_size
-            if size == 0:
-                size = page_size
 
             self.resize(size)
 
-        memmap[offset: end_offset] = data
+    # -----------------------------------------------------------
+
+    def write(self, offset, data):
+        end_offset = offset + len(data)
+        self.reserve(end_offset)
+
+        self.memmap[offset: end_offset] = data
 
     # -----------------------------------------------------------
 
     def move(self, dest, src, size):
-        memmap = self.memmap
+        self.reserve(dest + size)
 
-        end_offset = dest + size
-        if end_offset > memmap.size():
-            self.resize(end_offset)
-
-        memmap.move(dest, src, size)
+        self.memmap.move(dest, src, size)
 
 # ==============================================================================
 
@@ -157,6 +193,11 @@ class _IOFile(object):
 
     # -----------------------------------------------------------
 
+    def reserve(self, end_offset):
+        pass
+
+    # -----------------------------------------------------------
+
     def read(self, offset, size):
         stream = self.stream
         stream.seek(offset)
@@ -164,6 +205,10 @@ class _IOFile(object):
 
     # -----------------------------------------------------------
 
+    read_view = read
+
+    # -----------------------------------------------------------
+
     def write(self, offset, data):
         stream = self.stream
         stream.seek(offset)
@@ -197,9 +242,9 @@ class MetaData (object):
         'data_capacity',
     )
 
-    # big-endian, 8 bytes (key), 16 bytes (id), 4 bytes (size), 4 bytes
-    # (capacity)
-    _META_STRUCT = struct.Struct(">Q16sLL")
+    # big-endian, 8 bytes (key), 16 bytes (id), 8 bytes (data offset),
+    # 4 bytes (size), 4 bytes (capacity)
+    _META_STRUCT = struct.Struct(">Q16sQLL")
     size = _META_STRUCT.size
 
     # -----------------------------------------------------------
@@ -216,7 +261,7 @@ class MetaData (object):
     # -----------------------------------------------------------
 
     def dump(self, meta_struct=_META_STRUCT):
-        return meta_struct.pack(self.key, self.id,
+        return meta_struct.pack(self.key, self.id, self.data_offset,
                                 self.data_size, self.data_capacity)
 
     # -----------------------------------------------------------
@@ -227,14 +272,15 @@ class MetaData (object):
         self = cls.__new__(cls)
 
         try:
-            self.key, self.id, data_size, data_capacity = meta_struct.unpack(
-                dump)
+            self.key, self.id, data_offset, data_size, data_capacity = \
+                meta_struct.unpack(dump)
         except struct.error:
             raise ErrorDataFileChunkInvalid()
 
         if data_capacity < data_size:
             raise ErrorDataFileChunkInvalid()
 
+        self.data_offset = data_offset
         self.data_size = data_size
         self.data_capacity = data_capacity
 
@@ -243,16 +289,18 @@ class MetaData (object):
     # -----------------------------------------------------------
 
     def resize(self, data_size):
+        """
+        Returns False if the new data doesn't fit into the capacity
+        """
 
         self.data_size = data_size
 
-        capacity = self.data_capacity
-        if capacity >= data_size:
-            return 0
+        if self.data_capacity >= data_size:
+            return True
 
         self.data_capacity = data_size + min(data_size // 4, 128)
 
-        return self.data_capacity - capacity
+        return False
 
     # -----------------------------------------------------------
 
@@ -271,16 +319,396 @@ class MetaData (object):
 # ==============================================================================
 
 
+class _FreeSpace (object):
+    """
+    Sorted list of free chunks of the data area
+    """
+
+    __slots__ = (
+        'offsets',
+        'sizes',
+        'size',
+    )
+
+    def __init__(self):
+        self.offsets = []
+        self.sizes = []
+        self.size = 0
+
+    # -----------------------------------------------------------
+
+    def clear(self):
+        self.offsets = []
+        self.sizes = []
+        self.size = 0
+
+    # -----------------------------------------------------------
+
+    def __iter__(self):
+        return zip(self.offsets, self.sizes)
+
+    # -----------------------------------------------------------
+
+    def add(self, offset, size):
+        if not size:
+            return
+
+        offsets = self.offsets
+        sizes = self.sizes
+
+        self.size += size
+
+        index = bisect.bisect(offsets, offset)
+
+        # merge with the next chunk
+        if (index < len(offsets)) and (offset + size == offsets[index]):
+            size += sizes[index]
+            del offsets[index]
+            del sizes[index]
+
+        # merge with the previous chunk
+        if index > 0:
+            prev_index = index - 1
+            if offsets[prev_index] + sizes[prev_index] == offset:
+                sizes[prev_index] += size
+                return
+
+        offsets.insert(index, offset)
+        sizes.insert(index, size)
+
+    # -----------------------------------------------------------
+
+    def allocate(self, size):
+        """
+        Returns offset of the first free chunk with enough space
+        or None if there is no such chunk
+        """
+
+        sizes = self.sizes
+
+        for index, chunk_size in enumerate(sizes):
+            if chunk_size >= size:
+                offset = self.offsets[index]
+
+                if chunk_size == size:
+                    del self.offsets[index]
+                    del sizes[index]
+                else:
+                    self.offsets[index] += size
+                    sizes[index] -= size
+
+                self.size -= size
+                return offset
+
+        return None
+
+    # -----------------------------------------------------------
+
+    def pop_last(self, end_offset):
+        """
+        Removes the free chunk at the end of the data area
+        and returns its offset
+        """
+
+        offsets = self.offsets
+        sizes = self.sizes
+
+        if offsets and (offsets[-1] + sizes[-1] == end_offset):
+            self.size -= sizes.pop()
+            return offsets.pop()
+
+        return end_offset
+
+    # -----------------------------------------------------------
+
+    def cut(self, end_offset):
+        """
+        Removes free space before the offset
+        """
+
+        offsets = self.offsets
+        sizes = self.sizes
+
+        while offsets and (offsets[0] < end_offset):
+            chunk_end = offsets[0] + sizes[0]
+            if chunk_end <= end_offset:
+                self.size -= sizes[0]
+                del offsets[0]
+                del sizes[0]
+            else:
+                self.size -= end_offset - offsets[0]
+                sizes[0] = chunk_end - end_offset
+                offsets[0] = end_offset
+                break
+
+# ==============================================================================
+
+
+class _DataIndex (object):
+    """
+    Sorted ids and keys of metas, it's saved on closing of a data file.
+    The index is mapped into memory and searched without loading.
+    """
+
+    __slots__ = (
+        'stream',
+        'memmap',
+        'meta_count',
+        'data_end',
+        'keys_offset',
+        'keys_count',
+        'free_offset',
+        'free_count',
+    )
+
+    # +-----------------------------------+
+    # |8 bytes (MAGIC TAG)                |
+    # +-----------------------------------+
+    # |8 bytes (index id)                 |
+    # +-----------------------------------+
+    # |8 bytes (end of data area)         |
+    # +-----------------------------------+
+    # |4 bytes (number of metas)          |
+    # +-----------------------------------+
+    # |4 bytes (number of keys)           |
+    # +-----------------------------------+
+    # |4 bytes (number of free chunks)    |
+    # +-----------------------------------+
+    # | sorted ids: id, meta offset       |
+    # +-----------------------------------+
+    # | sorted keys: key, meta offset     |
+    # +-----------------------------------+
+    # | free chunks: offset, size         |
+    # +-----------------------------------+
+
+    MAGIC_TAG = b".AQL.IX."
+
+    _HEADER_STRUCT = struct.Struct(">8sQQLLL")
+    _ID_STRUCT = struct.Struct(">16sL")
+    _KEY_STRUCT = struct.Struct(">QL")
+    _FREE_STRUCT = struct.Struct(">QQ")
+    _OFFSET_STRUCT = struct.Struct(">L")
+
+    # -----------------------------------------------------------
+
+    def __init__(self, filename, index_id, header_struct=_HEADER_STRUCT):
+
+        self.stream = None
+        self.memmap = None
+
+        stream = open_file(filename, binary=True)
+        try:
+            header = stream.read(header_struct.size)
+
+            tag, file_index_id, data_end, meta_count, keys_count, \
+                free_count = header_struct.unpack(header)
+
+            if (tag != self.MAGIC_TAG) or (file_index_id != index_id):
+                raise ErrorDataFileFormatInvalid()
+
+            keys_offset = header_struct.size + \
+                meta_count * self._ID_STRUCT.size
+
+            free_offset = keys_offset + keys_count * self._KEY_STRUCT.size
+            index_size = free_offset + free_count * self._FREE_STRUCT.size
+
+            memmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except Exception:
+            stream.close()
+            raise
+
+        self.stream = stream
+        self.memmap = memmap
+
+        if memmap.size() != index_size:
+            self.close()
+            raise ErrorDataFileFormatInvalid()
+
+        self.data_end = data_end
+        self.meta_count = meta_count
+        self.keys_offset = keys_offset
+        self.keys_count = keys_count
+        self.free_offset = free_offset
+        self.free_count = free_count
+
+        _madvise_will_need(memmap)
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        if self.memmap is not None:
+            self.memmap.close()
+            self.memmap = None
+
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    # -----------------------------------------------------------
+
+    def _find(self, value, offset, count, item_size,
+              offset_struct=_OFFSET_STRUCT):
+        """
+        Binary search of the value in the sorted items
+        """
+
+        memmap = self.memmap
+        value_size = len(value)
+
+        low = 0
+        high = count
+
+        while low < high:
+            middle = (low + high) // 2
+            pos = offset + middle * item_size
+            middle_value = memmap[pos: pos + value_size]
+
+            if middle_value < value:
+                low = middle + 1
+            elif middle_value > value:
+                high = middle
+            else:
+                return offset_struct.unpack_from(memmap, pos + value_size)[0]
+
+        return None
+
+    # -----------------------------------------------------------
+
+    def find_id(self, data_id, header_struct=_HEADER_STRUCT,
+                item_size=_ID_STRUCT.size):
+
+        return self._find(data_id, header_struct.size, self.meta_count,
+                          item_size)
+
+    # -----------------------------------------------------------
+
+    def find_key(self, key, key_struct=struct.Struct(">Q"),
+                 item_size=_KEY_STRUCT.size):
+
+        # big-endian keys are sorted in the same order as numbers
+        return self._find(key_struct.pack(key), self.keys_offset,
+                          self.keys_count, item_size)
+
+    # -----------------------------------------------------------
+
+    def free_chunks(self, free_struct=_FREE_STRUCT):
+        memmap = self.memmap
+        unpack = free_struct.unpack_from
+        item_size = free_struct.size
+
+        offset = self.free_offset
+        for i in range(self.free_count):
+            yield unpack(memmap, offset)
+            offset += item_size
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _get_entries(table_begin, metas_dump,
+                     meta_struct=MetaData._META_STRUCT):
+        """
+        Returns sorted offsets of metas by their ids and keys
+        """
+
+        meta_size = meta_struct.size
+        unpack_meta = meta_struct.unpack_from
+
+        ids = []
+        keys = []
+
+        for pos in range(0, len(metas_dump), meta_size):
+            key, data_id = unpack_meta(metas_dump, pos)[:2]
+            meta_offset = table_begin + pos
+
+            ids.append((data_id, meta_offset))
+            if key:
+                keys.append((key, meta_offset))
+
+        ids.sort()
+        keys.sort()
+
+        return ids, keys
+
+    # -----------------------------------------------------------
+
+    @classmethod
+    def _dump_header(cls, index_id, data_end, ids, keys, free_chunks):
+        return cls._HEADER_STRUCT.pack(cls.MAGIC_TAG, index_id, data_end,
+                                       len(ids), len(keys), len(free_chunks))
+
+    # -----------------------------------------------------------
+
+    @classmethod
+    def _dump_entries(cls, dump, ids, keys, free_chunks):
+        pack_id = cls._ID_STRUCT.pack
+        pack_key = cls._KEY_STRUCT.pack
+        pack_free = cls._FREE_STRUCT.pack
+
+        dump.extend(pack_id(data_id, offset) for data_id, offset in ids)
+        dump.extend(pack_key(key, offset) for key, offset in keys)
+        dump.extend(pack_free(offset, size) for offset, size in free_chunks)
+
+    # -----------------------------------------------------------
+
+    @classmethod
+    def save(cls, filename, index_id, data_end, table_begin, metas_dump,
+             free_space):
+        """
+        Saves the index of the meta table.
+        Returns False if the index can't be written.
+        """
+
+        ids, keys = cls._get_entries(table_begin, metas_dump)
+        free_chunks = list(free_space)
+
+        dump = [cls._dump_header(index_id, data_end, ids, keys, free_chunks)]
+        cls._dump_entries(dump, ids, keys, free_chunks)
+
+        tmp_filename = filename + '.tmp'
+
+        try:
+            with open_file(tmp_filename, write=True, binary=True,
+                           truncate=True) as stream:
+                stream.write(b''.join(dump))
+
+            try:
+                os.replace(tmp_filename, filename)
+            except AttributeError:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                os.rename(tmp_filename, filename)
+
+        except (OSError, IOError):
+            # the index is optional, the meta table will be loaded next time
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+            return False
+
+        return True
+
+# ==============================================================================
+
+
 class DataFile (object):
 
     __slots__ = (
         'next_key',
+        'reserved_key',
         'id2data',
         'key2id',
         'meta_end',
         'data_begin',
         'data_end',
+        'offset2meta',
+        'free_space',
         'handle',
+        'index',
+        'index_id',
+        'index_filename',
     )
 
     # +-----------------------------------+
@@ -288,42 +716,56 @@ class DataFile (object):
     # +-----------------------------------+
     # |4 bytes (file version)             |
     # +-----------------------------------+
-    # |8 bytes (next unique key)          |
+    # |8 bytes (reserved unique keys)     |
+    # +-----------------------------------+
+    # |8 bytes (id of the valid index)    |
     # +-----------------------------------+
     # |4 bytes (data begin)               |
     # +-----------------------------------+
-    # | meta1 (32 bytes)                  |
+    # | meta1 (40 bytes)                  |
     # +-----------------------------------+
-    # | meta2 (32 bytes)                  |
+    # | meta2 (40 bytes)                  |
     # +-----------------------------------+
     #           .......
     # +-----------------------------------+
-    # | meta_n (32 bytes)                  |
-    # +-----------------------------------+
-    # |  data1 (x bytes)                  |
+    # | meta_n (40 bytes)                 |
     # +-----------------------------------+
-    # |  data2 (y bytes)                  |
-    # +-----------------------------------+
-    #           .......
-    # +-----------------------------------+
-    # |  data_n (z bytes)                  |
+    # |  data area                        |
     # +-----------------------------------+
+    #
+    # Each meta keeps an offset of its data in the data area.
+    # Space of removed and relocated data is reused for new data.
+    #
+    # Sorted ids and keys are saved to the index file on closing,
+    # so the next session loads only metas it accesses.
+    # The index id is reset in the header on the first change of the file.
 
     MAGIC_TAG = b".AQL.DB."
-    VERSION = 1
+    VERSION = 3
+
+    # number of keys reserved in the header at once
+    KEYS_RESERVE = 1024
+
+    # the data area is compacted when free space exceeds the ratio
+    COMPACT_RATIO = 0.5
+    COMPACT_MIN_SIZE = 1024 * 1024
 
     # big-endian, 8 bytes(MAGIC TAG), 4 bytes (file version)
     _HEADER_STRUCT = struct.Struct(">8sL")
     _HEADER_SIZE = _HEADER_STRUCT.size
 
-    _KEY_STRUCT = struct.Struct(">Q")  # 8 bytes (next unique key)
+    _KEY_STRUCT = struct.Struct(">Q")  # 8 bytes (reserved unique keys)
     _KEY_OFFSET = _HEADER_SIZE
     _KEY_SIZE = _KEY_STRUCT.size
 
+    _INDEX_ID_STRUCT = struct.Struct(">Q")  # 8 bytes (id of the index)
+    _INDEX_ID_OFFSET = _KEY_OFFSET + _KEY_SIZE
+    _INDEX_ID_SIZE = _INDEX_ID_STRUCT.size
+
     # 4 bytes (offset of data area)
     _META_TABLE_HEADER_STRUCT = struct.Struct(">L")
     _META_TABLE_HEADER_SIZE = _META_TABLE_HEADER_STRUCT.size
-    _META_TABLE_HEADER_OFFSET = _KEY_OFFSET + _KEY_SIZE
+    _META_TABLE_HEADER_OFFSET = _INDEX_ID_OFFSET + _INDEX_ID_SIZE
 
     _META_TABLE_OFFSET = _META_TABLE_HEADER_OFFSET + _META_TABLE_HEADER_SIZE
 
@@ -336,8 +778,14 @@ class DataFile (object):
         self.meta_end = 0
         self.data_begin = 0
         self.data_end = 0
+        self.offset2meta = {}
+        self.free_space = _FreeSpace()
         self.handle = None
-        self.next_key = None
+        self.index = None
+        self.index_id = 0
+        self.index_filename = None
+        self.next_key = 0
+        self.reserved_key = 0
 
         self.open(filename, force=force)
 
@@ -352,35 +800,69 @@ class DataFile (object):
             log_debug("mmap is not supported: %s", ex)
             self.handle = _IOFile(filename)
 
-        self._init_header(force)
+        self.index_filename = filename + '.index'
 
-        self.next_key = self._key_generator()
+        is_new = self._init_header(force)
 
-        self._init_meta_table()
+        self._init_keys()
+
+        if is_new:
+            self._reset_meta_table()
+
+        elif not self._open_index():
+            self._init_meta_table()
+
+            # the index will be saved on closing
+            self._set_modified()
 
     # -----------------------------------------------------------
 
     def close(self):
 
         if self.handle is not None:
-            self.handle.close()
-            self.handle = None
+            handle = self.handle
+
+            try:
+                self._close_index()
+
+                # cut off space reserved by geometric growth
+                if self.data_end and (handle.size() > self.data_end):
+                    handle.resize(self.data_end)
+
+                if not self.index_id:
+                    self._save_index()
+
+            finally:
+                handle.close()
+                self.handle = None
 
             self.id2data.clear()
             self.key2id.clear()
+            self.free_space.clear()
+            self.offset2meta = {}
+            self.index_id = 0
             self.meta_end = 0
             self.data_begin = 0
             self.data_end = 0
-            self.next_key = None
+            self.next_key = 0
+            self.reserved_key = 0
+
+    # -----------------------------------------------------------
+
+    def flush(self):
+        """
+        Writes all changes to the disk, the index is saved on close only
+        """
+        if self.handle is not None:
+            self.handle.flush()
 
     # -----------------------------------------------------------
 
     def clear(self):
 
+        self._set_modified()
         self._reset_meta_table()
 
-        self.next_key = self._key_generator()
-
         self.id2data.clear()
         self.key2id.clear()
 
@@ -395,6 +877,9 @@ class DataFile (object):
     # -----------------------------------------------------------
 
     def _init_header(self, force, header_struct=_HEADER_STRUCT):
+        """
+        Returns True if the file has been initialized
+        """
 
         header = self.handle.read(0, header_struct.size)
 
@@ -406,7 +891,7 @@ class DataFile (object):
                     raise ErrorDataFileFormatInvalid()
 
             elif version == self.VERSION:
-                return
+                return False
 
         except struct.error:
             if (header and header != b'\0') and not force:
@@ -418,31 +903,229 @@ class DataFile (object):
         self.handle.resize(len(header))
         self.handle.write(0, header)
 
+        return True
+
     # -----------------------------------------------------------
 
-    def _key_generator(self,
-                       key_offset=_KEY_OFFSET,
-                       key_struct=_KEY_STRUCT,
-                       max_key=(2 ** 64) - 1):
+    def _init_keys(self, key_offset=_KEY_OFFSET, key_struct=_KEY_STRUCT):
 
         key_dump = self.handle.read(key_offset, key_struct.size)
         try:
-            next_key, = key_struct.unpack(key_dump)
+            reserved_key, = key_struct.unpack(key_dump)
         except struct.error:
-            next_key = 0
+            reserved_key = 0
 
-        key_pack = key_struct.pack
-        write_file = self.handle.write
+        # keys reserved by the previous session are skipped
+        self.next_key = reserved_key
+        self.reserved_key = reserved_key
 
-        while True:
+    # -----------------------------------------------------------
 
-            if next_key < max_key:
-                next_key += 1
-            else:
-                next_key = 1    # this should never happen
+    def _new_keys(self, count,
+                  key_offset=_KEY_OFFSET,
+                  key_struct=_KEY_STRUCT,
+                  max_key=(2 ** 64) - 1):
+        """
+        Returns the first key of the range of new keys
+        """
+
+        next_key = self.next_key
+
+        if (next_key + count) > (max_key - self.KEYS_RESERVE):
+            next_key = 0    # this should never happen
+            self.reserved_key = 0
+
+        last_key = next_key + count
+        self.next_key = last_key
+
+        if last_key > self.reserved_key:
+            self.reserved_key = last_key + self.KEYS_RESERVE
+            self.handle.write(key_offset, key_struct.pack(self.reserved_key))
+
+        return next_key + 1
+
+    # -----------------------------------------------------------
+
+    def _open_index(self,
+                    index_id_offset=_INDEX_ID_OFFSET,
+                    index_id_struct=_INDEX_ID_STRUCT,
+                    table_header_struct=_META_TABLE_HEADER_STRUCT,
+                    table_header_offset=_META_TABLE_HEADER_OFFSET,
+                    table_begin=_META_TABLE_OFFSET,
+                    meta_size=MetaData.size):
+        """
+        Opens the index of the meta table.
+        Returns False if the meta table should be loaded.
+        """
+
+        handle = self.handle
+
+        try:
+            index_id, = index_id_struct.unpack(
+                handle.read(index_id_offset, index_id_struct.size))
+
+            data_begin, = table_header_struct.unpack(
+                handle.read(table_header_offset, table_header_struct.size))
+
+        except struct.error:
+            return False
+
+        self.index_id = index_id
+        if not index_id:
+            return False
+
+        try:
+            index = _DataIndex(self.index_filename, index_id)
+        except Exception:
+            return False
+
+        meta_end = table_begin + index.meta_count * meta_size
+
+        if (meta_end > data_begin) or (index.data_end < data_begin):
+            index.close()
+            return False
+
+        self.index = index
+        self.data_begin = data_begin
+        self.meta_end = meta_end
+        self.data_end = index.data_end
+
+        free_space = self.free_space
+        for offset, size in index.free_chunks():
+            free_space.add(offset, size)
 
-            write_file(key_offset, key_pack(next_key))
-            yield next_key
+        return True
+
+    # -----------------------------------------------------------
+
+    def _close_index(self):
+        index = self.index
+        if index is not None:
+            self.index = None
+            index.close()
+
+    # -----------------------------------------------------------
+
+    def _save_index(self,
+                    index_id_offset=_INDEX_ID_OFFSET,
+                    index_id_struct=_INDEX_ID_STRUCT,
+                    table_begin=_META_TABLE_OFFSET):
+
+        handle = self.handle
+        handle.flush()
+
+        metas_dump = handle.read(table_begin, self.meta_end - table_begin)
+
+        index_id, = index_id_struct.unpack(os.urandom(index_id_struct.size))
+        index_id = index_id or 1
+
+        if _DataIndex.save(self.index_filename, index_id, self.data_end,
+                           table_begin, metas_dump, self.free_space):
+
+            handle.write(index_id_offset, index_id_struct.pack(index_id))
+            handle.flush()
+
+    # -----------------------------------------------------------
+
+    def _set_modified(self,
+                      index_id_offset=_INDEX_ID_OFFSET,
+                      index_id_struct=_INDEX_ID_STRUCT):
+        """
+        Invalidates the saved index on the first change of the file
+        """
+
+        if self.index_id:
+            self.index_id = 0
+
+            handle = self.handle
+            handle.write(index_id_offset, index_id_struct.pack(0))
+            handle.flush()
+
+    # -----------------------------------------------------------
+
+    def _load_meta(self, meta_offset, meta_size=MetaData.size):
+        """
+        Returns the meta by its offset, loads it if needed
+        """
+
+        meta = self.offset2meta.get(meta_offset)
+        if meta is not None:
+            return meta
+
+        if meta_offset >= self.meta_end:
+            return None
+
+        try:
+            meta = MetaData.load(self.handle.read(meta_offset, meta_size))
+        except ErrorDataFileChunkInvalid:
+            return None
+
+        meta.offset = meta_offset
+
+        self.offset2meta[meta_offset] = meta
+        self.id2data[meta.id] = meta
+        if meta.key:
+            self.key2id[meta.key] = meta.id
+
+        return meta
+
+    # -----------------------------------------------------------
+
+    def _load_all(self, meta_size=MetaData.size,
+                  table_begin=_META_TABLE_OFFSET):
+        """
+        Loads all metas and closes the index
+        """
+
+        if self.index is None:
+            return
+
+        load_meta = self._load_meta
+        for meta_offset in range(table_begin, self.meta_end, meta_size):
+            load_meta(meta_offset)
+
+        self._close_index()
+
+    # -----------------------------------------------------------
+
+    def _find_meta(self, data_id):
+        meta = self.id2data.get(data_id)
+
+        if (meta is None) and (self.index is not None):
+            meta_offset = self.index.find_id(data_id)
+            if meta_offset is not None:
+                meta = self._load_meta(meta_offset)
+
+                # the meta could be removed or moved in this session
+                if (meta is not None) and (meta.id != data_id):
+                    meta = None
+
+        return meta
+
+    # -----------------------------------------------------------
+
+    def _get_meta(self, data_id):
+        meta = self._find_meta(data_id)
+        if meta is None:
+            raise KeyError(data_id)
+
+        return meta
+
+    # -----------------------------------------------------------
+
+    def _find_key(self, key):
+        data_id = self.key2id.get(key)
+
+        if (data_id is None) and (self.index is not None):
+            meta_offset = self.index.find_key(key)
+            if meta_offset is not None:
+                meta = self._load_meta(meta_offset)
+
+                # the key could be changed in this session
+                if (meta is not None) and (meta.key == key):
+                    data_id = meta.id
+
+        return data_id
 
     # -----------------------------------------------------------
 
@@ -453,7 +1136,10 @@ class DataFile (object):
         self.meta_end = table_offset
         self.data_begin = table_offset + meta_size * 1024
         self.data_end = self.data_begin
+        self.free_space.clear()
+        self.offset2meta = {}
 
+        self._close_index()
         self._truncate_file()
 
     # -----------------------------------------------------------
@@ -470,7 +1156,7 @@ class DataFile (object):
         handle.write(table_header_offset, header_dump)
 
         # handle.write( self.meta_end,
-        #               bytearray(self.data_begin - self.meta_end) )
+        #               bytearray( self.data_begin - self.meta_end) )
         handle.write(self.meta_end, b'\0' * (self.data_begin - self.meta_end))
         handle.flush()
 
@@ -513,15 +1199,19 @@ class DataFile (object):
 
     # -----------------------------------------------------------
 
-    def _load_meta_table(self, data_offset, metas_dump,
+    def _load_meta_table(self, data_begin, metas_dump,
                          meta_size=MetaData.size,
                          table_begin=_META_TABLE_OFFSET):
 
-        self.data_begin = data_offset
+        self.data_begin = data_begin
 
         file_size = self.handle.size()
         load_meta = MetaData.load
 
+        id2data = self.id2data
+        key2id = self.key2id
+        offset2meta = self.offset2meta
+
         pos = 0
         dump_size = len(metas_dump)
         while pos < dump_size:
@@ -529,34 +1219,87 @@ class DataFile (object):
             try:
                 meta = load_meta(meta_dump)
 
-                data_capacity = meta.data_capacity
-
-                if data_capacity == 0:
+                if meta.data_capacity == 0:
                     # end of meta table marker
                     break
 
                 meta.offset = pos + table_begin
-                meta.data_offset = data_offset
 
-                if (data_offset + meta.data_size) > file_size:
+                if (meta.data_offset < data_begin) or \
+                   ((meta.data_offset + meta.data_size) > file_size) or \
+                   (meta.id in id2data):
                     raise ErrorDataFileChunkInvalid()
 
-                data_offset += data_capacity
-
             except Exception:
-                self.data_end = data_offset
-                self.meta_end = pos + table_begin
-                self._truncate_file()
-                return
+                break
 
-            self.id2data[meta.id] = meta
+            id2data[meta.id] = meta
+            offset2meta[meta.offset] = meta
             if meta.key:
-                self.key2id[meta.key] = meta.id
+                key2id[meta.key] = meta.id
 
             pos += meta_size
 
         self.meta_end = pos + table_begin
-        self.data_end = data_offset
+
+        if not self._init_free_space():
+            self._reset_meta_table()
+            id2data.clear()
+            key2id.clear()
+            return
+
+        # clear the rest of meta table and unused data
+        self._truncate_file()
+
+    # -----------------------------------------------------------
+
+    def _init_free_space(self):
+        """
+        Finds free space between data chunks.
+        Returns False if data chunks are overlapped.
+        """
+
+        free_space = self.free_space
+        free_space.clear()
+
+        metas = sorted(self.id2data.values(),
+                       key=operator.attrgetter('data_offset'))
+
+        data_end = self.data_begin
+
+        for meta in metas:
+            data_offset = meta.data_offset
+            if data_offset < data_end:
+                return False
+
+            free_space.add(data_end, data_offset - data_end)
+            data_end = data_offset + meta.data_capacity
+
+        self.data_end = data_end
+
+        return True
+
+    # -----------------------------------------------------------
+
+    def _allocate(self, size):
+        offset = self.free_space.allocate(size)
+        if offset is None:
+            offset = self.free_space.pop_last(self.data_end)
+            self.data_end = offset + size
+
+        return offset
+
+    # -----------------------------------------------------------
+
+    def _shrink(self):
+        """
+        Cuts off free space at the end of the data area
+        """
+
+        data_end = self.free_space.pop_last(self.data_end)
+        if data_end != self.data_end:
+            self.data_end = data_end
+            self.handle.resize(data_end)
 
     # -----------------------------------------------------------
 
@@ -565,41 +1308,45 @@ class DataFile (object):
                            table_header_offset=_META_TABLE_HEADER_OFFSET,
                            table_begin=_META_TABLE_OFFSET):
 
+        # data of any meta can be relocated
+        self._load_all()
+
         data_begin = self.data_begin
-        data_end = self.data_end
 
         table_capacity = data_begin - table_begin
         new_data_begin = data_begin + table_capacity
 
-        handle = self.handle
+        # relocate data from the extended part of meta table
+        self.free_space.cut(new_data_begin)
+        if self.data_end < new_data_begin:
+            self.data_end = new_data_begin
 
-        handle.move(new_data_begin, data_begin, data_end - data_begin)
-        # handle.write( data_begin, bytearray( table_capacity ) )
-        handle.write(data_begin, b'\0' * table_capacity)
-
-        header_dump = table_header_struct.pack(new_data_begin)
-        handle.write(table_header_offset, header_dump)
-
-        self.data_begin = new_data_begin
-        self.data_end += table_capacity
+        handle = self.handle
+        write = handle.write
 
         for meta in self.id2data.values():
-            meta.data_offset += table_capacity
+            data_offset = meta.data_offset
+            if data_offset < new_data_begin:
+                capacity = meta.data_capacity
+                new_data_offset = self._allocate(capacity)
 
-    # -----------------------------------------------------------
+                if (data_offset + capacity) > new_data_begin:
+                    # the rest of the chunk becomes free
+                    self.free_space.add(new_data_begin,
+                                        data_offset + capacity -
+                                        new_data_begin)
 
-    def _extend_data(self, meta, oversize):
-        new_next_data = meta.data_offset + meta.data_capacity
-        next_data = new_next_data - oversize
-        rest_size = self.data_end - next_data
-        if rest_size > 0:
-            self.handle.move(new_next_data, next_data, rest_size)
+                handle.move(new_data_offset, data_offset, meta.data_size)
+                meta.data_offset = new_data_offset
+                write(meta.offset, meta.dump())
 
-            for meta in self.id2data.values():
-                if meta.data_offset >= next_data:
-                    meta.data_offset += oversize
+        # handle.write( data_begin, bytearray( table_capacity ) )
+        write(data_begin, b'\0' * table_capacity)
 
-        self.data_end += oversize
+        header_dump = table_header_struct.pack(new_data_begin)
+        write(table_header_offset, header_dump)
+
+        self.data_begin = new_data_begin
 
     # -----------------------------------------------------------
 
@@ -610,19 +1357,18 @@ class DataFile (object):
         if meta_offset == self.data_begin:
             self._extend_meta_table()
 
-        data_offset = self.data_end
-
-        meta = MetaData(meta_offset, key, data_id, data_offset, len(data))
+        meta = MetaData(meta_offset, key, data_id, 0, len(data))
+        meta.data_offset = self._allocate(meta.data_capacity)
 
         write = self.handle.write
 
-        write(data_offset, data)
+        write(meta.data_offset, data)
         write(meta_offset, meta.dump())
 
-        self.data_end += meta.data_capacity
         self.meta_end += meta_size
 
         self.id2data[data_id] = meta
+        self.offset2meta[meta_offset] = meta
 
     # -----------------------------------------------------------
 
@@ -632,44 +1378,82 @@ class DataFile (object):
 
         if meta.data_size != data_size:
             update_meta = True
-            oversize = meta.resize(data_size)
-            if oversize > 0:
-                self._extend_data(meta, oversize)
+
+            data_offset = meta.data_offset
+            data_capacity = meta.data_capacity
+
+            if not meta.resize(data_size):
+                # relocate the grown data
+                meta.data_offset = self._allocate(meta.data_capacity)
+                self.free_space.add(data_offset, data_capacity)
 
         write = self.handle.write
 
+        write(meta.data_offset, data)
+
         if update_meta:
             write(meta.offset, meta.dump())
 
-        write(meta.data_offset, data)
-
     # -----------------------------------------------------------
 
     def read(self, data_id):
-        try:
-            meta = self.id2data[data_id]
-        except KeyError:
+        meta = self._find_meta(data_id)
+        if meta is None:
             return None
 
         return self.handle.read(meta.data_offset, meta.data_size)
 
     # -----------------------------------------------------------
 
+    def read_many(self, data_ids):
+        return list(map(self.read, data_ids))
+
+    # -----------------------------------------------------------
+
+    def read_views(self, data_ids):
+        """
+        Yields data of ids as memoryview (None for unknown ids).
+        A view is valid until the next one is taken.
+        """
+
+        for data_id in data_ids:
+            meta = self._find_meta(data_id)
+            if meta is None:
+                yield None
+                continue
+
+            view = self.handle.read_view(meta.data_offset, meta.data_size)
+            try:
+                yield view
+            finally:
+                _release_view(view)
+
+    # -----------------------------------------------------------
+
     def write(self, data_id, data):
 
-        try:
-            meta = self.id2data[data_id]
-            self._update(meta, data, update_meta=False)
-        except KeyError:
+        self._set_modified()
+
+        meta = self._find_meta(data_id)
+        if meta is None:
             self._append(0, data_id, data)
+        else:
+            self._update(meta, data, update_meta=False)
 
     # -----------------------------------------------------------
 
     def write_with_key(self, data_id, data):
+        self._set_modified()
 
-        meta = self.id2data.get(data_id)
+        key = self._new_keys(1)
+        self._write_with_key(key, data_id, data)
+        return key
 
-        key = next(self.next_key)
+    # -----------------------------------------------------------
+
+    def _write_with_key(self, key, data_id, data):
+
+        meta = self._find_meta(data_id)
 
         if meta is None:
             self._append(key, data_id, data)
@@ -684,104 +1468,190 @@ class DataFile (object):
 
         self.key2id[key] = data_id
 
-        return key
+    # -----------------------------------------------------------
+
+    def _reserve(self, items, meta_size=MetaData.size):
+        """
+        Prepares space for all items of a batch at once
+        """
+
+        self._set_modified()
+
+        find_meta = self._find_meta
+
+        new_metas_size = 0
+        data_size = 0
+        for data_id, data in items:
+            if find_meta(data_id) is None:
+                new_metas_size += meta_size
+
+            data_size += len(data)
+
+        while (self.meta_end + new_metas_size) > self.data_begin:
+            self._extend_meta_table()
+
+        if data_size > self.free_space.size:
+            self.handle.reserve(self.data_end + data_size + data_size // 4)
+
+    # -----------------------------------------------------------
+
+    def write_many(self, items):
+        """
+        Writes a batch of (data_id, data) items
+        """
+
+        items = tuple(items)
+        self._reserve(items)
+
+        write = self.write
+        for data_id, data in items:
+            write(data_id, data)
+
+    # -----------------------------------------------------------
+
+    def write_with_keys(self, items):
+        """
+        Writes a batch of (data_id, data) items with new keys.
+        Returns keys of the items.
+        """
+
+        items = tuple(items)
+        self._reserve(items)
+
+        key = self._new_keys(len(items))
+        keys = []
+
+        write = self._write_with_key
+        for data_id, data in items:
+            write(key, data_id, data)
+            keys.append(key)
+            key += 1
+
+        return keys
 
     # -----------------------------------------------------------
 
     def get_ids(self, keys):
-        try:
-            return tuple(map(self.key2id.__getitem__, keys))
-        except KeyError:
-            return None
+        find_key = self._find_key
+
+        data_ids = []
+        for key in keys:
+            data_id = find_key(key)
+            if data_id is None:
+                return None
+
+            data_ids.append(data_id)
+
+        return tuple(data_ids)
 
     # -----------------------------------------------------------
 
     def get_keys(self, data_ids):
         return map(operator.attrgetter('key'),
-                   map(self.id2data.__getitem__, data_ids))
+                   map(self._get_meta, data_ids))
 
     # -----------------------------------------------------------
 
-    def remove(self, data_ids):     # noqa  TODO: refactor to compexity < 10
+    def get_all_ids(self):
+        self._load_all()
+        return list(self.id2data)
 
-        move = self.handle.move
-        meta_size = MetaData.size
+    # -----------------------------------------------------------
 
-        remove_data_ids = frozenset(data_ids)
+    def remove(self, data_ids, meta_size=MetaData.size):
 
-        metas = sorted(self.id2data.values(),
-                       key=operator.attrgetter('data_offset'))
+        id2data = self.id2data
+        key2id = self.key2id
+        find_meta = self._find_meta
 
-        meta_shift = 0
-        data_shift = 0
+        metas = []
+        for data_id in frozenset(data_ids):
+            meta = find_meta(data_id)
+            if meta is not None:
+                del id2data[data_id]
+                if meta.key:
+                    del key2id[meta.key]
 
-        meta_offset = 0
-        data_offset = 0
-        last_meta_end = 0
-        last_data_end = 0
+                metas.append(meta)
 
-        remove_data_begin = None
-        remove_meta_begin = None
+        if not metas:
+            return
+
+        self._set_modified()
 
-        move_meta_begin = None
-        move_data_begin = None
+        # move last metas to the places of removed ones, starting from the end
+        metas.sort(key=operator.attrgetter('offset'), reverse=True)
+
+        offset2meta = self.offset2meta
+        load_meta = self._load_meta
+        write = self.handle.write
 
         for meta in metas:
+            last_meta_offset = self.meta_end - meta_size
+            last_meta = load_meta(last_meta_offset)
 
-            meta_offset = meta.offset
-            last_meta_end = meta_offset + meta_size
-            data_offset = meta.data_offset
-            last_data_end = data_offset + meta.data_size
-            next_data_begin = data_offset + meta.data_capacity
+            del offset2meta[last_meta_offset]
+            self.meta_end = last_meta_offset
 
-            if meta.id in remove_data_ids:
+            if last_meta is not meta:
+                offset2meta[meta.offset] = last_meta
 
-                del self.id2data[meta.id]
-                if meta.key:
-                    del self.key2id[meta.key]
+                last_meta.offset = meta.offset
+                write(meta.offset, last_meta.dump())
 
-                if move_meta_begin is not None:
-                    move(remove_meta_begin, move_meta_begin,
-                         meta_offset - move_meta_begin)
-                    move(remove_data_begin, move_data_begin,
-                         data_offset - move_data_begin)
+            write(self.meta_end, b'\0' * meta_size)
 
-                    remove_meta_begin = None
-                    move_meta_begin = None
+            self.free_space.add(meta.data_offset, meta.data_capacity)
 
-                if remove_meta_begin is None:
-                    remove_meta_begin = meta_offset - meta_shift
-                    remove_data_begin = data_offset - data_shift
+        self._shrink()
 
-            else:
-                if remove_meta_begin is not None:
-                    if move_meta_begin is None:
-                        move_meta_begin = meta_offset
-                        move_data_begin = data_offset
-
-                        meta_shift = move_meta_begin - remove_meta_begin
-                        data_shift = move_data_begin - remove_data_begin
-
-                if meta_shift:
-                    meta.offset -= meta_shift
-                    meta.data_offset -= data_shift
-
-        if remove_data_begin is not None:
-            if move_meta_begin is None:
-                meta_shift = last_meta_end - remove_meta_begin
-                data_shift = next_data_begin - remove_data_begin
-            else:
-                move(remove_meta_begin, move_meta_begin,
-                     last_meta_end - move_meta_begin)
-                move(remove_data_begin, move_data_begin,
-                     last_data_end - move_data_begin)
+        if self._need_compact():
+            self.compact()
+
+    # -----------------------------------------------------------
+
+    def _need_compact(self):
+        free_size = self.free_space.size
+        if free_size < self.COMPACT_MIN_SIZE:
+            return False
+
+        data_size = self.data_end - self.data_begin
+        return free_size > (data_size * self.COMPACT_RATIO)
+
+    # -----------------------------------------------------------
+
+    def compact(self):
+        """
+        Moves all data to the beginning of data area to remove free space
+        """
+
+        if not self.free_space.size:
+            return
+
+        self._set_modified()
+        self._load_all()
+
+        metas = sorted(self.id2data.values(),
+                       key=operator.attrgetter('data_offset'))
+
+        handle = self.handle
+        move = handle.move
+        write = handle.write
+
+        data_end = self.data_begin
+
+        for meta in metas:
+            data_offset = meta.data_offset
+            if data_offset != data_end:
+                move(data_end, data_offset, meta.data_size)
+                meta.data_offset = data_end
+                write(meta.offset, meta.dump())
 
-        self.meta_end -= meta_shift
-        self.data_end -= data_shift
+            data_end += meta.data_capacity
 
-        # self.handle.write( self.meta_end, bytearray( meta_shift ) )
-        self.handle.write(self.meta_end, b'\0' * meta_shift)
-        self.handle.resize(self.data_end)
+        self.free_space.clear()
+        self.data_end = data_end
+        handle.resize(data_end)
 
     # -----------------------------------------------------------
 
@@ -790,6 +1660,8 @@ class DataFile (object):
         if self.handle is None:
             return
 
+        self._load_all()
+
         file_size = self.handle.size()
 
         if self.data_begin > file_size:
@@ -824,7 +1696,6 @@ class DataFile (object):
         items = sorted(self.id2data.items(), key=lambda item: item[1].offset)
 
         last_meta_offset = self._META_TABLE_OFFSET
-        last_data_offset = self.data_begin
 
         for data_id, meta in items:
             if meta.id != data_id:
@@ -851,22 +1722,21 @@ class DataFile (object):
                     "meta.offset(%s) != last_meta_offset(%s)" %
                     (meta.offset, last_meta_offset))
 
-            if meta.data_offset != last_data_offset:
+            if meta.data_offset < self.data_begin:
                 raise AssertionError(
-                    "meta.data_offset(%s) != last_data_offset(%s)" %
-                    (meta.data_offset, last_data_offset))
+                    "meta.data_offset(%s) < self.data_begin(%s)" %
+                    (meta.data_offset, self.data_begin))
 
-            if meta.data_offset >= self.data_end:
+            if (meta.data_offset + meta.data_capacity) > self.data_end:
                 raise AssertionError(
-                    "meta.data_offset(%s) >= self.data_end(%s)" %
-                    (meta.data_offset, self.data_end))
+                    "meta data end(%s) > self.data_end(%s)" %
+                    (meta.data_offset + meta.data_capacity, self.data_end))
 
             if (meta.data_offset + meta.data_size) > file_size:
                 raise AssertionError(
                     "(meta.data_offset + meta.data_size)(%s) > file_size(%s)" %
                     ((meta.data_offset + meta.data_size), file_size))
 
-            last_data_offset += meta.data_capacity
             last_meta_offset += MetaData.size
 
         # -----------------------------------------------------------
@@ -875,10 +1745,37 @@ class DataFile (object):
             raise AssertionError("last_meta_offset(%s) != self.meta_end(%s)" %
                                  (last_meta_offset, self.meta_end))
 
+        offset2meta = dict((meta.offset, meta) for data_id, meta in items)
+        if offset2meta != self.offset2meta:
+            raise AssertionError("offset2meta(%s) != self.offset2meta(%s)" %
+                                 (offset2meta, self.offset2meta))
+
+        # -----------------------------------------------------------
+        # data chunks and free chunks must cover the whole data area
+
+        chunks = [(meta.data_offset, meta.data_capacity)
+                  for meta in self.id2data.values()]
+        chunks += list(self.free_space)
+        chunks.sort()
+
+        last_data_offset = self.data_begin
+        for data_offset, data_capacity in chunks:
+            if data_offset != last_data_offset:
+                raise AssertionError(
+                    "data_offset(%s) != last_data_offset(%s)" %
+                    (data_offset, last_data_offset))
+
+            last_data_offset += data_capacity
+
         if last_data_offset != self.data_end:
             raise AssertionError("last_data_offset(%s) != self.data_end(%s)" %
                                  (last_data_offset, self.data_end))
 
+        free_size = sum(size for offset, size in self.free_space)
+        if free_size != self.free_space.size:
+            raise AssertionError("free_size(%s) != free_space.size(%s)" %
+                                 (free_size, self.free_space.size))
+
         # -----------------------------------------------------------
 
         for key, data_id in self.key2id.items():
@@ -901,6 +1798,11 @@ class DataFile (object):
                 raise AssertionError("meta.id(%s) != stored_meta.id(%s)" %
                                      (meta.id, stored_meta.id))
 
+            if meta.data_offset != stored_meta.data_offset:
+                raise AssertionError(
+                    "meta.data_offset(%s) != stored_meta.data_offset(%s)" %
+                    (meta.data_offset, stored_meta.data_offset))
+
             if meta.data_size != stored_meta.data_size:
                 raise AssertionError(
                     "meta.data_size(%s) != stored_meta.data_size(%s)" %
@@ -26,6 +26,7 @@ import itertools
 from aql.util_types import to_sequence
 
 from .aql_utils import equal_function_args
+from .aql_trace import trace_span
 
 __all__ = (
     'EVENT_WARNING', 'EVENT_STATUS', 'EVENT_DEBUG', 'EVENT_ALL',
@@ -168,8 +169,9 @@ class EventManager(object):
         user_handlers = self.user_handlers.get(event, [])
 
         args = (self.settings,) + args
-        for handler in itertools.chain(user_handlers, default_handlers):
-            handler(*args, **kw)
+        with trace_span(event, 'event'):
+            for handler in itertools.chain(user_handlers, default_handlers):
+                handler(*args, **kw)
 
     # -----------------------------------------------------------
 
@@ -0,0 +1,417 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import time
+import stat
+import errno
+import select
+import struct
+
+__all__ = (
+    'FileWatcher', 'InotifyFileWatcher', 'PollingFileWatcher',
+    'get_files_state', 'get_changed_files',
+)
+
+# ==============================================================================
+
+_fs_encode = getattr(os, 'fsencode', lambda path: path)
+_fs_decode = getattr(os, 'fsdecode', lambda path: path)
+
+# ==============================================================================
+
+
+def _get_end_time(timeout):
+    if timeout is None:
+        return None
+
+    return time.time() + timeout
+
+# ==============================================================================
+
+
+def _get_wait_time(end_time, default=None):
+    if end_time is None:
+        return default
+
+    wait_time = max(0, end_time - time.time())
+
+    if default is not None:
+        wait_time = min(wait_time, default)
+
+    return wait_time
+
+# ==============================================================================
+
+
+def _get_watched_files(filenames):
+    return frozenset(os.path.normcase(os.path.abspath(filename))
+                     for filename in filenames)
+
+# ==============================================================================
+#   Polling implementation
+# ==============================================================================
+
+
+def _get_file_state(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return stat.st_mtime, stat.st_size, stat.st_ino, stat.st_mode
+
+
+def _is_dir_state(state):
+    return (state is not None) and stat.S_ISDIR(state[3])
+
+
+def _get_dir_entries(dir_name):
+    try:
+        names = os.listdir(dir_name)
+    except OSError:
+        return None
+
+    return frozenset(os.path.normcase(os.path.join(dir_name, name))
+                     for name in names)
+
+
+def get_files_state(filenames):
+    """
+    Returns a snapshot of states of files to find their changes later.
+    Directories are compared by their entries.
+    """
+    files_state = {}
+
+    for filename in _get_watched_files(filenames):
+        state = _get_file_state(filename)
+        if _is_dir_state(state):
+            state = _get_dir_entries(filename)
+
+        files_state[filename] = state
+
+    return files_state
+
+
+def get_changed_files(filenames, files_state, since_time, exclude_files=()):
+    """
+    Returns files which have been changed after the snapshot of their state.
+    Files which are not in the snapshot are changed
+    if they have been modified since the specified time.
+    Excluded files and directory entries are ignored.
+    """
+    changed = set()
+
+    exclude_files = _get_watched_files(exclude_files)
+
+    for filename in _get_watched_files(filenames) - exclude_files:
+        state = _get_file_state(filename)
+
+        try:
+            prev_state = files_state[filename]
+        except KeyError:
+            if (state is not None) and not _is_dir_state(state) and \
+               (state[0] >= since_time):
+                changed.add(filename)
+
+            continue
+
+        if isinstance(prev_state, frozenset):
+            entries = _get_dir_entries(filename)
+            if (entries is None) or \
+               ((entries ^ prev_state) - exclude_files):
+                changed.add(filename)
+
+        elif prev_state != state:
+            changed.add(filename)
+
+    return changed
+
+
+class PollingFileWatcher (object):
+
+    __slots__ = ('files', 'debounce', 'interval')
+
+    def __init__(self, filenames, debounce=0.2, interval=0.5):
+        self.files = dict((filename, _get_file_state(filename))
+                          for filename in _get_watched_files(filenames))
+        self.debounce = debounce
+        self.interval = interval
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    # -----------------------------------------------------------
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        self.files = {}
+
+    # -----------------------------------------------------------
+
+    def _get_changes(self):
+        changed = set()
+
+        files = self.files
+        for filename, state in files.items():
+            new_state = _get_file_state(filename)
+            if new_state != state:
+                files[filename] = new_state
+                changed.add(filename)
+
+        return changed
+
+    # -----------------------------------------------------------
+
+    def wait(self, timeout=None):
+        end_time = _get_end_time(timeout)
+
+        changed = set()
+
+        while True:
+            if changed:
+                time.sleep(self.debounce)
+            else:
+                wait_time = _get_wait_time(end_time, self.interval)
+                if wait_time == 0:
+                    return changed
+
+                time.sleep(wait_time)
+
+            new_changed = self._get_changes()
+
+            if changed and not new_changed:
+                return changed
+
+            changed.update(new_changed)
+
+
+# ==============================================================================
+#   Linux inotify implementation
+# ==============================================================================
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ONLYDIR = 0x01000000
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+
+# changes of directory entries
+_IN_DIR_MASK = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | \
+    _IN_DELETE_SELF | _IN_MOVE_SELF
+
+_IN_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | \
+    _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | \
+    _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR
+
+_IN_EVENT_STRUCT = struct.Struct('iIII')
+
+_IN_READ_SIZE = 0x10000
+
+# ==============================================================================
+
+
+def _load_inotify():
+    import ctypes
+    import ctypes.util
+
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        raise OSError(errno.ENOSYS, "C library is not found")
+
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+
+    try:
+        inotify_init = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "inotify is not supported")
+
+    inotify_init.argtypes = [ctypes.c_int]
+    inotify_init.restype = ctypes.c_int
+
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                  ctypes.c_uint32]
+    inotify_add_watch.restype = ctypes.c_int
+
+    return inotify_init, inotify_add_watch, ctypes.get_errno
+
+# ==============================================================================
+
+
+class InotifyFileWatcher (object):
+
+    __slots__ = ('fd', 'files', 'dirs', 'debounce')
+
+    def __init__(self, filenames, debounce=0.2):
+        inotify_init, inotify_add_watch, get_errno = _load_inotify()
+
+        self.files = files = _get_watched_files(filenames)
+        self.dirs = dirs = {}
+        self.debounce = debounce
+
+        self.fd = fd = inotify_init(_IN_CLOEXEC | _IN_NONBLOCK)
+        if fd < 0:
+            err = get_errno()
+            raise OSError(err, os.strerror(err))
+
+        watch_dirs = set(os.path.dirname(filename) for filename in files)
+        # changes inside of watched directories change them as well
+        watch_dirs.update(filter(os.path.isdir, files))
+
+        try:
+            for dir_name in watch_dirs:
+                wd = inotify_add_watch(fd, _fs_encode(dir_name),
+                                       _IN_WATCH_MASK)
+                if wd >= 0:
+                    dirs[wd] = dir_name
+                    continue
+
+                err = get_errno()
+                # a missing directory can't contain watched files
+                if err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    raise OSError(err, os.strerror(err))
+        except Exception:
+            self.close()
+            raise
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    # -----------------------------------------------------------
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        fd = self.fd
+        if fd >= 0:
+            self.fd = -1
+            os.close(fd)
+
+    # -----------------------------------------------------------
+
+    def _add_event_changes(self, wd, mask, name, changed):
+        files = self.files
+
+        if mask & _IN_Q_OVERFLOW:
+            # some events are lost
+            changed.update(files)
+            return
+
+        dir_name = self.dirs.get(wd, None)
+        if dir_name is None:
+            return
+
+        if (mask & _IN_DIR_MASK) and (dir_name in files):
+            changed.add(dir_name)
+
+        if name:
+            filename = os.path.normcase(
+                os.path.join(dir_name, _fs_decode(name)))
+            if filename in files:
+                changed.add(filename)
+
+        elif mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+            dir_name += os.path.sep
+            changed.update(filename for filename in files
+                           if filename.startswith(dir_name))
+
+    # -----------------------------------------------------------
+
+    def _read_changes(self, changed):
+        try:
+            data = os.read(self.fd, _IN_READ_SIZE)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        event_size = _IN_EVENT_STRUCT.size
+        unpack_event = _IN_EVENT_STRUCT.unpack_from
+
+        pos = 0
+        data_size = len(data)
+
+        while pos < data_size:
+            wd, mask, cookie, name_size = unpack_event(data, pos)
+            pos += event_size
+
+            name = data[pos: pos + name_size].rstrip(b'\0')
+            pos += name_size
+
+            self._add_event_changes(wd, mask, name, changed)
+
+    # -----------------------------------------------------------
+
+    def wait(self, timeout=None):
+        end_time = _get_end_time(timeout)
+
+        changed = set()
+        fds = [self.fd]
+
+        while True:
+            if changed:
+                # coalesce a burst of events
+                wait_time = self.debounce
+            else:
+                wait_time = _get_wait_time(end_time)
+
+            try:
+                ready = select.select(fds, [], [], wait_time)[0]
+            except (OSError, select.error) as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            if not ready:
+                return changed
+
+            self._read_changes(changed)
+
+# ==============================================================================
+
+
+def FileWatcher(filenames, debounce=0.2):
+    try:
+        return InotifyFileWatcher(filenames, debounce=debounce)
+    except OSError:
+        # inotify is not available or out of watches
+        return PollingFileWatcher(filenames, debounce=debounce)
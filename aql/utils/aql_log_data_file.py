@@ -0,0 +1,732 @@
+#
+# Copyright (c) 2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import uuid
+import zlib
+import struct
+import marshal
+import operator
+
+from .aql_utils import open_file, read_bin_file, write_bin_file
+
+__all__ = ('LogDataFile', )
+
+# ==============================================================================
+
+
+class ErrorDataFileFormatInvalid(Exception):
+
+    def __init__(self):
+        msg = "Data file format is not valid."
+        super(ErrorDataFileFormatInvalid, self).__init__(msg)
+
+
+# ==============================================================================
+
+_RECORD_PUT = 1
+_RECORD_REMOVE = 2
+
+# ==============================================================================
+
+
+def _replace_file(src_filename, dst_filename):
+    try:
+        os.replace(src_filename, dst_filename)
+    except AttributeError:
+        if os.path.isfile(dst_filename):
+            os.remove(dst_filename)
+        os.rename(src_filename, dst_filename)
+
+# ==============================================================================
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+# ==============================================================================
+
+
+class LogDataFile (object):
+    """
+    Append-only data file.
+    Each write or remove appends a record to the end of the file.
+    The index of records is kept in memory and saved to a snapshot file,
+    so only records appended after the snapshot are scanned on opening.
+    Superseded records are removed by compaction.
+    """
+
+    __slots__ = (
+        'filename',
+        'stream',
+        'log_id',
+        'next_key',
+        'id2data',
+        'key2id',
+        'buffer',
+        'flushed_end',
+        'garbage_size',
+        'unsaved_records',
+    )
+
+    # +-----------------------------------+
+    # |8 bytes (MAGIC TAG)                |
+    # +-----------------------------------+
+    # |4 bytes (file version)             |
+    # +-----------------------------------+
+    # |16 bytes (unique id of the log)    |
+    # +-----------------------------------+
+    # |8 bytes (last key before the log)  |
+    # +-----------------------------------+
+    # | record1                           |
+    # +-----------------------------------+
+    #           .......
+    # +-----------------------------------+
+    # | record_n                          |
+    # +-----------------------------------+
+    #
+    # Record:
+    #   1 byte (type), 8 bytes (key), 16 bytes (id), 4 bytes (data size),
+    #   4 bytes (CRC32 of the record), data
+    #
+    # The version differs from versions of DataFile,
+    # so a file of another format is reinitialized
+
+    MAGIC_TAG = b".AQL.DB."
+    VERSION = 0x100
+
+    # the snapshot of the index is saved after this number of records
+    SNAPSHOT_RECORDS = 16384
+
+    # the write buffer is flushed when it exceeds this size
+    BUFFER_SIZE = 256 * 1024
+
+    # the file is compacted when superseded records exceed the ratio
+    COMPACT_RATIO = 0.5
+    COMPACT_MIN_SIZE = 1024 * 1024
+
+    _HEADER_STRUCT = struct.Struct(">8sL16sQ")
+    _HEADER_SIZE = _HEADER_STRUCT.size
+
+    _RECORD_STRUCT = struct.Struct(">BQ16sL")
+    _RECORD_SIZE = _RECORD_STRUCT.size
+
+    _CRC_STRUCT = struct.Struct(">L")
+    _CRC_SIZE = _CRC_STRUCT.size
+
+    _SNAPSHOT_VERSION = 1
+
+    # -----------------------------------------------------------
+
+    def __init__(self, filename, force=False):
+
+        self.filename = None
+        self.stream = None
+        self.log_id = None
+        self.next_key = 0
+        self.id2data = {}
+        self.key2id = {}
+        self.buffer = bytearray()
+        self.flushed_end = 0
+        self.garbage_size = 0
+        self.unsaved_records = 0
+
+        self.open(filename, force=force)
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def open(self, filename, force=False):
+        self.close()
+
+        self.stream = open_file(filename, write=True, binary=True)
+        self.filename = filename
+
+        try:
+            if self._read_header(force):
+                self._load_snapshot()
+                self._load_records()
+            else:
+                self._reset_log()
+
+        except Exception:
+            self.close()
+            raise
+
+    # -----------------------------------------------------------
+
+    def close(self):
+
+        if self.stream is not None:
+            try:
+                if self._need_compact():
+                    self.compact()
+                else:
+                    self._flush()
+                    if self.unsaved_records:
+                        self._save_snapshot()
+            finally:
+                self.stream.close()
+                self.stream = None
+
+        self.filename = None
+        self.log_id = None
+        self.next_key = 0
+        self.id2data.clear()
+        self.key2id.clear()
+        self.buffer = bytearray()
+        self.flushed_end = 0
+        self.garbage_size = 0
+        self.unsaved_records = 0
+
+    # -----------------------------------------------------------
+
+    def flush(self):
+        if self.stream is not None:
+            self._flush()
+
+    # -----------------------------------------------------------
+
+    def clear(self):
+        self._reset_log()
+
+    # -----------------------------------------------------------
+
+    def _get_snapshot_filename(self):
+        return self.filename + '.idx'
+
+    # -----------------------------------------------------------
+
+    def _read_header(self, force, header_struct=_HEADER_STRUCT):
+        """
+        Returns False if the file should be initialized
+        """
+
+        stream = self.stream
+        stream.seek(0)
+        header = stream.read(header_struct.size)
+
+        try:
+            tag, version, log_id, last_key = header_struct.unpack(header)
+        except struct.error:
+            if (header and header != b'\0') and \
+               (header[:len(self.MAGIC_TAG)] != self.MAGIC_TAG) and not force:
+                raise ErrorDataFileFormatInvalid()
+
+            return False
+
+        if tag != self.MAGIC_TAG:
+            if not force:
+                raise ErrorDataFileFormatInvalid()
+
+            return False
+
+        if version != self.VERSION:
+            return False
+
+        self.log_id = log_id
+        self.next_key = last_key
+        self.flushed_end = header_struct.size
+
+        return True
+
+    # -----------------------------------------------------------
+
+    def _write_header(self, stream, header_struct=_HEADER_STRUCT):
+        header = header_struct.pack(self.MAGIC_TAG, self.VERSION,
+                                    self.log_id, self.next_key)
+        stream.seek(0)
+        stream.write(header)
+
+    # -----------------------------------------------------------
+
+    def _reset_log(self):
+        _remove_file(self._get_snapshot_filename())
+
+        self.log_id = uuid.uuid4().bytes
+        self.id2data.clear()
+        self.key2id.clear()
+        self.buffer = bytearray()
+        self.garbage_size = 0
+        self.unsaved_records = 0
+
+        stream = self.stream
+        self._write_header(stream)
+        self.flushed_end = stream.tell()
+        stream.truncate(self.flushed_end)
+        stream.flush()
+
+    # -----------------------------------------------------------
+
+    def _load_snapshot(self):
+
+        try:
+            snapshot = marshal.loads(
+                read_bin_file(self._get_snapshot_filename()))
+
+            version, log_id, log_end, next_key, garbage_size, id2data = \
+                snapshot
+
+        except Exception:
+            # the snapshot doesn't exist or it's corrupted
+            return
+
+        if (version != self._SNAPSHOT_VERSION) or \
+           (log_id != self.log_id) or \
+           (log_end > self.stream.seek(0, os.SEEK_END)) or \
+           not isinstance(id2data, dict):
+            return
+
+        self.flushed_end = log_end
+        self.next_key = next_key
+        self.garbage_size = garbage_size
+        self.id2data = id2data
+        self.key2id = dict((data[0], data_id)
+                           for data_id, data in id2data.items() if data[0])
+
+    # -----------------------------------------------------------
+
+    def _save_snapshot(self):
+        snapshot = (self._SNAPSHOT_VERSION, self.log_id, self.flushed_end,
+                    self.next_key, self.garbage_size, self.id2data)
+
+        filename = self._get_snapshot_filename()
+        tmp_filename = filename + '.tmp'
+
+        try:
+            write_bin_file(tmp_filename, marshal.dumps(snapshot))
+            _replace_file(tmp_filename, filename)
+
+        except (OSError, IOError):
+            # the snapshot is optional, records will be scanned next time
+            _remove_file(tmp_filename)
+            return
+
+        self.unsaved_records = 0
+
+    # -----------------------------------------------------------
+
+    @staticmethod
+    def _decode_record(dump, pos,
+                       unpack_record=_RECORD_STRUCT.unpack_from,
+                       unpack_crc=_CRC_STRUCT.unpack_from,
+                       record_size=_RECORD_SIZE,
+                       header_size=_RECORD_SIZE + _CRC_SIZE,
+                       crc32=zlib.crc32):
+        """
+        Returns the record at the position
+        or None if it's partially written or corrupted
+        """
+        if (pos + header_size) > len(dump):
+            return None
+
+        record_type, key, data_id, data_size = unpack_record(dump, pos)
+        data_offset = pos + header_size
+        record_end = data_offset + data_size
+
+        if (record_end > len(dump)) or \
+           (record_type not in (_RECORD_PUT, _RECORD_REMOVE)):
+            return None
+
+        crc, = unpack_crc(dump, pos + record_size)
+        record_crc = crc32(dump[data_offset: record_end],
+                           crc32(dump[pos: pos + record_size]))
+
+        if crc != (record_crc & 0xFFFFFFFF):
+            return None
+
+        return record_type, key, data_id, data_offset, data_size
+
+    # -----------------------------------------------------------
+
+    def _load_records(self, header_size=_RECORD_SIZE + _CRC_SIZE):
+
+        stream = self.stream
+        log_end = self.flushed_end
+
+        stream.seek(log_end)
+        dump = stream.read()
+
+        id2data = self.id2data
+        key2id = self.key2id
+        next_key = self.next_key
+        garbage_size = self.garbage_size
+        num_records = 0
+
+        decode_record = self._decode_record
+
+        pos = 0
+
+        while True:
+            record = decode_record(dump, pos)
+            if record is None:
+                break
+
+            record_type, key, data_id, data_offset, data_size = record
+            record_end = data_offset + data_size
+
+            if next_key < key:
+                next_key = key
+
+            data = id2data.pop(data_id, None)
+            if data is not None:
+                garbage_size += header_size + data[2]
+                if data[0]:
+                    del key2id[data[0]]
+
+            if record_type == _RECORD_PUT:
+                id2data[data_id] = (key, log_end + data_offset, data_size)
+                if key:
+                    key2id[key] = data_id
+            else:
+                garbage_size += header_size
+
+            pos = record_end
+            num_records += 1
+
+        self.next_key = next_key
+        self.garbage_size = garbage_size
+        self.flushed_end = log_end + pos
+        self.unsaved_records = num_records
+
+        if pos != len(dump):
+            # cut off the partially written or corrupted tail
+            stream.truncate(self.flushed_end)
+
+    # -----------------------------------------------------------
+
+    def _flush(self):
+        buffer = self.buffer
+        if buffer:
+            stream = self.stream
+            stream.seek(self.flushed_end)
+            stream.write(buffer)
+            stream.flush()
+
+            self.flushed_end += len(buffer)
+            self.buffer = bytearray()
+
+    # -----------------------------------------------------------
+
+    def _append(self, record_type, key, data_id, data,
+                record_struct=_RECORD_STRUCT,
+                crc_struct=_CRC_STRUCT,
+                crc32=zlib.crc32):
+
+        record = record_struct.pack(record_type, key, data_id, len(data))
+        crc = crc32(data, crc32(record)) & 0xFFFFFFFF
+
+        buffer = self.buffer
+        buffer += record
+        buffer += crc_struct.pack(crc)
+
+        data_offset = self.flushed_end + len(buffer)
+
+        buffer += data
+
+        old_data = self.id2data.pop(data_id, None)
+        if old_data is not None:
+            self.garbage_size += self._RECORD_SIZE + self._CRC_SIZE + \
+                old_data[2]
+
+        if len(buffer) > self.BUFFER_SIZE:
+            self._flush()
+
+        self.unsaved_records += 1
+
+        return data_offset
+
+    # -----------------------------------------------------------
+
+    def _check_snapshot(self):
+        # it's called after the index is updated by the appended record
+        if self.unsaved_records >= self.SNAPSHOT_RECORDS:
+            self._flush()
+            self._save_snapshot()
+
+    # -----------------------------------------------------------
+
+    def read(self, data_id):
+        try:
+            key, data_offset, data_size = self.id2data[data_id]
+        except KeyError:
+            return None
+
+        flushed_end = self.flushed_end
+        if data_offset >= flushed_end:
+            data_offset -= flushed_end
+            return bytes(self.buffer[data_offset: data_offset + data_size])
+
+        stream = self.stream
+        stream.seek(data_offset)
+        return stream.read(data_size)
+
+    # -----------------------------------------------------------
+
+    def read_many(self, data_ids):
+        return list(map(self.read, data_ids))
+
+    # -----------------------------------------------------------
+
+    def read_views(self, data_ids):
+        for data_id in data_ids:
+            yield self.read(data_id)
+
+    # -----------------------------------------------------------
+
+    def write(self, data_id, data):
+
+        old_data = self.id2data.get(data_id)
+        key = old_data[0] if old_data is not None else 0
+
+        self._write(key, data_id, data)
+
+    # -----------------------------------------------------------
+
+    def _write(self, key, data_id, data):
+        data_offset = self._append(_RECORD_PUT, key, data_id, data)
+        self.id2data[data_id] = (key, data_offset, len(data))
+        self._check_snapshot()
+
+    # -----------------------------------------------------------
+
+    def write_with_key(self, data_id, data):
+
+        old_data = self.id2data.get(data_id)
+        if (old_data is not None) and old_data[0]:
+            del self.key2id[old_data[0]]
+
+        self.next_key += 1
+        key = self.next_key
+
+        self._write(key, data_id, data)
+        self.key2id[key] = data_id
+
+        return key
+
+    # -----------------------------------------------------------
+
+    def write_many(self, items):
+        """
+        Writes a batch of (data_id, data) items
+        """
+
+        write = self.write
+        for data_id, data in items:
+            write(data_id, data)
+
+    # -----------------------------------------------------------
+
+    def write_with_keys(self, items):
+        """
+        Writes a batch of (data_id, data) items with new keys.
+        Returns keys of the items.
+        """
+
+        write = self.write_with_key
+        return [write(data_id, data) for data_id, data in items]
+    # -----------------------------------------------------------
+
+    def get_ids(self, keys):
+        try:
+            return tuple(map(self.key2id.__getitem__, keys))
+        except KeyError:
+            return None
+
+    # -----------------------------------------------------------
+
+    def get_keys(self, data_ids):
+        return map(operator.itemgetter(0),
+                   map(self.id2data.__getitem__, data_ids))
+
+    # -----------------------------------------------------------
+
+    def get_all_ids(self):
+        return list(self.id2data)
+
+    # -----------------------------------------------------------
+
+    def remove(self, data_ids):
+
+        id2data = self.id2data
+        key2id = self.key2id
+
+        for data_id in data_ids:
+            data = id2data.get(data_id)
+            if data is not None:
+                key = data[0]
+                if key:
+                    del key2id[key]
+
+                self._append(_RECORD_REMOVE, key, data_id, b'')
+                self.garbage_size += self._RECORD_SIZE + self._CRC_SIZE
+                self._check_snapshot()
+
+    # -----------------------------------------------------------
+
+    def _need_compact(self):
+        garbage_size = self.garbage_size
+        if garbage_size < self.COMPACT_MIN_SIZE:
+            return False
+
+        log_size = self.flushed_end + len(self.buffer) - self._HEADER_SIZE
+        return garbage_size > (log_size * self.COMPACT_RATIO)
+
+    # -----------------------------------------------------------
+
+    def compact(self,
+                record_struct=_RECORD_STRUCT,
+                crc_struct=_CRC_STRUCT,
+                crc32=zlib.crc32):
+        """
+        Rewrites the file with actual records only
+        """
+
+        self._flush()
+
+        filename = self.filename
+        tmp_filename = filename + '.tmp'
+
+        items = sorted(self.id2data.items(), key=lambda item: item[1][1])
+
+        stream = self.stream
+        id2data = {}
+
+        self.log_id = uuid.uuid4().bytes
+
+        with open_file(tmp_filename, write=True, binary=True,
+                       truncate=True) as tmp_stream:
+
+            self._write_header(tmp_stream)
+            offset = tmp_stream.tell()
+
+            header_size = self._RECORD_SIZE + self._CRC_SIZE
+
+            for data_id, (key, data_offset, data_size) in items:
+                stream.seek(data_offset)
+                data = stream.read(data_size)
+
+                record = record_struct.pack(_RECORD_PUT, key, data_id,
+                                            data_size)
+                crc = crc32(data, crc32(record)) & 0xFFFFFFFF
+
+                tmp_stream.write(record)
+                tmp_stream.write(crc_struct.pack(crc))
+                tmp_stream.write(data)
+
+                offset += header_size
+                id2data[data_id] = (key, offset, data_size)
+                offset += data_size
+
+        stream.close()
+        self.stream = None
+
+        _replace_file(tmp_filename, filename)
+
+        self.stream = open_file(filename, write=True, binary=True)
+
+        self.id2data = id2data
+        self.flushed_end = offset
+        self.garbage_size = 0
+
+        self._save_snapshot()
+
+    # -----------------------------------------------------------
+
+    def self_test(self):    # noqa
+        if self.stream is None:
+            if self.id2data:
+                raise AssertionError("id2data is not empty")
+
+            if self.key2id:
+                raise AssertionError("key2id is not empty")
+
+            return
+
+        for key, data_id in self.key2id.items():
+            if self.id2data[data_id][0] != key:
+                raise AssertionError("key(%s) != self.id2data[data_id](%s)" %
+                                     (key, self.id2data[data_id]))
+
+        if len(self.key2id) != \
+                sum(1 for data in self.id2data.values() if data[0]):
+            raise AssertionError("keys of key2id and id2data are different")
+
+        # load all records from the file and compare them with the index
+        self._flush()
+
+        log = LogDataFile.__new__(LogDataFile)
+        log.stream = self.stream
+        log.id2data = {}
+        log.key2id = {}
+        log.garbage_size = 0
+
+        if not log._read_header(force=False):
+            raise AssertionError("Invalid header")
+
+        log._load_records()
+
+        if log.log_id != self.log_id:
+            raise AssertionError("log.log_id(%r) != self.log_id(%r)" %
+                                 (log.log_id, self.log_id))
+
+        if log.flushed_end != self.flushed_end:
+            raise AssertionError(
+                "log.flushed_end(%s) != self.flushed_end(%s)" %
+                (log.flushed_end, self.flushed_end))
+
+        if log.id2data != self.id2data:
+            raise AssertionError("log.id2data != self.id2data")
+
+        if log.key2id != self.key2id:
+            raise AssertionError("log.key2id(%s) != self.key2id(%s)" %
+                                 (log.key2id, self.key2id))
+
+        if log.garbage_size != self.garbage_size:
+            raise AssertionError(
+                "log.garbage_size(%s) != self.garbage_size(%s)" %
+                (log.garbage_size, self.garbage_size))
+
+        if log.next_key != self.next_key:
+            raise AssertionError("log.next_key(%s) != self.next_key(%s)" %
+                                 (log.next_key, self.next_key))
+
+        for data_id, (key, data_offset, data_size) in self.id2data.items():
+            if data_offset < self._HEADER_SIZE:
+                raise AssertionError(
+                    "data_offset(%s) < header size(%s)" %
+                    (data_offset, self._HEADER_SIZE))
+
+            if (data_offset + data_size) > self.flushed_end:
+                raise AssertionError(
+                    "data end(%s) > self.flushed_end(%s)" %
+                    (data_offset + data_size, self.flushed_end))
@@ -24,7 +24,7 @@ import logging
 
 __all__ = (
     'set_log_level', 'log_critical', 'log_warning', 'log_error', 'log_debug',
-    'log_info', 'add_log_handler',
+    'log_info', 'add_log_handler', 'set_log_stream',
     'LOG_CRITICAL', 'LOG_WARNING', 'LOG_ERROR', 'LOG_DEBUG', 'LOG_INFO',
 )
 
@@ -70,6 +70,7 @@ def _make_aql_logger():
 # -------------------------------------------------------------------------------
 
 _logger = _make_aql_logger()
+_log_handler = _logger.handlers[0]
 
 set_log_level = _logger.setLevel
 log_critical = _logger.critical
@@ -80,3 +81,18 @@ log_debug = _logger.debug
 add_log_handler = _logger.addHandler
 
 # -------------------------------------------------------------------------------
+
+
+def set_log_stream(stream):
+    """
+    Redirects log messages to the stream. Returns the previous stream.
+    """
+    _log_handler.acquire()
+    try:
+        _log_handler.flush()
+        previous_stream = _log_handler.stream
+        _log_handler.stream = stream
+    finally:
+        _log_handler.release()
+
+    return previous_stream
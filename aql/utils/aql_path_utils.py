@@ -33,7 +33,7 @@ except AttributeError:
     filterfalse = itertools.ifilterfalse
 
 
-from aql.util_types import is_string, to_sequence
+from aql.util_types import is_string, to_sequence, abs_path, set_work_dir
 
 from .aql_utils import ItemsGroups
 
@@ -43,7 +43,7 @@ __all__ = (
     'find_program', 'find_programs', 'find_optional_program',
     'find_optional_programs',
     'relative_join', 'relative_join_list', 'exclude_files_from_dirs',
-    'split_drive', 'group_paths_by_dir', 'Chdir',
+    'split_drive', 'group_paths_by_dir', 'Chdir', 'WorkDir',
 )
 
 # ==============================================================================
@@ -60,7 +60,7 @@ class ErrorNoPrograms(Exception):
 
 def abs_file_path(file_path, path_sep=os.path.sep,
                   seps=(os.path.sep, os.path.altsep),
-                  _abspath=os.path.abspath,
+                  _abspath=abs_path,
                   _normcase=os.path.normcase):
     if not file_path:
         file_path = '.'
@@ -88,10 +88,10 @@ def expand_file_path(path,
 def exclude_files_from_dirs(files, dirs):
     result = []
     folders = tuple(os.path.normcase(
-        os.path.abspath(folder)) + os.path.sep for folder in to_sequence(dirs))
+        abs_path(folder)) + os.path.sep for folder in to_sequence(dirs))
 
     for filename in to_sequence(files):
-        filename = os.path.normcase(os.path.abspath(filename))
+        filename = os.path.normcase(abs_path(filename))
         if not filename.startswith(folders):
             result.append(filename)
 
@@ -136,7 +136,7 @@ def find_files(paths=".",
     path_join = os.path.join
 
     for path in paths:
-        for root, folders, files in os.walk(os.path.abspath(path)):
+        for root, folders, files in os.walk(abs_path(path)):
             for file_name in files:
                 file_name_nocase = os.path.normcase(file_name)
                 if (not match_exclude_mask(file_name_nocase)) and\
@@ -527,3 +527,23 @@ class Chdir (object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         os.chdir(self.previous_path)
         return False
+
+# ==============================================================================
+
+
+class WorkDir (object):
+    """
+    Changes working directory of the current thread only.
+    Unlike Chdir it's safe to be used in several threads.
+    """
+    __slots__ = ('previous_path', )
+
+    def __init__(self, path):
+        self.previous_path = set_work_dir(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        set_work_dir(self.previous_path)
+        return False
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import socket
+import struct
+
+__all__ = ('send_message', 'recv_message', 'parse_socket_address')
+
+# ==============================================================================
+
+# A message is a header (kind, size) followed by data of the message
+_HEADER_STRUCT = struct.Struct(">BL")
+
+
+# ==============================================================================
+def send_message(conn, kind, data=b''):
+    conn.sendall(_HEADER_STRUCT.pack(kind, len(data)) + data)
+
+
+# ==============================================================================
+def _recv_data(conn, size):
+    chunks = []
+    while size > 0:
+        chunk = conn.recv(min(size, 0x10000))
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+# ==============================================================================
+def recv_message(conn):
+    """
+    Returns (kind, data) of the next message or (None, None) on EOF
+    """
+    header = _recv_data(conn, _HEADER_STRUCT.size)
+    if header is None:
+        return None, None
+
+    kind, size = _HEADER_STRUCT.unpack(header)
+
+    data = _recv_data(conn, size)
+    if data is None:
+        return None, None
+
+    return kind, data
+
+
+# ==============================================================================
+def parse_socket_address(address):
+    """
+    Returns (family, address) of 'host:port' or a path to Unix domain socket
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+
+    return getattr(socket, 'AF_UNIX', None), address
@@ -89,13 +89,28 @@ else:
 
 
 class SqlDataFile (object):
+    """
+    Data file based on SQLite.
+    Changes are committed in batches, keys are resolved on demand.
+    """
 
     __slots__ = (
         'id2key',
         'key2id',
         'connection',
+        'next_key',
+        'changes',
     )
 
+    # max number of cached keys
+    KEYS_CACHE_SIZE = 65536
+
+    # changes are committed after this number of records
+    COMMIT_CHANGES = 4096
+
+    # max number of parameters in one query
+    _QUERY_SIZE = 500
+
     # -----------------------------------------------------------
 
     def __init__(self, filename, force=False):
@@ -103,15 +118,19 @@ class SqlDataFile (object):
         self.id2key = {}
         self.key2id = {}
         self.connection = None
+        self.next_key = 0
+        self.changes = 0
 
         self.open(filename, force=force)
 
     # -----------------------------------------------------------
 
     def clear(self):
-        with self.connection as conn:
-            conn.execute("DELETE FROM items")
+        conn = self.connection
+        conn.execute("DELETE FROM items")
+        conn.commit()
 
+        self.changes = 0
         self.id2key.clear()
         self.key2id.clear()
 
@@ -125,15 +144,15 @@ class SqlDataFile (object):
 
     # -----------------------------------------------------------
 
-    def _load_ids(self, conn, blob_to_bytes=_blob_to_bytes):
+    @staticmethod
+    def _load_next_key(conn):
+        result = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name='items'").fetchone()
 
-        set_key = self.key2id.__setitem__
-        set_id = self.id2key.__setitem__
+        if result is None:
+            return 0
 
-        for key, data_id in conn.execute("SELECT key,id FROM items"):
-            data_id = blob_to_bytes(data_id)
-            set_key(key, data_id)
-            set_id(data_id, key)
+        return result[0]
 
     # -----------------------------------------------------------
 
@@ -154,8 +173,7 @@ class SqlDataFile (object):
             os.remove(filename)
             conn = self._open_connection(filename)
 
-        self._load_ids(conn)
-
+        self.next_key = self._load_next_key(conn)
         self.connection = conn
 
     # -----------------------------------------------------------
@@ -163,14 +181,25 @@ class SqlDataFile (object):
     def close(self):
 
         if self.connection is not None:
-            self.connection.close()
-            self.connection = None
+            try:
+                self.connection.commit()
+            finally:
+                self.connection.close()
+                self.connection = None
 
+        self.changes = 0
         self.id2key.clear()
         self.key2id.clear()
 
     # -----------------------------------------------------------
 
+    def flush(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.changes = 0
+
+    # -----------------------------------------------------------
+
     @staticmethod
     def _is_aql_db(filename):
 
@@ -188,8 +217,10 @@ class SqlDataFile (object):
         conn = None
 
         try:
+            # access from several threads is serialized by EntitiesFile
             conn = sqlite3.connect(filename,
-                                   detect_types=sqlite3.PARSE_DECLTYPES)
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False)
 
             with conn:
                 conn.execute(
@@ -210,11 +241,62 @@ class SqlDataFile (object):
             raise ErrorDataFileFormatInvalid(filename)
 
         conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA journal_mode=WAL")
 
         return conn
 
     # -----------------------------------------------------------
 
+    def _commit(self, changes):
+        self.changes += changes
+        if self.changes >= self.COMMIT_CHANGES:
+            self.changes = 0
+            self.connection.commit()
+
+    # -----------------------------------------------------------
+
+    def _cache_key(self, key, data_id):
+        id2key = self.id2key
+        key2id = self.key2id
+
+        old_key = id2key.pop(data_id, None)
+        if old_key is not None:
+            del key2id[old_key]
+
+        elif len(id2key) >= self.KEYS_CACHE_SIZE:
+            id2key.clear()
+            key2id.clear()
+
+        id2key[data_id] = key
+        key2id[key] = data_id
+
+    # -----------------------------------------------------------
+
+    def _uncache_id(self, data_id):
+        key = self.id2key.pop(data_id, None)
+        if key is not None:
+            del self.key2id[key]
+
+    # -----------------------------------------------------------
+
+    def _select(self, query, values, many_bytes_to_blob=_many_bytes_to_blob):
+        """
+        Runs the query with 'IN' clause for all values by chunks
+        """
+
+        execute = self.connection.execute
+        query_size = self._QUERY_SIZE
+
+        for pos in range(0, len(values), query_size):
+            chunk = values[pos: pos + query_size]
+            params = ','.join('?' * len(chunk))
+
+            for row in execute(query % params,
+                               tuple(many_bytes_to_blob(chunk))):
+                yield row
+
+    # -----------------------------------------------------------
+
     def read(self, data_id,
              bytes_to_blob=_bytes_to_blob,
              blob_to_bytes=_blob_to_bytes):
@@ -230,23 +312,62 @@ class SqlDataFile (object):
 
     # -----------------------------------------------------------
 
-    def write_with_key(self, data_id, data,
-                       bytes_to_blob=_bytes_to_blob):
+    def read_many(self, data_ids, blob_to_bytes=_blob_to_bytes):
+        """
+        Returns data of all ids, None for unknown ids
+        """
 
-        key = self.id2key.pop(data_id, None)
-        if key is not None:
-            del self.key2id[key]
+        data_ids = tuple(data_ids)
 
-        with self.connection as conn:
-            cur = conn.execute(
-                "INSERT OR REPLACE INTO items(id, data) VALUES (?,?)",
-                (bytes_to_blob(data_id), bytes_to_blob(data)))
+        id2data = dict(
+            (blob_to_bytes(data_id), blob_to_bytes(data))
+            for data_id, data in self._select(
+                "SELECT id, data FROM items WHERE id IN (%s)", data_ids))
 
-        key = cur.lastrowid
-        self.key2id[key] = data_id
-        self.id2key[data_id] = key
+        return [id2data.get(data_id) for data_id in data_ids]
 
-        return key
+    # -----------------------------------------------------------
+
+    def read_views(self, data_ids):
+        for data in self.read_many(data_ids):
+            yield data
+
+    # -----------------------------------------------------------
+
+    def write_with_keys(self, items, bytes_to_blob=_bytes_to_blob):
+        """
+        Writes a batch of (data_id, data) items.
+        Returns keys of the items.
+        """
+
+        rows = []
+        keys = []
+        key = self.next_key
+        cache_key = self._cache_key
+
+        for data_id, data in items:
+            key += 1
+            rows.append((key, bytes_to_blob(data_id), bytes_to_blob(data)))
+            keys.append(key)
+            cache_key(key, data_id)
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO items(key, id, data) VALUES (?,?,?)",
+            rows)
+
+        self.next_key = key
+        self._commit(len(rows))
+
+        return keys
+
+    # -----------------------------------------------------------
+
+    write_many = write_with_keys
+
+    # -----------------------------------------------------------
+
+    def write_with_key(self, data_id, data):
+        return self.write_with_keys(((data_id, data),))[0]
 
     # -----------------------------------------------------------
 
@@ -254,76 +375,103 @@ class SqlDataFile (object):
 
     # -----------------------------------------------------------
 
-    def get_ids(self, keys):
+    def get_ids(self, keys, blob_to_bytes=_blob_to_bytes):
+        keys = tuple(keys)
+
+        key2id = self.key2id.copy()
+
+        unknown_keys = tuple(key for key in keys if key not in key2id)
+        if unknown_keys:
+            rows = self._select("SELECT key, id FROM items WHERE key IN (%s)",
+                                unknown_keys)
+
+            for key, data_id in rows:
+                data_id = blob_to_bytes(data_id)
+                key2id[key] = data_id
+                self._cache_key(key, data_id)
+
         try:
-            return tuple(map(self.key2id.__getitem__, keys))
+            return tuple(map(key2id.__getitem__, keys))
         except KeyError:
             return None
 
     # -----------------------------------------------------------
 
-    def get_keys(self, data_ids):
-        return map(self.id2key.__getitem__, data_ids)
+    def get_keys(self, data_ids, blob_to_bytes=_blob_to_bytes):
+        data_ids = tuple(data_ids)
+
+        id2key = self.id2key.copy()
+
+        unknown_ids = tuple(data_id for data_id in data_ids
+                            if data_id not in id2key)
+        if unknown_ids:
+            rows = self._select("SELECT id, key FROM items WHERE id IN (%s)",
+                                unknown_ids)
+
+            for data_id, key in rows:
+                data_id = blob_to_bytes(data_id)
+                id2key[data_id] = key
+                self._cache_key(key, data_id)
+
+        return list(map(id2key.__getitem__, data_ids))
+
+    # -----------------------------------------------------------
+
+    def get_all_ids(self, blob_to_bytes=_blob_to_bytes):
+        items = self.connection.execute("SELECT id FROM items")
+        return [blob_to_bytes(data_id) for data_id, in items]
 
     # -----------------------------------------------------------
 
     def remove(self, data_ids, many_bytes_to_blob=_many_bytes_to_blob):
 
-        with self.connection as conn:
-            conn.executemany("DELETE FROM items WHERE id=?",
-                             zip(many_bytes_to_blob(data_ids)))
+        data_ids = tuple(data_ids)
 
-        get_key = self.id2key.__getitem__
-        del_key = self.key2id.__delitem__
-        del_id = self.id2key.__delitem__
+        self.connection.executemany("DELETE FROM items WHERE id=?",
+                                    zip(many_bytes_to_blob(data_ids)))
 
         for data_id in data_ids:
-            key = get_key(data_id)
-            del_key(key)
-            del_id(data_id)
+            self._uncache_id(data_id)
+
+        self._commit(len(data_ids))
 
     # -----------------------------------------------------------
 
-    def self_test(self, blob_to_bytes=_blob_to_bytes):  # noqa
+    def self_test(self, bytes_to_blob=_bytes_to_blob):  # noqa
+        if len(self.id2key) > self.KEYS_CACHE_SIZE:
+            raise AssertionError("len(id2key)(%s) > KEYS_CACHE_SIZE(%s)" %
+                                 (len(self.id2key), self.KEYS_CACHE_SIZE))
+
+        if len(self.id2key) != len(self.key2id):
+            raise AssertionError("len(id2key)(%s) != len(key2id)(%s)" %
+                                 (len(self.id2key), len(self.key2id)))
+
         if self.connection is None:
             if self.id2key:
                 raise AssertionError("id2key is not empty")
 
-            if self.key2id:
-                raise AssertionError("key2id is not empty")
-
             return
 
-        key2id = self.key2id.copy()
-        id2key = self.id2key.copy()
-
-        items = self.connection.execute("SELECT key,id FROM items")
+        execute = self.connection.execute
 
-        for key, data_id in items:
-
-            data_id = blob_to_bytes(data_id)
-
-            d = key2id.pop(key, None)
-
-            if d is None:
-                raise AssertionError("key(%s) not in key2id" % (key,))
+        for data_id, key in self.id2key.items():
 
+            d = self.key2id.get(key)
             if d != data_id:
-                raise AssertionError("data_id(%s) != d(%s)" %
-                                     (binascii.hexlify(data_id),
-                                      binascii.hexlify(d)))
+                raise AssertionError("key2id[%s] != data_id(%s)" %
+                                     (key, binascii.hexlify(data_id)))
 
-            k = id2key.pop(data_id, None)
+            row = execute("SELECT key FROM items WHERE id=?",
+                          (bytes_to_blob(data_id),)).fetchone()
 
-            if k is None:
-                raise AssertionError("data_id(%s) not in id2key" %
+            if row is None:
+                raise AssertionError("data_id(%s) not in items" %
                                      (binascii.hexlify(data_id),))
 
-            if k != key:
-                raise AssertionError("key(%s) != k(%s)" % (key, k))
-
-        if key2id:
-            raise AssertionError("unknown keys: %s" % (key2id,))
+            if row[0] != key:
+                raise AssertionError("key(%s) != k(%s)" % (key, row[0]))
 
-        if id2key:
-            raise AssertionError("unknown data_ids: %s" % (id2key,))
+        max_key = execute("SELECT MAX(key) FROM items").fetchone()[0]
+        if max_key is not None and max_key > self.next_key:
+            raise AssertionError("max_key(%s) > next_key(%s)" %
+                                 (max_key, self.next_key))
@@ -0,0 +1,244 @@
+#
+# Copyright (c) 2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import time
+import marshal
+
+from aql.util_types import to_unicode
+
+from .aql_utils import file_signature, read_bin_file, write_bin_file,\
+    get_signature_algorithm
+
+__all__ = (
+    'FileStatCache',
+    'open_file_stat_cache', 'close_file_stat_cache', 'cached_file_signature',
+)
+
+# ==============================================================================
+
+_FORMAT_VERSION = 1
+
+# A file may be changed again within the resolution of file system timestamps
+# without changing its stat, so signatures of recently modified files
+# are not cached
+_RACY_INTERVAL = 2.0
+
+# ==============================================================================
+
+
+def _get_stat_key(stat):
+    try:
+        mtime = stat.st_mtime_ns
+        ctime = stat.st_ctime_ns
+    except AttributeError:
+        mtime = stat.st_mtime
+        ctime = stat.st_ctime
+
+    return stat.st_dev, stat.st_ino, stat.st_size, mtime, ctime
+
+# ==============================================================================
+
+
+class FileStatCache (object):
+    """
+    Keeps signatures of files by their stat information
+    to avoid reading of unchanged files.
+    """
+
+    __slots__ = (
+        'filename',
+        'algorithm',
+        'items',
+        'changed',
+        'loaded',
+    )
+
+    # -----------------------------------------------------------
+
+    def __init__(self, filename=None):
+        self.filename = None
+        self.algorithm = get_signature_algorithm()
+        self.items = {}
+        self.changed = False
+
+        # (filename, stat key, algorithm, items) of the last closed cache,
+        # it allows to skip reading of the same file by a long living process
+        self.loaded = None
+
+        if filename:
+            self.open(filename)
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def open(self, filename):
+        self.close()
+
+        self.filename = filename
+
+        loaded = self.loaded
+        self.loaded = None
+
+        if (loaded is not None) and \
+           (loaded[0] == filename) and \
+           (loaded[2] == self.algorithm):
+            try:
+                stat_key = _get_stat_key(os.stat(filename))
+            except OSError:
+                stat_key = None
+
+            if stat_key == loaded[1]:
+                self.items = loaded[3]
+                return
+
+        try:
+            version, algorithm, items = marshal.loads(read_bin_file(filename))
+        except Exception:
+            # the cache doesn't exist or it's corrupted
+            return
+
+        if (version == _FORMAT_VERSION) and \
+           (algorithm == self.algorithm) and \
+           isinstance(items, dict):
+            self.items = items
+
+    # -----------------------------------------------------------
+
+    def save(self):
+        filename = self.filename
+        if not filename or not self.changed:
+            return
+
+        data = marshal.dumps((_FORMAT_VERSION, self.algorithm, self.items))
+
+        # write and rename to not corrupt the cache by concurrent builds
+        tmp_filename = "%s.%s.tmp" % (filename, os.getpid())
+
+        try:
+            write_bin_file(tmp_filename, data)
+
+            try:
+                os.replace(tmp_filename, filename)
+            except AttributeError:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                os.rename(tmp_filename, filename)
+
+        except (OSError, IOError):
+            # the cache is optional, it will be rebuilt next time
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+            return
+
+        self.changed = False
+
+    # -----------------------------------------------------------
+
+    def _keep_loaded(self):
+        filename = self.filename
+        if not filename or self.changed:
+            return
+
+        try:
+            stat_key = _get_stat_key(os.stat(filename))
+        except OSError:
+            return
+
+        self.loaded = (filename, stat_key, self.algorithm, self.items)
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        try:
+            self.save()
+            self._keep_loaded()
+        finally:
+            self.filename = None
+            self.algorithm = get_signature_algorithm()
+            self.items = {}
+            self.changed = False
+
+    # -----------------------------------------------------------
+
+    def clear(self):
+        if self.items:
+            self.items = {}
+            self.changed = True
+
+    # -----------------------------------------------------------
+
+    def __len__(self):
+        return len(self.items)
+
+    # -----------------------------------------------------------
+
+    def file_signature(self, filename, offset=0):
+
+        algorithm = get_signature_algorithm()
+        if self.algorithm != algorithm:
+            self.algorithm = algorithm
+            self.clear()
+
+        stat = os.stat(filename)
+        stat_key = _get_stat_key(stat)
+
+        key = (to_unicode(filename), offset)
+
+        item = self.items.get(key, None)
+        if (item is not None) and (item[0] == stat_key):
+            return item[1]
+
+        signature = file_signature(filename, offset)
+
+        if (time.time() - stat.st_mtime) > _RACY_INTERVAL:
+            self.items[key] = (stat_key, signature)
+            self.changed = True
+
+        return signature
+
+
+# ==============================================================================
+
+_FILE_STAT_CACHE = FileStatCache()
+
+
+def open_file_stat_cache(filename):
+    _FILE_STAT_CACHE.open(filename)
+
+
+def close_file_stat_cache():
+    _FILE_STAT_CACHE.close()
+
+
+def cached_file_signature(filename, offset=0):
+    return _FILE_STAT_CACHE.file_signature(filename, offset)
@@ -0,0 +1,252 @@
+#
+# Copyright (c) 2014-2015 The developers of Aqualid project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom
+# the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+#  OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import json
+import time
+import threading
+
+__all__ = (
+    'TraceFile',
+    'open_trace_file', 'close_trace_file', 'is_tracing',
+    'trace_span', 'trace_async_begin', 'trace_async_end',
+)
+
+# ==============================================================================
+
+
+def _get_time():
+    # trace events use microseconds
+    return int(time.time() * 1000000)
+
+# ==============================================================================
+
+
+class _NullSpan (object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# ==============================================================================
+
+
+class _TraceSpan (object):
+    __slots__ = (
+        'trace',
+        'name',
+        'category',
+        'args',
+        'start',
+    )
+
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        self.start = _get_time()
+        return self
+
+    # -----------------------------------------------------------
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        start = self.start
+        event = {'ph': 'X',
+                 'name': self.name,
+                 'cat': self.category,
+                 'ts': start,
+                 'dur': _get_time() - start}
+
+        args = self.args
+        if exc_type is not None:
+            args = dict(args or {})
+            args['error'] = exc_type.__name__
+
+        if args:
+            event['args'] = args
+
+        self.trace.add_event(event)
+        return False
+
+# ==============================================================================
+
+
+class TraceFile (object):
+    """
+    Collects Chrome trace events (chrome://tracing, Perfetto)
+    and writes them in JSON format on close.
+    """
+
+    __slots__ = (
+        'filename',
+        'events',
+        'lock',
+        'pid',
+        'threads',
+    )
+
+    # -----------------------------------------------------------
+
+    def __init__(self, filename=None):
+        self.filename = None
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.threads = set()
+
+        if filename:
+            self.open(filename)
+
+    # -----------------------------------------------------------
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # -----------------------------------------------------------
+
+    def open(self, filename):
+        self.close()
+
+        self.filename = filename
+        self.pid = os.getpid()
+
+    # -----------------------------------------------------------
+
+    def is_enabled(self):
+        return self.filename is not None
+
+    # -----------------------------------------------------------
+
+    def add_event(self, event):
+        thread = threading.current_thread()
+        tid = thread.ident
+
+        event['pid'] = self.pid
+        event['tid'] = tid
+
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({'ph': 'M',
+                                    'name': 'thread_name',
+                                    'pid': self.pid,
+                                    'tid': tid,
+                                    'args': {'name': thread.name}})
+
+            self.events.append(event)
+
+    # -----------------------------------------------------------
+
+    def span(self, name, category, args=None):
+        if self.filename is None:
+            return _NULL_SPAN
+
+        if callable(name):
+            name = name()
+
+        return _TraceSpan(self, name, category, args)
+
+    # -----------------------------------------------------------
+
+    def async_event(self, phase, event_id, name, category):
+        if self.filename is None:
+            return
+
+        if callable(name):
+            name = name()
+
+        self.add_event({'ph': phase,
+                        'name': name,
+                        'cat': category,
+                        'id': event_id,
+                        'ts': _get_time()})
+
+    # -----------------------------------------------------------
+
+    def save(self):
+        filename = self.filename
+        if not filename:
+            return
+
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.threads = set()
+
+        data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+        with open(filename, 'w') as trace_file:
+            json.dump(data, trace_file)
+
+    # -----------------------------------------------------------
+
+    def close(self):
+        try:
+            self.save()
+        finally:
+            self.filename = None
+            self.events = []
+            self.threads = set()
+
+
+# ==============================================================================
+
+_TRACE_FILE = TraceFile()
+
+
+def open_trace_file(filename):
+    _TRACE_FILE.open(filename)
+
+
+def close_trace_file():
+    _TRACE_FILE.close()
+
+
+def is_tracing():
+    return _TRACE_FILE.filename is not None
+
+
+def trace_span(name, category, args=None):
+    return _TRACE_FILE.span(name, category, args)
+
+
+def trace_async_begin(event_id, name, category):
+    _TRACE_FILE.async_event('b', event_id, name, category)
+
+
+def trace_async_end(event_id, name, category):
+    _TRACE_FILE.async_event('e', event_id, name, category)
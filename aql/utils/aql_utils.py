@@ -23,6 +23,7 @@
 import io
 import os
 import re
+import mmap
 import imp
 import sys
 import time
@@ -30,6 +31,8 @@ import types
 import errno
 import marshal
 import hashlib
+import binascii
+import functools
 import inspect
 import tempfile
 import traceback
@@ -46,6 +49,8 @@ __all__ = (
     'open_file', 'read_bin_file', 'read_text_file', 'write_bin_file',
     'write_text_file',
     'exec_file', 'remove_files', 'new_hash', 'dump_simple_object',
+    'set_signature_algorithm', 'get_signature_algorithm',
+    'get_signature_algorithms',
     'simple_object_signature', 'data_signature',
     'file_signature', 'file_time_signature', 'file_checksum',
     'load_module', 'load_package',
@@ -88,6 +93,15 @@ class ErrorUnmarshallableObject(Exception):
 
 # ==============================================================================
 
+
+class ErrorSignatureAlgorithmUnknown(Exception):
+
+    def __init__(self, name):
+        msg = "Unknown signature algorithm: '%s'" % (name, )
+        super(ErrorSignatureAlgorithmUnknown, self).__init__(msg)
+
+# ==============================================================================
+
 if hasattr(os, 'O_NOINHERIT'):
     _O_NOINHERIT = os.O_NOINHERIT
 else:
@@ -234,15 +248,133 @@ def simple_object_signature(obj, common_hash=None):
     return data_signature(data, common_hash)
 
 
+# ==============================================================================
+
+# size of all signatures and ids, it's fixed by the format of data files
+_SIGNATURE_SIZE = 16
+
+
+class _ShortHash (object):
+    """
+    Hash with a digest truncated to the size of signatures
+    """
+
+    __slots__ = ('hash',)
+
+    def __init__(self, hash_object):
+        self.hash = hash_object
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def digest(self):
+        return self.hash.digest()[:_SIGNATURE_SIZE]
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest()).decode('ascii')
+
+    def copy(self):
+        return _ShortHash(self.hash.copy())
+
+
+# ==============================================================================
+def _get_hash_constructors():
+    """
+    Returns constructors of algorithms with a configurable digest size
+    """
+    constructors = {}
+
+    for name in ('blake2b', 'blake2s'):
+        new = getattr(hashlib, name, None)
+        if new is not None:
+            constructors[name] = functools.partial(
+                new, digest_size=_SIGNATURE_SIZE)
+
+    return constructors
+
+
+_HASH_CONSTRUCTORS = _get_hash_constructors()
+
+
+# ==============================================================================
+def _get_hash_constructor(name, constructors=_HASH_CONSTRUCTORS):
+
+    try:
+        return constructors[name]
+    except KeyError:
+        pass
+
+    new = getattr(hashlib, name, None)
+    if new is None:
+        new = functools.partial(hashlib.new, name)
+
+    try:
+        digest_size = new().digest_size
+    except (ValueError, TypeError):
+        raise ErrorSignatureAlgorithmUnknown(name)
+
+    if digest_size < _SIGNATURE_SIZE:
+        raise ErrorSignatureAlgorithmUnknown(name)
+
+    if digest_size == _SIGNATURE_SIZE:
+        return new
+
+    def _new_short_hash(data=b''):
+        return _ShortHash(new(data))
+
+    return _new_short_hash
+
+
+# ==============================================================================
+_signature_algorithm = 'md5'
+_new_signature_hash = hashlib.md5
+
+
+def set_signature_algorithm(name):
+    """
+    Sets hash algorithm of all signatures and ids of entities.
+    It must be set before creating of any entities and builders.
+    """
+    global _signature_algorithm, _new_signature_hash
+
+    name = name.lower()
+    if name != _signature_algorithm:
+        _new_signature_hash = _get_hash_constructor(name)
+        _signature_algorithm = name
+
+
+def get_signature_algorithm():
+    return _signature_algorithm
+
+
+def get_signature_algorithms():
+    """
+    Returns names of hash algorithms usable for signatures
+    """
+    names = set(name.lower() for name in hashlib.algorithms_available)
+    names.update(('md5', 'sha1'))
+
+    algorithms = []
+    for name in sorted(names):
+        try:
+            _get_hash_constructor(name)
+        except ErrorSignatureAlgorithmUnknown:
+            continue
+
+        algorithms.append(name)
+
+    return algorithms
+
+
 # ==============================================================================
 def new_hash(data=b''):
-    return hashlib.md5(data)
+    return _new_signature_hash(data)
 
 
 # ==============================================================================
 def data_signature(data, common_hash=None):
     if common_hash is None:
-        obj_hash = hashlib.md5(data)
+        obj_hash = _new_signature_hash(data)
     else:
         obj_hash = common_hash.copy()
         obj_hash.update(data)
@@ -251,22 +383,144 @@ def data_signature(data, common_hash=None):
 
 
 # ==============================================================================
-def file_signature(filename, offset=0):
 
-    checksum = hashlib.md5()
-    chunk_size = checksum.block_size * 4096
+# files smaller than this are read into a buffer, larger ones are mapped
+_MMAP_MIN_SIZE = 4 * 1024 * 1024
+
+_HASH_CHUNK_SIZE = 262144
+
+
+class _HashBuffer (threading.local):
+    data = None
+
+
+_HASH_BUFFER = _HashBuffer()
 
-    with open_file(filename, binary=True) as f:
-        f.seek(offset)
 
-        read = f.read
-        checksum_update = checksum.update
+def _get_hash_buffer(chunk_size, hash_buffer=_HASH_BUFFER):
+    data = hash_buffer.data
+    if (data is None) or (len(data) < chunk_size):
+        hash_buffer.data = data = bytearray(chunk_size)
 
-        chunk = True
+    return memoryview(data)[:chunk_size]
 
-        while chunk:
-            chunk = read(chunk_size)
-            checksum_update(chunk)
+
+# ==============================================================================
+def _fadvise_sequential(fd, offset):
+    try:
+        os.posix_fadvise(fd, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+
+def _madvise_sequential(mem):
+    try:
+        mem.madvise(mmap.MADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+
+# ==============================================================================
+def _hash_view(checksum, view, offset, end, chunk_size):
+    checksum_update = checksum.update
+
+    for pos in range(offset, end, chunk_size):
+        checksum_update(view[pos:min(pos + chunk_size, end)])
+
+
+# ==============================================================================
+def _hash_file_mmap(checksum, fd, offset, size, chunk_size):
+    """
+    Hashes the mapped file without copying of data into user buffers.
+    Returns False if the file can't be mapped.
+    """
+    try:
+        mem = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, OverflowError):
+        return False
+
+    try:
+        _madvise_sequential(mem)
+
+        try:
+            view = memoryview(mem)
+        except TypeError:
+            return False
+
+        end = len(mem)
+        if size > 0:
+            end = min(end, offset + size)
+
+        try:
+            _hash_view(checksum, view, offset, end, chunk_size)
+        finally:
+            view.release()
+    finally:
+        mem.close()
+
+    return True
+
+
+# ==============================================================================
+def _hash_stream(checksum, f, size, chunk_size):
+    """
+    Reads the stream into a reused buffer until the size or the end
+    """
+    buf = _get_hash_buffer(chunk_size)
+
+    readinto = f.readinto
+    checksum_update = checksum.update
+
+    while True:
+        if 0 < size < chunk_size:
+            buf = buf[:size]
+
+        read_size = readinto(buf)
+        if not read_size:
+            break
+
+        checksum_update(buf[:read_size])
+
+        if size > 0:
+            size -= read_size
+            if size <= 0:
+                break
+
+
+# ==============================================================================
+def _hash_file(checksum, filename, offset=0, size=-1,
+               chunk_size=_HASH_CHUNK_SIZE):
+    """
+    Updates the checksum by data of the file starting from the offset.
+    If the size is not positive the file is read until the end.
+    """
+
+    fd = _open_file_handle(filename)
+    with io.FileIO(fd, 'r') as f:
+
+        file_size = os.fstat(fd).st_size
+        data_size = file_size - offset
+        if 0 < size < data_size:
+            data_size = size
+
+        if data_size >= _MMAP_MIN_SIZE:
+            if _hash_file_mmap(checksum, fd, offset, size, chunk_size * 4):
+                return checksum
+
+        _fadvise_sequential(fd, offset)
+
+        if offset:
+            f.seek(offset)
+
+        _hash_stream(checksum, f, size, chunk_size)
+
+    return checksum
+
+
+# ==============================================================================
+def file_signature(filename, offset=0):
+
+    checksum = _hash_file(_new_signature_hash(), filename, offset)
 
     # print("file_signature: %s: %s" % (filename, checksum.hexdigest()) )
     return checksum.digest()
@@ -281,29 +535,12 @@ def file_time_signature(filename):
 
 
 # ==============================================================================
-def file_checksum(filename, offset=0, size=-1, alg='md5', chunk_size=262144):
+def file_checksum(filename, offset=0, size=-1, alg='md5',
+                  chunk_size=_HASH_CHUNK_SIZE):
 
     checksum = hashlib.__dict__[alg]()
 
-    with open_file(filename, binary=True) as f:
-        read = f.read
-        f.seek(offset)
-        checksum_update = checksum.update
-
-        chunk = True
-
-        while chunk:
-            chunk = read(chunk_size)
-            checksum_update(chunk)
-
-            if size > 0:
-                size -= len(chunk)
-                if size <= 0:
-                    break
-
-            checksum_update(chunk)
-
-    return checksum
+    return _hash_file(checksum, filename, offset, size, chunk_size)
 
 # ==============================================================================
 
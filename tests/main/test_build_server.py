@@ -0,0 +1,97 @@
+import os
+import io
+import sys
+import threading
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir, log_info
+from aql.main import BuildServer, build_on_server, ErrorBuildServerRunning,\
+    is_build_server_running
+
+# ==============================================================================
+
+
+class _Module (object):
+    pass
+
+# ==============================================================================
+
+
+class TestBuildServer(AqlTestCase):
+
+    def _handle_build(self, args):
+        self.build_dirs.append(os.getcwd())
+
+        print("output of the build")
+        log_info("log of the build")
+
+        return len(args)
+
+    # -----------------------------------------------------------
+
+    def _start_server(self, directory):
+
+        server = BuildServer(directory, self._handle_build)
+        self.servers.append(server)
+
+        def _serve(server=server):
+            while server.serve():
+                # emulates restart of the process
+                server = BuildServer(directory, self._handle_build)
+                self.servers.append(server)
+
+        thread = threading.Thread(target=_serve)
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    # -----------------------------------------------------------
+
+    def test_build_server(self):
+
+        self.build_dirs = []
+        self.servers = []
+
+        with Tempdir() as tmp_dir:
+            output = io.StringIO()
+            self.assertIsNone(build_on_server(tmp_dir, [], output))
+            self.assertFalse(is_build_server_running(tmp_dir))
+
+            module_file = self.generate_file(tmp_dir, 201)
+
+            module = _Module()
+            module.__file__ = module_file
+            sys.modules['_aql_test_build_server'] = module
+
+            thread = self._start_server(tmp_dir)
+            try:
+                self.assertRaises(ErrorBuildServerRunning,
+                                  BuildServer, tmp_dir, self._handle_build)
+
+                self.assertTrue(is_build_server_running(tmp_dir))
+
+                status = build_on_server(tmp_dir, ['a', 'b=1'], output)
+                self.assertEqual(status, 2)
+                self.assertEqual(self.build_dirs, [os.getcwd()])
+
+                text = output.getvalue()
+                self.assertIn("output of the build", text)
+                self.assertIn("log of the build", text)
+
+                # the server is restarted on changes of modules
+                stat = os.stat(module_file)
+                os.utime(module_file, (stat.st_atime, stat.st_mtime + 10))
+
+                status = build_on_server(tmp_dir, [], output)
+                self.assertEqual(status, 0)
+                self.assertEqual(len(self.build_dirs), 2)
+
+            finally:
+                del sys.modules['_aql_test_build_server']
+                self.servers[-1].close()
+                thread.join()
+
+            self.assertIsNone(build_on_server(tmp_dir, [], output))
+            self.assertFalse(is_build_server_running(tmp_dir))
@@ -0,0 +1,221 @@
+import os
+import json
+import shutil
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir
+from aql.options import builtin_options
+from aql.nodes import Node, FileBuilder, BuildManager, ArtifactCache,\
+    ErrorArtifactCacheInvalidKey
+from aql.nodes.aql_node import NodeEntity
+
+# ==============================================================================
+
+
+class CopyIdepBuilder (FileBuilder):
+
+    NAME_ATTRS = ('idep',)
+
+    def __init__(self, options, idep):
+        self.idep = idep
+
+    def build(self, source_entities, targets):
+        for src in source_entities:
+            src = src.get()
+            target = self.get_source_target_path(src + '.copy')
+            shutil.copyfile(src, target)
+            targets.add_target_files(target)
+
+        targets.add_implicit_dep_files(self.idep)
+
+# ==============================================================================
+
+
+class TestArtifactCache(AqlTestCase):
+
+    def test_artifact_cache(self):
+
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = os.path.join(tmp_dir, 'build')
+
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            db_dir = os.path.join(tmp_dir, 'db')
+            os.mkdir(db_dir)
+
+            src_files = self.generate_source_files(tmp_dir, 3, 201)
+            idep_file = self.generate_file(tmp_dir, 201)
+
+            builder = CopyIdepBuilder(options, idep_file)
+
+            targets = {}
+
+            def _build_nodes(clean=True):
+                if clean:
+                    self.remove_files(targets.values())
+                    self.remove_files(os.path.join(db_dir, name)
+                                      for name in os.listdir(db_dir))
+
+                self.built_nodes = 0
+
+                nodes = [Node(builder, src_file) for src_file in src_files]
+
+                bm = BuildManager()
+                bm.add(nodes)
+
+                try:
+                    self.assertTrue(bm.build(
+                        jobs=2, keep_going=False,
+                        db_file=os.path.join(db_dir, '.aql.db'),
+                        cache_dir=cache_dir, cache_root=tmp_dir))
+                finally:
+                    bm.close()
+
+                for src_file, node in zip(src_files, nodes):
+                    targets[src_file] = node.get_target_entities()[0].get()
+
+                return self.built_nodes, bm.cache_hits, bm.cache_misses
+
+            self.assertEqual(_build_nodes(), (3, 0, 3))
+            self.assertEqual(_build_nodes(), (0, 3, 0))
+
+            for src_file, target in targets.items():
+                with open(src_file, 'rb') as src, open(target, 'rb') as dst:
+                    self.assertEqual(src.read(), dst.read())
+
+            # restored nodes are saved into DB
+            self.assertEqual(_build_nodes(clean=False), (0, 0, 0))
+
+            # a changed implicit dependency invalidates cached nodes
+            self.regenerate_file(idep_file, 201)
+            NodeEntity.reset_actual_ideps()
+            self.assertEqual(_build_nodes(), (3, 0, 3))
+
+            self.regenerate_file(src_files[0], 201)
+            self.assertEqual(_build_nodes(), (1, 2, 1))
+
+    # -----------------------------------------------------------
+
+    def test_artifact_cache_relocated(self):
+
+        with Tempdir() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.mkdir(src_dir)
+
+            src_files = self.generate_source_files(src_dir, 2, 201)
+            src_names = [os.path.basename(src) for src in src_files]
+
+            other_dir = os.path.join(tmp_dir, 'other')
+            shutil.copytree(src_dir, other_dir)
+
+            def _build_nodes(root):
+                options = builtin_options()
+                options.build_dir = os.path.join(root, 'build')
+
+                builder = CopyIdepBuilder(options,
+                                          os.path.join(root, src_names[0]))
+
+                nodes = [Node(builder, os.path.join(root, name))
+                         for name in src_names]
+
+                bm = BuildManager()
+                bm.add(nodes)
+
+                try:
+                    self.assertTrue(bm.build(
+                        jobs=1, keep_going=False,
+                        db_file=os.path.join(root, '.aql.db'),
+                        cache_dir=cache_dir, cache_root=root))
+                finally:
+                    bm.close()
+
+                for node in nodes:
+                    for entity in node.get_target_entities():
+                        self.assertTrue(entity.get().startswith(root))
+                        self.assertTrue(os.path.isfile(entity.get()))
+
+                return bm.cache_hits, bm.cache_misses
+
+            self.assertEqual(_build_nodes(src_dir), (0, 2))
+
+            # the same project in another directory uses the cached targets
+            self.assertEqual(_build_nodes(other_dir), (2, 0))
+
+            # entries are plain data
+            entry_files = [os.path.join(root, name)
+                           for root, dirs, names in
+                           os.walk(os.path.join(cache_dir, 'entries'))
+                           for name in names]
+
+            self.assertEqual(len(entry_files), 2)
+            for entry_file in entry_files:
+                with open(entry_file, 'rb') as f:
+                    record = json.loads(f.read().decode('utf-8'))
+
+                for relpath, key in record['files']:
+                    self.assertFalse(os.path.isabs(relpath))
+
+    # -----------------------------------------------------------
+
+    def test_artifact_cache_evict(self):
+
+        with Tempdir() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+
+            src_files = self.generate_source_files(tmp_dir, 4, 1000)
+
+            cache = ArtifactCache(cache_dir, max_size=2500)
+            objects_dir = os.path.join(cache_dir, 'objects')
+
+            for src_file in src_files:
+                cache.store_file(src_file)
+
+            object_files = [os.path.join(root, name)
+                            for root, dirs, names in os.walk(objects_dir)
+                            for name in names]
+
+            self.assertEqual(len(object_files), 4)
+
+            # the first file is the least recently used
+            old_file = object_files[0]
+            old_time = os.path.getmtime(old_file) - 100
+            os.utime(old_file, (old_time, old_time))
+
+            new_file = object_files[1]
+            new_time = os.path.getmtime(new_file) + 100
+            os.utime(new_file, (new_time, new_time))
+
+            cache.evict()
+
+            object_files = set(os.path.join(root, name)
+                               for root, dirs, names in os.walk(objects_dir)
+                               for name in names)
+
+            self.assertEqual(len(object_files), 2)
+            self.assertNotIn(old_file, object_files)
+            self.assertIn(new_file, object_files)
+
+            # the cache is not scanned until the indexed size exceeds maximum
+            other_file = os.path.join(objects_dir, 'other')
+            with open(other_file, 'wb') as f:
+                f.write(b'0' * 1000)
+
+            cache.store_data('abcdef', b'1' * 100)
+            cache.close()
+
+            self.assertTrue(os.path.isfile(other_file))
+
+            cache.store_data('fedcba', b'1' * 1000)
+            cache.close()
+
+            object_files = set(os.path.join(root, name)
+                               for root, dirs, names in os.walk(objects_dir)
+                               for name in names)
+
+            self.assertNotIn(other_file, object_files)
+
+            with self.assertRaises(ErrorArtifactCacheInvalidKey):
+                cache.restore_file('../../file', other_file)
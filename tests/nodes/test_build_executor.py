@@ -0,0 +1,354 @@
+import os
+import stat
+import socket
+import threading
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir, read_bin_file, send_message, recv_message
+from aql.options import builtin_options
+from aql.nodes import Node, Builder, FileBuilder, BuildManager, BuildWorker,\
+    ArtifactCache, ErrorBuildWorkerNoSecret
+
+from aql.nodes.aql_build_executor import RemoteExecutor, _FILES,\
+    _NEED_FILES, _GET_FILES, _dumps, _loads, _get_sandbox_path
+
+_SECRET = b'secret'
+
+# ==============================================================================
+
+
+class PidValueBuilder (Builder):
+
+    SANDBOX_SAFE = True
+
+    def build(self, source_entities, targets):
+        for source_value in source_entities:
+            value = "%s-%s" % (source_value.get(), os.getpid())
+            targets.add_targets(value)
+
+# ==============================================================================
+
+
+class PidCopyBuilder (FileBuilder):
+
+    SANDBOX_SAFE = True
+
+    def build(self, source_entities, targets):
+        for src in source_entities:
+            src = src.get()
+            target = self.get_source_target_path(src + '.copy')
+
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            with open(target, 'wb') as f:
+                f.write(data + str(os.getpid()).encode())
+
+            targets.add_target_files(target)
+
+# ==============================================================================
+
+
+class IncludeBuilder (FileBuilder):
+    """
+    Includes local headers like a C++ compiler
+    """
+
+    def build(self, source_entities, targets):
+        for src in source_entities:
+            src = src.get()
+            target = self.get_source_target_path(src + '.out')
+
+            data = []
+            with open(src) as f:
+                for line in f:
+                    if line.startswith('#include'):
+                        header = line.split('"')[1]
+                        header = os.path.join(os.path.dirname(src), header)
+                        with open(header) as h:
+                            line = h.read()
+
+                    data.append(line)
+
+            with open(target, 'w') as f:
+                f.write(''.join(data))
+
+            targets.add_target_files(target)
+
+# ==============================================================================
+
+
+class TestBuildExecutor(AqlTestCase):
+
+    def _run_worker(self, address, cache_dir):
+        worker = BuildWorker(address, jobs=2, cache_dir=cache_dir,
+                             secret=_SECRET)
+
+        thread = threading.Thread(target=worker.serve)
+        thread.daemon = True
+        thread.start()
+
+        return worker, thread
+
+    # -----------------------------------------------------------
+
+    def _test_build_workers(self, tmp_dir, address):
+
+        options = builtin_options()
+        options.build_dir = os.path.join(tmp_dir, 'build')
+
+        worker, thread = self._run_worker(address,
+                                          os.path.join(tmp_dir, 'cache'))
+        try:
+            src_files = self.generate_source_files(tmp_dir, 3, 201)
+
+            process_options = options.override()
+            process_options.process_build = True
+
+            copy_builder = PidCopyBuilder(process_options)
+            value_builder = PidValueBuilder(options)
+
+            copy_node = Node(copy_builder, src_files)
+            value_node = Node(value_builder, [1])
+            expensive_node = Node(value_builder, [2])
+
+            bm = BuildManager()
+            bm.add([copy_node, value_node, expensive_node])
+            bm.expensive(expensive_node)
+
+            try:
+                self.assertTrue(bm.build(jobs=1, keep_going=False,
+                                         build_workers=[worker.address],
+                                         build_secret=_SECRET))
+            finally:
+                bm.close()
+
+            pid = str(os.getpid())
+
+            self.assertEqual(value_node.get().split('-')[1], pid)
+            self.assertNotEqual(expensive_node.get().split('-')[1], pid)
+
+            targets = copy_node.get()
+            self.assertEqual(len(targets), len(src_files))
+
+            for src_file, target in zip(src_files, targets):
+                data = read_bin_file(target)
+                self.assertTrue(data.startswith(read_bin_file(src_file)))
+                self.assertNotEqual(data[-len(pid):], pid.encode())
+
+        finally:
+            worker.close()
+            thread.join()
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_unix(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skipTest("Unix domain sockets are not supported")
+
+        with Tempdir() as tmp_dir:
+            address = os.path.join(tmp_dir, 'worker.sock')
+            self._test_build_workers(tmp_dir, address)
+
+            # the socket is accessible by the owner only
+            worker = BuildWorker(address, jobs=1)
+            try:
+                mode = stat.S_IMODE(os.stat(address).st_mode)
+                self.assertEqual(mode & 0o077, 0)
+            finally:
+                worker.close()
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_tcp(self):
+        with Tempdir() as tmp_dir:
+            self._test_build_workers(tmp_dir, '127.0.0.1:0')
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_unavailable(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+            options.process_build = True
+
+            node = Node(PidValueBuilder(options), [1])
+
+            bm = BuildManager()
+            bm.add([node])
+
+            address = os.path.join(tmp_dir, 'worker.sock')
+
+            # nodes are built locally without workers
+            try:
+                self.assertTrue(bm.build(jobs=1, keep_going=False,
+                                         build_workers=[address]))
+            finally:
+                bm.close()
+
+            self.assertNotEqual(node.get().split('-')[1], str(os.getpid()))
+
+            self.assertRaises(ErrorBuildWorkerNoSecret,
+                              BuildWorker, '127.0.0.1:0')
+
+            # clients with another secret are not accepted
+            worker, thread = self._run_worker(
+                '127.0.0.1:0', os.path.join(tmp_dir, 'cache'))
+            try:
+                executor = RemoteExecutor([worker.address], b'other')
+                self.assertEqual(executor.jobs, 0)
+                executor.close()
+
+                executor = RemoteExecutor([worker.address], _SECRET)
+                self.assertEqual(executor.jobs, 2)
+                executor.close()
+            finally:
+                worker.close()
+                thread.join()
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_failed(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            builder = PidValueBuilder(options).initiate()
+            address = os.path.join(tmp_dir, 'worker.sock')
+
+            executor = RemoteExecutor([], _SECRET)
+
+            client_conn, worker_conn = socket.socketpair()
+            try:
+                executor.idle_conns[address] = [client_conn]
+                executor.jobs = 2
+                executor.slots.put(address)
+                executor.slots.put(address)
+
+                # the worker drops the connection
+                worker_conn.close()
+
+                # nodes are built locally, jobs of the worker are not used
+                for i in range(3):
+                    self.assertIsNone(executor.build(builder, [], [], ()))
+
+                self.assertEqual(executor.jobs, 0)
+                self.assertIn(address, executor.failed)
+            finally:
+                client_conn.close()
+                executor.close()
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_local_header(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = os.path.join(tmp_dir, 'build')
+            options.process_build = True
+
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.makedirs(src_dir)
+
+            header = os.path.join(src_dir, 'header.h')
+            with open(header, 'w') as f:
+                f.write('int header;\n')
+
+            src_file = os.path.join(src_dir, 'source.cpp')
+            with open(src_file, 'w') as f:
+                f.write('#include "header.h"\nint source;\n')
+
+            worker, thread = self._run_worker(
+                '127.0.0.1:0', os.path.join(tmp_dir, 'cache'))
+            try:
+                node = Node(IncludeBuilder(options), src_file)
+
+                bm = BuildManager()
+                bm.add([node])
+
+                # headers are unknown to the worker, so it's built locally
+                try:
+                    self.assertTrue(bm.build(jobs=1, keep_going=False,
+                                             build_workers=[worker.address],
+                                             build_secret=_SECRET))
+                finally:
+                    bm.close()
+
+                target = node.get()
+                with open(target) as f:
+                    self.assertEqual(f.read(), 'int header;\nint source;\n')
+            finally:
+                worker.close()
+                thread.join()
+
+    # -----------------------------------------------------------
+
+    def test_build_executor_files(self):
+
+        with Tempdir() as tmp_dir:
+            src_file = self.generate_file(tmp_dir, 201)
+            key = ArtifactCache.get_file_key(src_file)
+            data = read_bin_file(src_file)
+
+            worker, thread = self._run_worker(
+                '127.0.0.1:0', os.path.join(tmp_dir, 'cache'))
+
+            sandbox = os.path.join(tmp_dir, 'sandbox')
+            sandbox_file = _get_sandbox_path(sandbox, src_file)
+
+            client_conn, worker_conn = socket.socketpair()
+            try:
+                # missing input files are sent by the client
+                def _restore_inputs():
+                    worker._restore_inputs(worker_conn, [(src_file, key)],
+                                           sandbox)
+
+                restore_thread = threading.Thread(target=_restore_inputs)
+                restore_thread.start()
+
+                kind, keys = recv_message(client_conn)
+                self.assertEqual(kind, _NEED_FILES)
+                self.assertEqual(_loads(keys), [key])
+
+                send_message(client_conn, _FILES, _dumps([(key, data)]))
+                restore_thread.join()
+
+                # input files are restored into the sandbox only
+                self.assertTrue(sandbox_file.startswith(sandbox))
+                self.assertEqual(read_bin_file(sandbox_file), data)
+
+                # then they are restored from the cache of the worker
+                os.remove(sandbox_file)
+                _restore_inputs()
+                self.assertEqual(read_bin_file(sandbox_file), data)
+
+                # paths of clients can't leave the sandbox
+                self.assertEqual(
+                    _get_sandbox_path(sandbox, '/../../file'),
+                    os.path.join(sandbox, 'file'))
+
+                # changed target files are received by the client
+                target_file = src_file + '.target'
+
+                def _send_targets():
+                    kind, keys = recv_message(worker_conn)
+                    self.assertEqual(kind, _GET_FILES)
+                    self.assertEqual(_loads(keys), [key])
+                    send_message(worker_conn, _FILES, _dumps([(key, data)]))
+
+                send_thread = threading.Thread(target=_send_targets)
+                send_thread.start()
+
+                self.assertTrue(RemoteExecutor._fetch_files(
+                    client_conn, worker.address,
+                    {src_file: key, target_file: key}))
+
+                send_thread.join()
+
+                self.assertEqual(read_bin_file(target_file), data)
+
+            finally:
+                client_conn.close()
+                worker_conn.close()
+                worker.close()
+                thread.join()
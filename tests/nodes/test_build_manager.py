@@ -6,14 +6,16 @@ import operator
 from aql_testcase import AqlTestCase, skip
 
 from aql.util_types import encode_str
-from aql.utils import file_checksum, Tempdir, \
-    add_user_handler, remove_user_handler
+from aql.utils import file_checksum, Tempdir, Chrono, \
+    add_user_handler, remove_user_handler, set_signature_algorithm
 
 from aql.entity import SimpleEntity, FileChecksumEntity
 from aql.options import builtin_options, BoolOptionType
 from aql.nodes import Node, Builder, FileBuilder, BuildManager
+from aql.nodes.aql_node import NodeEntity
 from aql.nodes.aql_build_manager import ErrorNodeDependencyCyclic,\
-    ErrorNodeSignatureDifferent, ErrorNodeDuplicateNames
+    ErrorNodeSignatureDifferent, ErrorNodeDuplicateNames,\
+    close_kept_db_files, _KEPT_VFILES, _NodesBuilder
 
 
 # ==============================================================================
@@ -34,6 +36,15 @@ class ValueBuilder (Builder):
         targets.add_targets(value)
 
 
+# ==============================================================================
+class ProcessValueBuilder (Builder):
+
+    def build(self, source_entities, targets):
+        for source_value in source_entities:
+            value = "%s-%s" % (source_value.get(), os.getpid())
+            targets.add_targets(value)
+
+
 # ==============================================================================
 class ExpensiveValueBuilder (Builder):
 
@@ -258,6 +269,22 @@ class ChecksumBuilder (FileBuilder):
             targets[src_value].add_targets(target_files)
 
 
+# ==============================================================================
+class ChecksumIdepBuilder (ChecksumBuilder):
+
+    NAME_ATTRS = ('replace_ext', 'idep')
+
+    def __init__(self, options, offset, length, idep):
+        self.offset = offset
+        self.length = length
+        self.replace_ext = False
+        self.idep = idep
+
+    def build(self, source_entities, targets):
+        super(ChecksumIdepBuilder, self).build(source_entities, targets)
+        targets.add_implicit_dep_files(self.idep)
+
+
 # ==============================================================================
 class ChecksumSingleBuilder (ChecksumBuilder):
 
@@ -413,6 +440,42 @@ class TestBuildManager(AqlTestCase):
 
     # -----------------------------------------------------------
 
+    def test_bm_deps_order(self):
+
+        bm = BuildManager()
+
+        options = builtin_options()
+        builder = CopyValueBuilder(options)
+
+        nodes = [Node(builder, SimpleEntity("value%s" % i, name="n%s" % i))
+                 for i in range(10)]
+
+        bm.add(nodes)
+        bm.self_test()
+
+        def _depends(node, dep_node):
+            node.depends(dep_node)
+            bm.depends(node, [dep_node])
+
+        for node, dep_node in zip(nodes, nodes[1:]):
+            _depends(node, dep_node)
+            bm.self_test()
+
+        _depends(nodes[5], nodes[9])
+        bm.self_test()
+
+        for node in nodes[1:]:
+            self.assertRaises(ErrorNodeDependencyCyclic,
+                              _depends, node, nodes[0])
+            bm.self_test()
+
+        self.assertRaises(ErrorNodeDependencyCyclic,
+                          _depends, nodes[0], nodes[0])
+
+        bm.self_test()
+
+    # -----------------------------------------------------------
+
     def test_bm_build(self):
 
         with Tempdir() as tmp_dir:
@@ -563,6 +626,205 @@ class TestBuildManager(AqlTestCase):
 
     # -----------------------------------------------------------
 
+    def test_bm_single_db(self):
+
+        with Tempdir() as tmp_dir:
+            src_files = self.generate_source_files(tmp_dir, 6, 201)
+            idep_file = self.generate_file(tmp_dir, 201)
+
+            builders = []
+            build_dirs = []
+            for name in ('a', 'b'):
+                options = builtin_options()
+                options.build_dir = os.path.join(tmp_dir, 'build', name)
+                build_dirs.append(options.build_dir.get())
+                builders.append(
+                    ChecksumIdepBuilder(options, 0, 256, idep_file))
+
+            db_file = os.path.join(tmp_dir, 'build', '.aql.db')
+
+            def _build_nodes(db_file):
+                bm = BuildManager()
+                for builder in builders:
+                    for src_file in src_files:
+                        bm.add([Node(builder, src_file)])
+
+                try:
+                    self.assertTrue(bm.build(jobs=4, keep_going=False,
+                                             db_file=db_file))
+                    bm.self_test()
+                finally:
+                    bm.close()
+
+            self.built_nodes = 0
+            _build_nodes(None)
+            self.assertEqual(self.built_nodes, len(src_files) * 2)
+
+            for build_dir in build_dirs:
+                self.assertTrue(
+                    os.path.isfile(os.path.join(build_dir, '.aql.db')))
+
+            # existing DBs are migrated into the project DB
+            self.built_nodes = 0
+            _build_nodes(db_file)
+            self.assertEqual(self.built_nodes, 0)
+
+            self.assertTrue(os.path.isfile(db_file))
+            for build_dir in build_dirs:
+                self.assertFalse(
+                    os.path.isfile(os.path.join(build_dir, '.aql.db')))
+
+            self.regenerate_file(idep_file, 201)
+            # actual implicit dependencies are cached per process
+            NodeEntity.reset_actual_ideps()
+
+            self.built_nodes = 0
+            _build_nodes(db_file)
+            self.assertEqual(self.built_nodes, len(src_files) * 2)
+
+            self.built_nodes = 0
+            _build_nodes(db_file)
+            self.assertEqual(self.built_nodes, 0)
+
+    # -----------------------------------------------------------
+
+    def test_bm_keep_db_open(self):
+
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            src_files = self.generate_source_files(tmp_dir, 4, 201)
+            idep_file = self.generate_file(tmp_dir, 201)
+
+            builder = ChecksumIdepBuilder(options, 0, 256, idep_file)
+
+            def _build_nodes(keep_db_open):
+                self.built_nodes = 0
+
+                bm = BuildManager()
+                for src_file in src_files:
+                    bm.add([Node(builder, src_file)])
+
+                try:
+                    self.assertTrue(bm.build(jobs=4, keep_going=False,
+                                             keep_db_open=keep_db_open))
+                finally:
+                    bm.close()
+
+                return self.built_nodes
+
+            try:
+                self.assertEqual(_build_nodes(True), len(src_files))
+                self.assertEqual(len(_KEPT_VFILES), 1)
+
+                vfile = list(_KEPT_VFILES.values())[0][1]
+
+                self.assertEqual(_build_nodes(True), 0)
+                self.assertIs(list(_KEPT_VFILES.values())[0][1], vfile)
+
+                self.regenerate_file(idep_file, 201)
+                NodeEntity.reset_actual_ideps()
+                self.assertEqual(_build_nodes(True), len(src_files))
+
+                # the kept file is closed to be opened as usual
+                self.assertEqual(_build_nodes(False), 0)
+                self.assertFalse(_KEPT_VFILES)
+
+                self.assertEqual(_build_nodes(True), 0)
+            finally:
+                close_kept_db_files()
+
+            self.assertFalse(_KEPT_VFILES)
+            self.assertEqual(_build_nodes(False), 0)
+
+    # -----------------------------------------------------------
+
+    def test_bm_used_files(self):
+
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            src_files = self.generate_source_files(tmp_dir, 4, 201)
+            idep_file = self.generate_file(tmp_dir, 201)
+
+            builder = ChecksumIdepBuilder(options, 0, 256, idep_file)
+
+            src_file, failed_src_file, dep_file, other_file = src_files
+
+            node = Node(builder, src_file)
+            node.depends(FileChecksumEntity(dep_file))
+
+            failed_node = Node(FailedBuilder(options),
+                               FileChecksumEntity(failed_src_file))
+
+            # it's not built because of the failed node
+            other_node = Node(builder, [failed_node, other_file])
+
+            bm = BuildManager()
+            bm.add([node, failed_node, other_node])
+
+            used_files = set()
+            built_files = set()
+
+            try:
+                self.assertFalse(bm.build(jobs=1, keep_going=True,
+                                          used_files=used_files,
+                                          built_files=built_files))
+            finally:
+                bm.close()
+
+            self.assertEqual(used_files, set(src_files + [idep_file]))
+
+            target_files = set(entity.get()
+                               for entity in node.get_target_entities())
+            self.assertTrue(target_files)
+            self.assertEqual(built_files, target_files)
+
+    # -----------------------------------------------------------
+
+    def test_bm_check_parallel(self):
+
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            src_files = self.generate_source_files(tmp_dir, 20, 201)
+
+            builder = ChecksumBuilder(options, 0, 256, replace_ext=True)
+
+            def _build_nodes(use_sqlite):
+                bm = BuildManager()
+                for src_file in src_files:
+                    bm.add([Node(builder, src_file)])
+
+                try:
+                    bm.self_test()
+                    self.assertTrue(bm.build(jobs=4, keep_going=False,
+                                             use_sqlite=use_sqlite))
+                    bm.self_test()
+                finally:
+                    bm.close()
+
+            for use_sqlite in (False, True):
+                self.building_nodes = self.built_nodes = 0
+                _build_nodes(use_sqlite)
+                self.assertEqual(self.built_nodes, len(src_files))
+
+                self.built_nodes = 0
+                _build_nodes(use_sqlite)
+                self.assertEqual(self.built_nodes, 0)
+
+                self.regenerate_file(src_files[0], 201)
+                self.regenerate_file(src_files[7], 201)
+
+                self.built_nodes = 0
+                _build_nodes(use_sqlite)
+                self.assertEqual(self.built_nodes, 2)
+
+    # -----------------------------------------------------------
+
     def test_bm_batch(self):
 
         with Tempdir() as tmp_dir:
@@ -1106,6 +1368,127 @@ class TestBuildManager(AqlTestCase):
 
             _build(bm, jobs=16)
 
+    # ----------------------------------------------------------
+
+    def test_bm_critical_path(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            bm = BuildManager()
+
+            value1 = SimpleEntity("http://aql.org/download1",
+                                  name="target_url1")
+            value2 = SimpleEntity("http://aql.org/download2",
+                                  name="target_url2")
+
+            builder = CopyValueBuilder(options)
+
+            node0 = Node(builder, value1)
+            node1 = Node(builder, node0)
+            node2 = Node(builder, node1)
+            node3 = Node(builder, value2)
+
+            bm.add([node2, node3])
+            bm.priority([node0, node1, node3], 1)
+            bm.priority(node2, 5)
+
+            self.assertEqual(bm.get_critical_path(node0), 7)
+            self.assertEqual(bm.get_critical_path(node1), 6)
+            self.assertEqual(bm.get_critical_path(node3), 1)
+
+            node2.depends(node3)
+            bm.depends(node2, [node3])
+            bm.self_test()
+
+            self.assertEqual(bm.get_critical_path(node0), 7)
+            self.assertEqual(bm.get_critical_path(node3), 6)
+
+            node4 = Node(builder, node3)
+            bm.add([node4])
+            bm.priority(node4, 10)
+
+            self.assertEqual(bm.get_critical_path(node3), 11)
+            self.assertEqual(bm.get_critical_path(node0), 7)
+
+            _build(bm)
+
+    # ----------------------------------------------------------
+
+    def test_bm_recorded_build_times(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            builder = CopyValueBuilder(options)
+
+            def _make_nodes(value="value0", name="name0"):
+                node0 = Node(builder, SimpleEntity(value, name=name))
+                node1 = Node(builder, node0)
+                node2 = Node(builder, node1)
+                return node0, node1, node2
+
+            bm = BuildManager()
+            nodes = _make_nodes()
+            bm.add(nodes[-1:])
+            _build(bm)
+
+            # durations of nodes are known before they are checked
+            bm = BuildManager()
+            nodes = _make_nodes(value="value1")
+            bm.add(nodes[-1:])
+
+            with _NodesBuilder(bm) as nodes_builder:
+                recorded_times = [nodes_builder.find_recorded_build_time(node)
+                                  for node in nodes]
+
+            self.assertNotIn(None, recorded_times)
+
+            for node in nodes:
+                self.assertIsNone(node.get_build_time())
+
+            bm = BuildManager()
+            nodes = _make_nodes(name="name1")
+            bm.add(nodes[-1:])
+
+            with _NodesBuilder(bm) as nodes_builder:
+                self.assertIsNone(
+                    nodes_builder.find_recorded_build_time(nodes[2]))
+
+    # ----------------------------------------------------------
+
+    def test_bm_process_build(self):
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            bm = BuildManager()
+
+            builder = ProcessValueBuilder(options)
+
+            options = options.override()
+            options.process_build = True
+            process_builder = ProcessValueBuilder(options)
+
+            node1 = Node(builder, [1, 2])
+            node2 = Node(builder, [3])
+            node3 = Node(process_builder, [4])
+
+            bm.add([node1, node2, node3])
+            bm.process_build(node1)
+
+            _build(bm, jobs=4)
+
+            pid = str(os.getpid())
+
+            values1 = node1.get()
+            self.assertEqual(len(values1), 2)
+            for value in values1:
+                self.assertNotEqual(value.split('-')[1], pid)
+
+            self.assertEqual(node2.get().split('-')[1], pid)
+            self.assertNotEqual(node3.get().split('-')[1], pid)
+
 
 # ==============================================================================
 def _generate_node_tree(bm, builder, node, depth):
@@ -1130,3 +1513,96 @@ class TestBuildManagerSpeed(AqlTestCase):
         bm.add([node])
 
         _generate_node_tree(bm, builder, node, 5000)
+
+    # ----------------------------------------------------------
+
+    def _test_bm_tree_speed(self, num_nodes):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        options = builtin_options()
+        builder = CopyValueBuilder(options)
+
+        value = SimpleEntity("http://aql.org/download", name="target_url1")
+
+        nodes = [Node(builder, value)]
+        for i in range(1, num_nodes):
+            nodes.append(Node(builder, nodes[(i - 1) // 2]))
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+        timer = Chrono()
+
+        with timer:
+            bm = BuildManager()
+            bm.add(nodes)
+
+        print("nodes: %s, add time: %s" % (num_nodes, timer))
+
+        if tracemalloc is not None:
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("nodes: %s, memory: %.1f MiB, peak: %.1f MiB" %
+                  (num_nodes, size / 1048576.0, peak / 1048576.0))
+
+        tree = bm._nodes
+
+        with timer:
+            tails = tree.pop_tails()
+            while tails:
+                for node in tails:
+                    tree.remove_tail(node)
+
+                tails = tree.pop_tails()
+
+        print("nodes: %s, remove time: %s" % (num_nodes, timer))
+
+        self.assertEqual(len(bm), 0)
+
+    # ----------------------------------------------------------
+
+    def test_bm_tree_speed_100k(self):
+        self._test_bm_tree_speed(100000)
+
+    # ----------------------------------------------------------
+
+    def test_bm_tree_speed_1m(self):
+        self._test_bm_tree_speed(1000000)
+
+    # ----------------------------------------------------------
+
+    def test_bm_signature_algorithm_speed(self):
+
+        with Tempdir() as tmp_dir:
+            src_files = self.generate_source_files(tmp_dir, 200, 65536)
+
+            # the files are modified recently,
+            # so their signatures are not taken from the stat cache
+            for algorithm in ('md5', 'sha1', 'blake2b', 'blake2s'):
+                set_signature_algorithm(algorithm)
+                try:
+                    options = builtin_options()
+                    options.build_dir = os.path.join(tmp_dir, algorithm)
+
+                    builder = ChecksumBuilder(options, 0, 256)
+
+                    def _build_nodes():
+                        bm = BuildManager()
+                        for src_file in src_files:
+                            bm.add([Node(builder, src_file)])
+
+                        _build(bm, jobs=4)
+
+                    _build_nodes()
+
+                    timer = Chrono()
+                    with timer:
+                        _build_nodes()
+
+                    print("algorithm: %s, no-op build time: %s" %
+                          (algorithm, timer))
+                finally:
+                    set_signature_algorithm('md5')
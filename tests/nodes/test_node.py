@@ -6,15 +6,16 @@ import hashlib
 from aql_testcase import AqlTestCase, skip
 
 
-from aql.util_types import to_sequence
+from aql.util_types import to_sequence, FilePath
 
-from aql.utils import Tempfile, Tempdir, write_bin_file
+from aql.utils import Tempfile, Tempdir, write_bin_file, new_hash
 
 from aql.options import builtin_options
 from aql.entity import SimpleEntity, NullEntity, FileChecksumEntity,\
     EntitiesFile
 
 from aql.nodes import Node, Builder, FileBuilder
+from aql.nodes.aql_node import ErrorUnactualEntity
 
 # ==============================================================================
 
@@ -191,6 +192,98 @@ class TestNodes(AqlTestCase):
 
     # ==============================================================================
 
+    def test_node_build_time(self):
+
+        with Tempfile() as tmp:
+
+            vfile = EntitiesFile(tmp)
+            try:
+                value1 = SimpleEntity(
+                    "http://aql.org/download1", name="target_url1")
+                value2 = SimpleEntity(
+                    "http://aql.org/download2", name="target_url2")
+
+                options = builtin_options()
+                builder = ChecksumBuilder(options)
+
+                node = Node(builder, [value1, value2])
+                node.initiate()
+                node.build_split(vfile, False)
+
+                self.assertFalse(node.check_actual(vfile, False))
+                self.assertIsNone(node.get_build_time())
+                node.build()
+                build_time = node.get_build_time()
+                self.assertGreaterEqual(build_time, 0)
+                node.save(vfile)
+
+                vfile.close()
+                vfile.open(tmp)
+
+                node = Node(builder, [value1, value2])
+                node.initiate()
+                node.build_split(vfile, False)
+                self.assertTrue(node.check_actual(vfile, False))
+                self.assertAlmostEqual(node.get_build_time(), build_time)
+
+            finally:
+                vfile.close()
+
+    # ==============================================================================
+
+    def test_node_save_unactual(self):
+
+        with Tempdir() as tmp_dir:
+            vfile_name = Tempfile(root_dir=tmp_dir)
+            vfile_name.close()
+            with EntitiesFile(vfile_name) as vfile:
+                src_files = self.generate_source_files(tmp_dir, 2, 100)
+
+                options = builtin_options()
+                options.batch_build = True
+                options.batch_groups = 1
+
+                builder = CopyBuilder(options, "tmp", "i")
+
+                node = Node(builder, src_files)
+                node.initiate()
+                split_nodes = node.build_split(vfile, False)
+                self.assertEqual(len(split_nodes), 1)
+
+                split_node = split_nodes[0]
+                split_node.build()
+
+                node_entity1, node_entity2 = split_node.node_entities
+                node_entity1.target_entities[0].signature = None
+
+                self.assertRaises(ErrorUnactualEntity,
+                                  split_node.save, vfile)
+
+                # other entities of the node are saved
+                self.assertIsNone(vfile.find_node_entity(node_entity1))
+                self.assertIsNotNone(vfile.find_node_entity(node_entity2))
+
+    # ==============================================================================
+
+    def test_node_work_dir(self):
+
+        with Tempdir() as tmp_dir:
+            options = builtin_options()
+            options.build_dir = tmp_dir
+
+            cwd = os.getcwd()
+
+            builder = CopyBuilder(options, "tmp", "i")
+            node = Node(builder, FilePath('test.txt'), cwd=tmp_dir)
+            node.initiate()
+
+            self.assertEqual(os.getcwd(), cwd)
+
+            src_path = os.path.normcase(os.path.join(tmp_dir, 'test.txt'))
+            self.assertEqual(node.get_sources(), (src_path,))
+
+    # ==============================================================================
+
     def _rebuild_node(self, vfile, builder, values, deps, tmp_files):
         node = Node(builder, values)
         node.depends(deps)
@@ -395,6 +488,49 @@ class TestNodes(AqlTestCase):
 
                 self._rebuild_batch_node(vfile, src_files, 2)
 
+    # ==========================================================
+
+    def test_node_batch_signature(self):
+
+        with Tempdir() as tmp_dir:
+            vfile_name = Tempfile(root_dir=tmp_dir)
+            vfile_name.close()
+            with EntitiesFile(vfile_name) as vfile:
+                src_files = self.generate_source_files(tmp_dir, 5, 100)
+
+                options = builtin_options()
+                options.batch_build = True
+
+                builder = CopyBuilder(options, "tmp", "i")
+
+                deps = [SimpleEntity("11", name="dep1"),
+                        SimpleEntity("22", name="dep2")]
+
+                node = Node(builder, src_files)
+                node.depends(deps)
+                node.initiate()
+                node.build_split(vfile, False)
+
+                for node_entity in node.node_entities:
+                    hash_sum = new_hash(node.builder.signature)
+                    for dep in deps:
+                        hash_sum.update(dep.id)
+                        hash_sum.update(dep.signature)
+
+                    for src in node_entity.source_entities:
+                        hash_sum.update(src.signature)
+
+                    self.assertEqual(node_entity.signature,
+                                     hash_sum.digest())
+
+                node = Node(builder, src_files)
+                node.depends(deps + [NullEntity()])
+                node.initiate()
+                node.build_split(vfile, False)
+
+                for node_entity in node.node_entities:
+                    self.assertIsNone(node_entity.signature)
+
 # ==============================================================================
 
 _FileValueType = FileChecksumEntity
@@ -1,3 +1,5 @@
+import pickle
+
 from aql_testcase import AqlTestCase
 
 from aql.util_types import Dict, split_dict_type, value_dict_type
@@ -75,3 +77,13 @@ class TestDictTypes(AqlTestCase):
         self.assertEqual(ds.setdefault(2, '0'), 1)
 
         self.assertEqual(ds[7], 8)
+
+    # -----------------------------------------------------------
+
+    def test_dict_pickle(self):
+        dict_type = split_dict_type(value_dict_type(Dict, int, int), ', ')
+        d = dict_type("1=2, 3=4")
+
+        pd = pickle.loads(pickle.dumps(d))
+        self.assertIsInstance(pd, Dict)
+        self.assertEqual(pd, {1: 2, 3: 4})
@@ -1,10 +1,11 @@
+import os
 import random
 import uuid
 
 from aql_testcase import AqlTestCase, skip
 
 from aql.utils import Tempfile, Chrono
-from aql.utils import DataFile, SqlDataFile
+from aql.utils import DataFile, SqlDataFile, LogDataFile
 
 from aql.util_types import encode_str
 
@@ -202,6 +203,365 @@ class TestDataFile(AqlTestCase):
 
     # -----------------------------------------------------------
 
+    def _test_data_file_write_many(self, data_file_type):
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(1500, 16, 128)
+            data_ids = list(data_map)
+
+            df = data_file_type(tmp)
+            try:
+                df.write_many((data_id, data_map[data_id])
+                              for data_id in data_ids[:100])
+                df.self_test()
+
+                items = [(data_id, data_map[data_id]) for data_id in data_ids]
+                keys = df.write_with_keys(items)
+                df.self_test()
+
+                self.assertEqual(len(keys), len(data_ids))
+                self.assertEqual(len(set(keys)), len(keys))
+                self.assertSequenceEqual(df.get_ids(keys), data_ids)
+
+                key = df.write_with_key(data_ids[0], b'1')
+                self.assertGreater(key, max(keys))
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                self.assertGreater(df.write_with_key(data_ids[1], b'2'), key)
+
+                self.assertEqual(df.read(data_ids[0]), b'1')
+                self.assertEqual(df.read(data_ids[1]), b'2')
+                for data_id in data_ids[2:]:
+                    self.assertEqual(df.read(data_id), data_map[data_id])
+
+                unknown_id = encode_str(str(uuid.uuid4()))[:16]
+                self.assertSequenceEqual(
+                    df.read_many(data_ids[2:] + [unknown_id]),
+                    [data_map[data_id] for data_id in data_ids[2:]] + [None])
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
+    def test_data_file_sql_keys_cache(self):
+
+        class _SqlDataFile(SqlDataFile):
+            __slots__ = ()
+            KEYS_CACHE_SIZE = 100
+            COMMIT_CHANGES = 50
+
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(1200, 16, 128)
+            data_ids = list(data_map)
+
+            df = _SqlDataFile(tmp)
+            try:
+                keys = df.write_with_keys(data_map.items())
+                df.self_test()
+                self.assertLessEqual(len(df.key2id), df.KEYS_CACHE_SIZE)
+
+                df.close()
+                df.open(tmp)
+                self.assertFalse(df.key2id)
+
+                self.assertSequenceEqual(df.get_ids(keys), data_ids)
+                self.assertSequenceEqual(df.get_keys(data_ids), keys)
+                df.self_test()
+
+                self.assertIsNone(df.get_ids(keys[:10] + [max(keys) + 1]))
+                self.assertRaises(KeyError, df.get_keys, [b'0' * 16])
+
+                df.remove(data_ids[:600])
+                df.self_test()
+                self.assertIsNone(df.get_ids(keys[:1]))
+                self.assertSequenceEqual(df.get_keys(data_ids[600:]),
+                                         keys[600:])
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                self.assertSequenceEqual(df.get_ids(keys[600:]),
+                                         data_ids[600:])
+                self.assertGreater(df.write_with_key(data_ids[0], b'1'),
+                                   max(keys))
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
+    def test_data_file_free_space(self):
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(200, 16, 128)
+            data_ids = list(data_map)
+
+            df = DataFile(tmp)
+            try:
+                for data_id in data_ids:
+                    df.write(data_id, data_map[data_id])
+
+                data_end = df.data_end
+
+                # grown data is relocated, the old space becomes free
+                first_id = data_ids[0]
+                data = generate_data(1024, 1024)
+                data_map[first_id] = data
+                df.write(first_id, data)
+                df.self_test()
+
+                self.assertEqual(df.read(first_id), data)
+                self.assertGreater(df.data_end, data_end)
+                self.assertGreater(df.free_space.size, 0)
+
+                # removed space is reused by new data
+                df.remove(data_ids[1:11])
+                df.self_test()
+
+                data_end = df.data_end
+                free_size = df.free_space.size
+
+                for data_id in data_ids[1:11]:
+                    df.write(data_id, data_map[data_id])
+                    df.self_test()
+
+                self.assertEqual(df.data_end, data_end)
+                self.assertLess(df.free_space.size, free_size)
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                for data_id, data in data_map.items():
+                    self.assertEqual(df.read(data_id), data)
+
+                # explicit compaction
+                df.remove(data_ids[::2])
+                df.self_test()
+                self.assertGreater(df.free_space.size, 0)
+
+                df.compact()
+                df.self_test()
+                self.assertEqual(df.free_space.size, 0)
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                for data_id in data_ids[1::2]:
+                    self.assertEqual(df.read(data_id), data_map[data_id])
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
+    def test_data_file_index(self):
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(2000, 16, 128)
+            data_ids = list(data_map)
+
+            df = DataFile(tmp)
+            try:
+                keys = df.write_with_keys((data_id, data_map[data_id])
+                                          for data_id in data_ids)
+                df.close()
+
+                # only accessed metas are loaded
+                df.open(tmp)
+                self.assertIsNotNone(df.index)
+                self.assertEqual(len(df.id2data), 0)
+
+                self.assertEqual(df.read(data_ids[10]), data_map[data_ids[10]])
+                self.assertSequenceEqual(df.get_ids(keys[20:22]),
+                                         data_ids[20:22])
+                self.assertEqual(list(df.get_keys(data_ids[30:31])),
+                                 keys[30:31])
+                self.assertIsNone(df.read(b'0' * 16))
+                self.assertIsNone(df.get_ids([max(keys) + 1]))
+
+                self.assertEqual(len(df.id2data), 4)
+
+                # changes are visible through the index
+                new_key = df.write_with_key(data_ids[20], b'20')
+                df.remove(data_ids[:5])
+                df.write(data_ids[-1], b'-1')
+                df.write(data_ids[0], b'0')
+
+                self.assertIsNone(df.get_ids(keys[20:21]))
+                self.assertSequenceEqual(df.get_ids([new_key]),
+                                         data_ids[20:21])
+                for data_id in data_ids[1:5]:
+                    self.assertIsNone(df.read(data_id))
+
+                self.assertLess(len(df.id2data), 20)
+
+                df.close()
+                df.open(tmp)
+                self.assertIsNotNone(df.index)
+
+                self.assertEqual(df.read(data_ids[0]), b'0')
+                self.assertEqual(df.read(data_ids[-1]), b'-1')
+                self.assertEqual(df.read(data_ids[20]), b'20')
+
+                # repeated ids are found through the index only once
+                df.remove([data_ids[5], data_ids[5]])
+                self.assertIsNone(df.read(data_ids[5]))
+                del data_map[data_ids[5]]
+
+                data_map[data_ids[0]] = b'0'
+                data_map[data_ids[-1]] = b'-1'
+                data_map[data_ids[20]] = b'20'
+                for data_id in data_ids[1:5]:
+                    del data_map[data_id]
+
+                df.self_test()
+                self.assertIsNone(df.index)
+                self.assertEqual(len(df.id2data), len(data_map))
+
+                # the meta table is loaded without the index
+                df.close()
+                os.remove(tmp + '.index')
+
+                df.open(tmp)
+                self.assertIsNone(df.index)
+                df.self_test()
+
+                for data_id, data in data_map.items():
+                    self.assertEqual(df.read(data_id), data)
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
+    def test_data_file_log(self):
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(300, 16, 128)
+            data_ids = list(data_map)
+
+            class _LogDataFile (LogDataFile):
+                __slots__ = ()
+                SNAPSHOT_RECORDS = 100
+
+            df = _LogDataFile(tmp)
+            try:
+                for data_id in data_ids[:200]:
+                    df.write_with_key(data_id, data_map[data_id])
+
+                df.self_test()
+
+                # only records after the last snapshot are not indexed
+                self.assertLess(df.unsaved_records, 100)
+
+                df.remove(data_ids[:50])
+                df.self_test()
+
+                for data_id in data_ids[200:]:
+                    df.write_with_key(data_id, data_map[data_id])
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                for data_id in data_ids[:50]:
+                    self.assertIsNone(df.read(data_id))
+
+                for data_id in data_ids[50:]:
+                    self.assertEqual(df.read(data_id), data_map[data_id])
+
+                # a partially written record is dropped
+                last_id = data_ids[-1]
+                df.write(last_id, generate_data(64, 64))
+                df.close()
+
+                with open(tmp, 'r+b') as f:
+                    f.seek(-1, 2)
+                    f.truncate()
+
+                df.open(tmp)
+                df.self_test()
+                self.assertEqual(df.read(last_id), data_map[last_id])
+
+                keys = list(df.get_keys(data_ids[50:]))
+
+                df.compact()
+                df.self_test()
+                self.assertEqual(df.garbage_size, 0)
+
+                self.assertEqual(list(df.get_keys(data_ids[50:])), keys)
+                for data_id in data_ids[50:]:
+                    self.assertEqual(df.read(data_id), data_map[data_id])
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                self.assertGreater(df.write_with_key(data_ids[0], b'1'),
+                                   max(keys))
+                self.assertEqual(df.read(data_ids[0]), b'1')
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
+    def test_data_file_log_snapshot(self):
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            data_map = generate_data_map(8, 16, 128)
+            data_ids = list(data_map)
+
+            class _LogDataFile (LogDataFile):
+                __slots__ = ()
+                SNAPSHOT_RECORDS = 4
+
+            df = _LogDataFile(tmp)
+            try:
+                # the last record triggers saving of the snapshot
+                for data_id in data_ids[:4]:
+                    df.write_with_key(data_id, data_map[data_id])
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                self.assertEqual(df.read_many(data_ids[:4]),
+                                 [data_map[data_id]
+                                  for data_id in data_ids[:4]])
+
+                for data_id in data_ids[4:]:
+                    df.write_with_key(data_id, data_map[data_id])
+
+                df.remove(data_ids[:4])
+
+                df.close()
+                df.open(tmp)
+                df.self_test()
+
+                self.assertEqual(df.read_many(data_ids),
+                                 [None] * 4 + [data_map[data_id]
+                                               for data_id in data_ids[4:]])
+
+            finally:
+                df.close()
+
+    # -----------------------------------------------------------
+
     def _test_data_file_speed(self, data_file_type):
 
         with Tempfile() as tmp:
@@ -221,6 +581,11 @@ class TestDataFile(AqlTestCase):
 
                 print("add time: %s" % timer)
 
+                with timer:
+                    df.write_with_keys(data_map.items())
+
+                print("batch update time: %s" % timer)
+
                 df.close()
 
                 with timer:
@@ -253,6 +618,58 @@ class TestDataFile(AqlTestCase):
             finally:
                 df.close()
 
+    def _test_data_file_batch_speed(self, data_file_type, count):
+
+        with Tempfile() as tmp:
+            tmp.remove()
+
+            timer = Chrono()
+
+            data_map = generate_data_map(count, 123, 123)
+            items = list(data_map.items())
+            data_ids = list(data_map)
+
+            print("%s, %s entities:" % (data_file_type.__name__, count))
+
+            df = data_file_type(tmp)
+            try:
+                with timer:
+                    keys = []
+                    for pos in range(0, count, 1000):
+                        keys += df.write_with_keys(items[pos: pos + 1000])
+
+                print("  batch add time: %s" % timer)
+
+                df.close()
+
+                with timer:
+                    df = data_file_type(tmp)
+                    df.read_many(data_ids[:100])
+                print("  load and read 100 time: %s" % timer)
+
+                with timer:
+                    for pos in range(0, count, 1000):
+                        df.read_many(data_ids[pos: pos + 1000])
+                print("  batch read time: %s" % timer)
+
+                with timer:
+                    for pos in range(0, count, 1000):
+                        df.get_ids(keys[pos: pos + 1000])
+                print("  batch get ids time: %s" % timer)
+
+                with timer:
+                    df.write_many(items)
+                print("  batch update time: %s" % timer)
+
+            finally:
+                df.close()
+
+    @skip
+    def test_data_file_batch_speed(self):
+        for count in (10000, 100000):
+            self._test_data_file_batch_speed(DataFile, count)
+            self._test_data_file_batch_speed(SqlDataFile, count)
+
     @skip
     def test_data_file_speed(self):
         self._test_data_file_speed(DataFile)
@@ -261,20 +678,42 @@ class TestDataFile(AqlTestCase):
     def test_data_file_speed_sql(self):
         self._test_data_file_speed(SqlDataFile)
 
+    @skip
+    def test_data_file_speed_log(self):
+        self._test_data_file_speed(LogDataFile)
+
     def test_data_file_add(self):
         self._test_data_file_add(DataFile)
 
     def test_data_file_add_sql(self):
         self._test_data_file_add(SqlDataFile)
 
+    def test_data_file_add_log(self):
+        self._test_data_file_add(LogDataFile)
+
     def test_data_file_update(self):
         self._test_data_file_update(DataFile)
 
     def test_data_file_update_sql(self):
         self._test_data_file_update(SqlDataFile)
 
+    def test_data_file_update_log(self):
+        self._test_data_file_update(LogDataFile)
+
     def test_data_file_remove(self):
         self._test_data_file_remove(DataFile)
 
     def test_data_file_remove_sql(self):
         self._test_data_file_remove(SqlDataFile)
+
+    def test_data_file_remove_log(self):
+        self._test_data_file_remove(LogDataFile)
+
+    def test_data_file_write_many(self):
+        self._test_data_file_write_many(DataFile)
+
+    def test_data_file_write_many_sql(self):
+        self._test_data_file_write_many(SqlDataFile)
+
+    def test_data_file_write_many_log(self):
+        self._test_data_file_write_many(LogDataFile)
@@ -0,0 +1,116 @@
+import os
+import time
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir, FileWatcher, InotifyFileWatcher, \
+    PollingFileWatcher, get_files_state, get_changed_files
+
+# ==============================================================================
+
+
+class TestFileWatcher(AqlTestCase):
+
+    def _test_watcher(self, watcher_type, **kw):
+
+        with Tempdir() as tmp_dir:
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.mkdir(src_dir)
+
+            src_files = self.generate_source_files(tmp_dir, 3, 32)
+            src_file, other_file, unwatched_file = src_files
+
+            new_file = os.path.join(tmp_dir, 'new_file.txt')
+
+            filenames = [src_file, other_file, new_file, src_dir]
+
+            with watcher_type(filenames, debounce=0.1, **kw) as watcher:
+
+                self.assertFalse(watcher.wait(timeout=0.3))
+
+                self.regenerate_file(unwatched_file, 32)
+                self.assertFalse(watcher.wait(timeout=0.3))
+
+                self.regenerate_file(src_file, 64)
+                self.regenerate_file(other_file, 64)
+                self.assertEqual(watcher.wait(timeout=5),
+                                 set([src_file, other_file]))
+
+                self.assertFalse(watcher.wait(timeout=0.3))
+
+                with open(new_file, 'w') as f:
+                    f.write('new')
+
+                self.assertEqual(watcher.wait(timeout=5), set([new_file]))
+
+                os.remove(other_file)
+                self.assertEqual(watcher.wait(timeout=5), set([other_file]))
+
+                time.sleep(0.1)
+                with open(os.path.join(src_dir, 'file.txt'), 'w') as f:
+                    f.write('new')
+
+                self.assertEqual(watcher.wait(timeout=5), set([src_dir]))
+
+    # -----------------------------------------------------------
+
+    def test_file_watcher_polling(self):
+        self._test_watcher(PollingFileWatcher, interval=0.05)
+
+    # -----------------------------------------------------------
+
+    def test_file_watcher_inotify(self):
+        try:
+            InotifyFileWatcher([]).close()
+        except OSError:
+            self.skipTest("inotify is not available")
+
+        self._test_watcher(InotifyFileWatcher)
+
+    # -----------------------------------------------------------
+
+    def test_file_watcher(self):
+        with Tempdir() as tmp_dir:
+            src_file = self.generate_source_files(tmp_dir, 1, 32)[0]
+
+            with FileWatcher([src_file], debounce=0.1) as watcher:
+                self.regenerate_file(src_file, 64)
+                self.assertEqual(watcher.wait(timeout=5), set([src_file]))
+
+    # -----------------------------------------------------------
+
+    def test_file_watcher_changed_files(self):
+        with Tempdir() as tmp_dir:
+            src_files = self.generate_source_files(tmp_dir, 4, 32)
+            src_file, removed_file, new_file, other_file = src_files
+
+            files_state = get_files_state([src_file, removed_file,
+                                           other_file])
+
+            since_time = time.time() + 100
+            self.assertFalse(get_changed_files(src_files, files_state,
+                                               since_time))
+
+            self.regenerate_file(src_file, 64)
+            os.remove(removed_file)
+
+            self.assertEqual(get_changed_files(src_files, files_state,
+                                               since_time),
+                             set([src_file, removed_file]))
+
+            # files which are not in the snapshot are checked by the time
+            self.assertEqual(get_changed_files([new_file], files_state, 0),
+                             set([new_file]))
+
+            # directories are compared by their entries except excluded ones
+            files_state = get_files_state([tmp_dir])
+
+            self.regenerate_file(other_file, 64)
+            self.assertFalse(get_changed_files([tmp_dir], files_state, 0))
+
+            os.remove(new_file)
+            self.assertFalse(get_changed_files([tmp_dir], files_state, 0,
+                                               [new_file]))
+
+            self.assertEqual(get_changed_files([tmp_dir], files_state, 0),
+                             set([os.path.normcase(os.path.abspath(tmp_dir))]))
@@ -5,7 +5,7 @@ from aql_testcase import AqlTestCase
 from aql.utils import find_files, change_path, \
     find_program, find_programs, find_optional_program, \
     find_optional_programs, relative_join, exclude_files_from_dirs, \
-    group_paths_by_dir, Tempdir
+    group_paths_by_dir, Tempdir, WorkDir, abs_file_path
 
 # ==============================================================================
 
@@ -248,3 +248,20 @@ class TestPathUtils(AqlTestCase):
         result = [os.path.normcase(os.path.abspath(file)) for file in result]
 
         self.assertEqual(exclude_files_from_dirs(files, dirs), result)
+
+    # ==============================================================================
+
+    def test_work_dir(self):
+
+        cwd = os.getcwd()
+
+        with Tempdir() as tmp_dir:
+            with WorkDir(tmp_dir):
+                self.assertEqual(os.getcwd(), cwd)
+                self.assertEqual(abs_file_path('file0.hpp'),
+                                 os.path.normcase(
+                                     os.path.join(tmp_dir, 'file0.hpp')))
+
+            self.assertEqual(abs_file_path('file0.hpp'),
+                             os.path.normcase(
+                                 os.path.join(cwd, 'file0.hpp')))
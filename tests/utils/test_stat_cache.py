@@ -0,0 +1,84 @@
+import os
+import time
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir, FileStatCache, file_signature, write_bin_file
+
+# ==============================================================================
+
+
+class TestStatCache(AqlTestCase):
+
+    def test_stat_cache(self):
+
+        with Tempdir() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, '.aql.stat')
+
+            src_files = self.generate_source_files(tmp_dir, 3, 201)
+            old_file, old_file2, new_file = src_files
+
+            old_time = time.time() - 100
+            os.utime(old_file, (old_time, old_time))
+            os.utime(old_file2, (old_time, old_time))
+
+            with FileStatCache(cache_file) as cache:
+                for src_file in src_files:
+                    self.assertEqual(cache.file_signature(src_file),
+                                     file_signature(src_file))
+
+                self.assertEqual(cache.file_signature(old_file, 10),
+                                 file_signature(old_file, 10))
+
+                # recently modified files are not cached
+                self.assertEqual(len(cache), 3)
+
+            with FileStatCache(cache_file) as cache:
+                self.assertEqual(len(cache), 3)
+
+                self.regenerate_file(old_file2, 201)
+                os.utime(old_file2, (old_time, old_time))
+
+                self.assertEqual(cache.file_signature(old_file),
+                                 file_signature(old_file))
+
+                self.assertEqual(cache.file_signature(old_file2),
+                                 file_signature(old_file2))
+
+            write_bin_file(cache_file, b"corrupted cache")
+
+            with FileStatCache(cache_file) as cache:
+                self.assertEqual(len(cache), 0)
+                self.assertEqual(cache.file_signature(old_file),
+                                 file_signature(old_file))
+
+            with FileStatCache(cache_file) as cache:
+                self.assertEqual(len(cache), 1)
+
+    # ==========================================================
+
+    def test_stat_cache_reopen(self):
+
+        with Tempdir() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, '.aql.stat')
+
+            src_file = self.generate_source_files(tmp_dir, 1, 201)[0]
+
+            old_time = time.time() - 100
+            os.utime(src_file, (old_time, old_time))
+
+            cache = FileStatCache(cache_file)
+            cache.file_signature(src_file)
+            items = cache.items
+            cache.close()
+
+            # the same unchanged file is not read again
+            cache.open(cache_file)
+            self.assertIs(cache.items, items)
+            cache.close()
+
+            write_bin_file(cache_file, b"corrupted cache")
+
+            cache.open(cache_file)
+            self.assertEqual(len(cache), 0)
+            cache.close()
@@ -0,0 +1,99 @@
+import os
+import json
+import threading
+
+from aql_testcase import AqlTestCase
+
+from aql.utils import Tempdir, TraceFile, open_trace_file, close_trace_file,\
+    is_tracing, trace_span, trace_async_begin, trace_async_end
+
+# ==============================================================================
+
+
+class TestTrace(AqlTestCase):
+
+    def test_trace_file(self):
+
+        with Tempdir() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'trace.json')
+
+            with TraceFile(filename) as trace:
+                with trace.span('main', 'test', {'value': 1}):
+
+                    def _worker():
+                        with trace.span(lambda: 'worker', 'test'):
+                            pass
+
+                    thread = threading.Thread(target=_worker)
+                    thread.start()
+                    thread.join()
+
+                try:
+                    with trace.span('failed', 'test'):
+                        raise ValueError()
+                except ValueError:
+                    pass
+
+                trace.async_event('b', 1, 'queue', 'test')
+                trace.async_event('e', 1, 'queue', 'test')
+
+            with open(filename) as trace_file:
+                events = json.load(trace_file)['traceEvents']
+
+            spans = dict((event['name'], event) for event in events
+                         if event['ph'] == 'X')
+
+            self.assertEqual(sorted(spans), ['failed', 'main', 'worker'])
+
+            main = spans['main']
+            worker = spans['worker']
+
+            self.assertEqual(main['args'], {'value': 1})
+            self.assertEqual(spans['failed']['args'],
+                             {'error': 'ValueError'})
+
+            self.assertNotEqual(main['tid'], worker['tid'])
+            self.assertLessEqual(main['ts'], worker['ts'])
+            self.assertGreaterEqual(main['ts'] + main['dur'],
+                                    worker['ts'] + worker['dur'])
+
+            threads = [event for event in events if event['ph'] == 'M']
+            self.assertEqual(len(threads), 2)
+
+            phases = [event['ph'] for event in events
+                      if event['name'] == 'queue']
+            self.assertEqual(phases, ['b', 'e'])
+
+    # -----------------------------------------------------------
+
+    def test_trace_disabled(self):
+
+        def _name():
+            raise AssertionError("Name of a span is evaluated")
+
+        self.assertFalse(is_tracing())
+
+        with trace_span(_name, 'test'):
+            pass
+
+        trace_async_begin(1, _name, 'test')
+        trace_async_end(1, _name, 'test')
+
+        with Tempdir() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'trace.json')
+
+            open_trace_file(filename)
+            try:
+                self.assertTrue(is_tracing())
+                with trace_span('span', 'test'):
+                    pass
+            finally:
+                close_trace_file()
+
+            self.assertFalse(is_tracing())
+
+            with open(filename) as trace_file:
+                events = json.load(trace_file)['traceEvents']
+
+            self.assertEqual([event['name'] for event in events
+                              if event['ph'] == 'X'], ['span'])
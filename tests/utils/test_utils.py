@@ -1,11 +1,14 @@
 import os
 import stat
+import hashlib
 
-from aql_testcase import AqlTestCase
+from aql_testcase import AqlTestCase, skip
 
 from aql.utils import equal_function_args, check_function_args,\
     get_function_name, execute_command, flatten_list, group_items, Tempfile,\
-    get_shell_script_env
+    get_shell_script_env, Chrono, new_hash, data_signature, file_signature,\
+    simple_object_signature, set_signature_algorithm,\
+    get_signature_algorithm, get_signature_algorithms, file_checksum
 
 
 class TestUtils(AqlTestCase):
@@ -203,3 +206,143 @@ class TestUtils(AqlTestCase):
 
         groups = group_items(items, wish_groups=1, max_group_size=2)
         self.assertEqual(groups, [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9]])
+
+    # ==============================================================================
+
+    def test_signature_algorithm(self):
+
+        self.assertEqual(get_signature_algorithm(), 'md5')
+
+        data = b"1234567890"
+
+        md5_signature = data_signature(data)
+
+        algorithms = get_signature_algorithms()
+        self.assertIn('md5', algorithms)
+        self.assertIn('sha1', algorithms)
+
+        with Tempfile() as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+
+            try:
+                for algorithm in algorithms:
+                    set_signature_algorithm(algorithm)
+                    self.assertEqual(get_signature_algorithm(), algorithm)
+
+                    signature = data_signature(data)
+                    self.assertEqual(len(signature), 16)
+                    self.assertEqual(new_hash(data).digest(), signature)
+                    self.assertEqual(file_signature(temp_file), signature)
+                    self.assertEqual(len(simple_object_signature(data)), 16)
+
+                    common_hash = new_hash(data)
+                    self.assertEqual(data_signature(data, common_hash),
+                                     new_hash(data + data).digest())
+
+                    if algorithm in ('sha1', 'blake2b', 'blake2s'):
+                        self.assertNotEqual(signature, md5_signature)
+
+                self.assertRaises(Exception,
+                                  set_signature_algorithm, 'unknown_alg')
+            finally:
+                set_signature_algorithm('md5')
+
+        self.assertEqual(data_signature(data), md5_signature)
+
+    # ==============================================================================
+
+    def test_file_checksum(self):
+
+        small_data = os.urandom(1000)
+        large_data = os.urandom(5 * 1024 * 1024 + 1000)
+
+        for data in (b'', small_data, large_data):
+            with Tempfile() as temp_file:
+                temp_file.write(data)
+                temp_file.flush()
+
+                for offset, size in ((0, -1), (0, 0), (10, -1), (10, 100),
+                                     (100, 300000), (1000, 4200000),
+                                     (len(data) + 10, -1)):
+
+                    part = data[offset:]
+                    if size > 0:
+                        part = part[:size]
+
+                    checksum = file_checksum(temp_file, offset, size,
+                                             chunk_size=256)
+                    self.assertEqual(checksum.digest(),
+                                     hashlib.md5(part).digest())
+
+                    checksum = file_checksum(temp_file, offset, size,
+                                             alg='sha1')
+                    self.assertEqual(checksum.digest(),
+                                     hashlib.sha1(part).digest())
+
+                self.assertEqual(file_signature(temp_file, 10),
+                                 hashlib.md5(data[10:]).digest())
+
+
+# ==============================================================================
+@skip
+class TestUtilsSpeed(AqlTestCase):
+
+    def test_signature_algorithm_speed(self):
+
+        data = bytearray(64 * 1024 * 1024)
+
+        with Tempfile() as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+
+            try:
+                for algorithm in get_signature_algorithms():
+                    set_signature_algorithm(algorithm)
+
+                    timer = Chrono()
+                    with timer:
+                        data_signature(data)
+
+                    file_timer = Chrono()
+                    with file_timer:
+                        file_signature(temp_file)
+
+                    print("algorithm: %s, data: %s, file: %s" %
+                          (algorithm, timer, file_timer))
+            finally:
+                set_signature_algorithm('md5')
+
+    # ==============================================================================
+
+    def test_file_signature_speed(self):
+
+        chunk_size = 262144
+
+        def _read_signature(filename):
+            checksum = hashlib.md5()
+            with open(filename, 'rb') as f:
+                chunk = True
+                while chunk:
+                    chunk = f.read(chunk_size)
+                    checksum.update(chunk)
+
+            return checksum.digest()
+
+        for size in (1024 * 1024, 256 * 1024 * 1024):
+            with Tempfile() as temp_file:
+                temp_file.write(os.urandom(size))
+                temp_file.flush()
+
+                read_timer = Chrono()
+                with read_timer:
+                    read_signature = _read_signature(temp_file)
+
+                timer = Chrono()
+                with timer:
+                    signature = file_signature(temp_file)
+
+                self.assertEqual(signature, read_signature)
+
+                print("size: %s MiB, read: %s, file_signature: %s" %
+                      (size // (1024 * 1024), read_timer, timer))
@@ -1,10 +1,16 @@
+import os
 import time
 
+from multiprocessing.pool import ThreadPool
+
 from aql_testcase import AqlTestCase
 
-from aql.utils import Tempfile
+from aql.util_types import set_work_dir
+from aql.utils import Tempfile, Tempdir
+from aql.entity import SimpleEntity
 from aql.entity.aql_file_entity import FilePartChecksumEntity, \
-    FileChecksumEntity, FileTimestampEntity
+    FileChecksumEntity, FileTimestampEntity, prefetch_signatures, \
+    share_file_entities, reset_shared_file_entities
 
 
 class TestFileValue(AqlTestCase):
@@ -180,3 +186,125 @@ class TestFileValue(AqlTestCase):
 
         self._test_save_load(value1)
         self._test_save_load(value2)
+
+    # ==========================================================
+
+    def test_file_value_prefetch(self):
+
+        with Tempdir() as tmp_dir:
+            src_files = self.generate_source_files(tmp_dir, 10, 201)
+
+            entities = [FileChecksumEntity(src) for src in src_files]
+            entities += [FileChecksumEntity(src) for src in src_files[:4]]
+            entities += [FileTimestampEntity(src) for src in src_files[:2]]
+            entities += [FilePartChecksumEntity(src_files[0], offset=4),
+                         FilePartChecksumEntity(src_files[0], offset=8)]
+            entities.append(SimpleEntity("value"))
+
+            known_entity = FileChecksumEntity(src_files[0])
+            known_entity.signature
+            entities.append(known_entity)
+
+            thread_pool = ThreadPool(4)
+            try:
+                hits, misses = prefetch_signatures(entities, thread_pool)
+            finally:
+                thread_pool.close()
+                thread_pool.join()
+
+            self.assertEqual(misses, 14)
+            self.assertEqual(hits, 5)
+
+            for entity in entities[:-2]:
+                self.assertEqual(entity.signature, entity.get_signature())
+
+            self.assertEqual(prefetch_signatures(entities), (19, 0))
+
+    # ==========================================================
+
+    def test_file_value_share(self):
+
+        with Tempdir() as tmp_dir:
+            src_files = self.generate_source_files(tmp_dir, 10, 201)
+
+            try:
+                entities = share_file_entities(
+                    FileChecksumEntity(src) for src in src_files)
+
+                thread_pool = ThreadPool(4)
+                try:
+                    shared_entities = thread_pool.map(
+                        lambda src: share_file_entities(
+                            (FileChecksumEntity(src),))[0],
+                        src_files * 4)
+                finally:
+                    thread_pool.close()
+                    thread_pool.join()
+
+                for entity, shared_entity in zip(entities * 4,
+                                                 shared_entities):
+                    self.assertIs(entity, shared_entity)
+
+                src_file = src_files[0]
+                entity = entities[0]
+
+                other_entities = share_file_entities([
+                    FileChecksumEntity(src_file, tags='tag'),
+                    FileTimestampEntity(src_file),
+                    FilePartChecksumEntity(src_file, offset=4),
+                    SimpleEntity(src_file),
+                ])
+
+                for other_entity in other_entities:
+                    self.assertIsNot(other_entity, entity)
+
+                other_entity = share_file_entities(
+                    [FilePartChecksumEntity(src_file, offset=4)])[0]
+                self.assertIs(other_entity, other_entities[2])
+
+                # entities with a known signature are not replaced
+                known_entity = FileChecksumEntity(src_file)
+                known_entity.signature
+                self.assertIs(share_file_entities([known_entity])[0],
+                              known_entity)
+
+                reset_shared_file_entities()
+
+                other_entity = share_file_entities(
+                    [FileChecksumEntity(src_file)])[0]
+                self.assertIsNot(other_entity, entity)
+                self.assertEqual(other_entity, entity)
+
+            finally:
+                reset_shared_file_entities()
+
+    # ==========================================================
+
+    def test_file_value_paths(self):
+
+        with Tempdir() as tmp_dir:
+            src_file = self.generate_source_files(tmp_dir, 1, 201)[0]
+            src_file = os.path.normcase(src_file)
+
+            src_dir, src_name = os.path.split(src_file)
+
+            entity = FileChecksumEntity(src_file)
+            self.assertEqual(entity.name, src_file)
+
+            other_path = os.path.join(src_dir, '.', 'dir', '..', src_name)
+            other_entity = FileTimestampEntity(other_path)
+            self.assertIs(other_entity.name, entity.name)
+
+            prev_work_dir = set_work_dir(src_dir)
+            try:
+                other_entity = FileChecksumEntity(src_name)
+                self.assertIs(other_entity.name, entity.name)
+
+                set_work_dir(tmp_dir)
+
+                other_entity = FileChecksumEntity(src_name)
+                self.assertEqual(other_entity.name,
+                                 os.path.normcase(os.path.join(tmp_dir,
+                                                               src_name)))
+            finally:
+                set_work_dir(prev_work_dir)
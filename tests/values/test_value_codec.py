@@ -0,0 +1,184 @@
+import os
+import timeit
+
+from aql_testcase import AqlTestCase, skip
+
+from aql.utils import Tempfile, Tempdir
+from aql.entity import FileChecksumEntity, FileTimestampEntity, \
+    FilePartChecksumEntity, DirEntity, SimpleEntity, NullEntity, \
+    SignatureEntity, EntityPickler, EntityCodec
+
+from aql.entity.aql_entity_codec import ErrorEntityCodecInvalidData
+from aql.nodes.aql_node import NodeEntity
+
+# ==============================================================================
+
+
+def _make_node_entity(targets, itargets):
+    return NodeEntity(b'0123456789ABCDEF', b'FEDCBA9876543210',
+                      targets, itargets, [1, 2, 300, 70000], 1.25)
+
+# ==============================================================================
+
+
+class TestValueCodec(AqlTestCase):
+
+    def _check_entity(self, codec, entity):
+        data = codec.dumps(entity)
+
+        for value in (data, memoryview(data), bytearray(data)):
+            decoded = codec.loads(value)
+            self.assertEqual(type(decoded), type(entity))
+            self.assertEqual(decoded, entity)
+
+        return data
+
+    # -----------------------------------------------------------
+
+    def test_value_codec(self):
+
+        codec = EntityCodec()
+
+        with Tempdir() as tmp_dir:
+            with Tempfile(root_dir=tmp_dir) as tmp:
+                tmp.write(b'1234567890')
+                tmp.close()
+
+                entities = [
+                    FileChecksumEntity(tmp, tags=('a', 'b')),
+                    FileTimestampEntity(tmp),
+                    FilePartChecksumEntity(tmp, offset=2),
+                    DirEntity(tmp_dir),
+                    SimpleEntity('123-345', name=str(tmp)),
+                    SimpleEntity(name=str(tmp)),
+                    SimpleEntity(b'\x00\xff'),
+                    SimpleEntity([1, -1, 2 ** 70, -2 ** 70, 1.5, None,
+                                  True, False, (u'ф', b''),
+                                  frozenset([3]), {'key': 'value'}]),
+                    NullEntity(),
+                    SignatureEntity(b'1234', name='sign'),
+                ]
+
+                for entity in entities:
+                    self._check_entity(codec, entity)
+
+                node_entity = _make_node_entity(entities[:2], entities[2:])
+                decoded = codec.loads(codec.dumps(node_entity))
+
+                self.assertEqual(decoded.name, node_entity.name)
+                self.assertEqual(decoded.signature, node_entity.signature)
+                self.assertEqual(decoded.target_entities, entities[:2])
+                self.assertEqual(decoded.itarget_entities, entities[2:])
+                self.assertEqual(decoded.idep_keys, [1, 2, 300, 70000])
+                self.assertEqual(decoded.build_time, 1.25)
+
+    # -----------------------------------------------------------
+
+    def test_value_codec_compress(self):
+
+        codec = EntityCodec()
+
+        targets = [SimpleEntity('value', name='/very/long/path/%s' % i)
+                   for i in range(100)]
+
+        node_entity = _make_node_entity(targets, [])
+
+        data = codec.dumps(node_entity)
+        self.assertLess(len(data), codec.COMPRESS_SIZE)
+
+        decoded = codec.loads(memoryview(data))
+        self.assertEqual(decoded.target_entities, targets)
+
+    # -----------------------------------------------------------
+
+    def test_value_codec_paths(self):
+
+        codec = EntityCodec()
+
+        build_dir = os.path.join(os.sep + 'project', 'build', 'release')
+        names = [os.path.join(build_dir, 'file%s.o' % i) for i in range(10)]
+        names += [os.path.join(build_dir, 'obj', 'file.o'),
+                  os.sep + 'file.o', 'file.o',
+                  os.path.join(u'фф', 'file.o')]
+
+        targets = [SimpleEntity('value', name=name) for name in names]
+
+        node_entity = _make_node_entity(targets, targets[:3])
+
+        data = codec.dumps(node_entity)
+        self.assertLess(len(data), sum(map(len, names)))
+
+        for value in (data, memoryview(data)):
+            decoded = codec.loads(value)
+            self.assertEqual(decoded.target_entities, targets)
+            self.assertEqual(decoded.itarget_entities, targets[:3])
+
+        targets = [SimpleEntity('value', name=name)
+                   for name in names for i in range(10)]
+
+        node_entity = _make_node_entity(targets, [])
+
+        data = codec.dumps(node_entity)
+        self.assertLess(len(data), codec.COMPRESS_SIZE)
+
+        decoded = codec.loads(memoryview(data))
+        self.assertEqual(decoded.target_entities, targets)
+
+    # -----------------------------------------------------------
+
+    def test_value_codec_pickle_records(self):
+
+        codec = EntityCodec()
+        pickler = EntityPickler()
+
+        entity = SimpleEntity('123-345', name='value', tags='a')
+
+        data = pickler.dumps(entity)
+        self.assertEqual(codec.loads(data), entity)
+        self.assertEqual(codec.loads(memoryview(data)), entity)
+
+        data = codec.dumps(entity)
+
+        self.assertRaises(ErrorEntityCodecInvalidData,
+                          codec.loads, data + b'\x00')
+
+        self.assertRaises(ErrorEntityCodecInvalidData,
+                          codec.loads, b'\xA7' + data[1:])
+
+    # ==============================================================================
+
+    @skip
+    def test_value_codec_speed(self):
+
+        with Tempdir() as tmp_dir:
+
+            src_files = self.generate_source_files(tmp_dir, 100, 32)
+
+            entities = [FileChecksumEntity(src_file, tags='c')
+                        for src_file in src_files]
+
+            target = os.path.join(tmp_dir, 'build', 'target.o')
+            targets = [SimpleEntity('value', name=target + str(i))
+                       for i in range(10)]
+
+            entities += [_make_node_entity(targets, entities[:5])] * 10
+
+            for coder in (EntityPickler(), EntityCodec()):
+
+                def _dumps(coder=coder):
+                    return list(map(coder.dumps, entities))
+
+                dumps = _dumps()
+
+                def _loads(coder=coder, dumps=dumps):
+                    return list(map(coder.loads, dumps))
+
+                name = type(coder).__name__
+
+                t = timeit.timeit(_dumps, number=100)
+                print("%s dumps: %.3f sec" % (name, t))
+
+                t = timeit.timeit(_loads, number=100)
+                print("%s loads: %.3f sec" % (name, t))
+
+                print("%s size: %s" % (name, sum(map(len, dumps))))
@@ -2,7 +2,7 @@ import operator
 
 from aql_testcase import AqlTestCase, skip
 
-from aql.utils import Tempfile, Chrono
+from aql.utils import Tempfile, Chrono, set_signature_algorithm
 from aql.entity import SimpleEntity, SignatureEntity, EntitiesFile
 
 # ==============================================================================
@@ -185,7 +185,9 @@ class TestValuesFile(AqlTestCase):
 
     # ==============================================================================
 
-    def _test_values_file_speed(self, use_sqlite):
+    def _test_values_file_speed(self, use_sqlite=False, use_log_db=False):
+        db_options = dict(use_sqlite=use_sqlite, use_log_db=use_log_db)
+
         values = []
         for i in range(20000):
             value = SimpleEntity(
@@ -195,28 +197,105 @@ class TestValuesFile(AqlTestCase):
         with Tempfile() as tmp:
             print("Opening a database '%s' ..." % tmp)
             timer = Chrono()
-            with EntitiesFile(tmp, use_sqlite=use_sqlite) as vf:
+            with EntitiesFile(tmp, **db_options) as vf:
                 with timer:
                     keys = vf.add_entities(values)
             print("add values time: %s" % (timer,))
 
-            with EntitiesFile(tmp, use_sqlite=use_sqlite) as vf:
+            with EntitiesFile(tmp, **db_options) as vf:
                 with timer:
                     keys = vf.add_entities(values)
             print("re-add values time: %s" % (timer,))
 
-            with EntitiesFile(tmp, use_sqlite=use_sqlite) as vf:
+            with EntitiesFile(tmp, **db_options) as vf:
                 with timer:
                     vf.find_entities_by_key(keys)
             print("get values time: %s" % timer)
 
             with timer:
-                with EntitiesFile(tmp, use_sqlite=use_sqlite) as vf:
+                with EntitiesFile(tmp, **db_options) as vf:
                     pass
             print("reopen values file time: %s" % timer)
 
     # ==============================================================================
 
+    def test_values_file_add_entities(self):
+        for db_options in ({}, {'use_sqlite': True}, {'use_log_db': True}):
+            with Tempfile() as tmp:
+                values = [SimpleEntity("http://aql.org/download%s" % i)
+                          for i in range(10)]
+
+                with EntitiesFile(tmp, **db_options) as vfile:
+                    keys = vfile.add_entities(values[::2])
+                    vfile.self_test()
+
+                    # keys are returned in the order of entities
+                    new_keys = vfile.add_entities(values)
+                    vfile.self_test()
+
+                    self.assertSequenceEqual(new_keys[::2], keys)
+                    self.assertEqual(len(set(new_keys)), len(values))
+
+                with EntitiesFile(tmp, **db_options) as vfile:
+                    self.assertEqual(vfile.find_entities_by_key(new_keys),
+                                     values)
+
+    # ==============================================================================
+
+    def test_values_file_codec(self):
+        with Tempfile() as tmp:
+            values = [SimpleEntity("http://aql.org/download%s" % i)
+                      for i in range(10)]
+
+            with EntitiesFile(tmp, use_codec=True) as vfile:
+                keys = vfile.add_entities(values[:5])
+
+            # records of both formats are readable by any file
+            with EntitiesFile(tmp) as vfile:
+                self.assertEqual(vfile.find_entities_by_key(keys),
+                                 values[:5])
+                keys += vfile.add_entities(values[5:])
+                vfile.self_test()
+
+            with EntitiesFile(tmp, use_codec=True) as vfile:
+                self.assertEqual(vfile.find_entities_by_key(keys), values)
+                vfile.self_test()
+
+    # ==============================================================================
+
+    def test_values_file_signature_algorithm(self):
+        for db_options in ({}, {'use_sqlite': True}, {'use_log_db': True}):
+            with Tempfile() as tmp:
+                value = SimpleEntity("http://aql.org/download")
+
+                with EntitiesFile(tmp, **db_options) as vfile:
+                    value_keys = vfile.add_entities([value])
+
+                with EntitiesFile(tmp, **db_options) as vfile:
+                    self.assertEqual(vfile.find_entities_by_key(value_keys),
+                                     [value])
+
+                set_signature_algorithm('sha1')
+                try:
+                    with EntitiesFile(tmp, **db_options) as vfile:
+                        vfile.self_test()
+                        self.assertIsNone(
+                            vfile.find_entities_by_key(value_keys))
+
+                        value = SimpleEntity("http://aql.org/download")
+                        value_keys = vfile.add_entities([value])
+
+                    with EntitiesFile(tmp, **db_options) as vfile:
+                        self.assertEqual(
+                            vfile.find_entities_by_key(value_keys), [value])
+                finally:
+                    set_signature_algorithm('md5')
+
+                with EntitiesFile(tmp, **db_options) as vfile:
+                    self.assertIsNone(vfile.find_entities_by_key(value_keys))
+
+    # ==============================================================================
+
     @skip
     def test_values_file_speed(self):
         self._test_values_file_speed(use_sqlite=False)
@@ -226,3 +305,9 @@ class TestValuesFile(AqlTestCase):
     @skip
     def test_values_file_speed_sql(self):
         self._test_values_file_speed(use_sqlite=True)
+
+    # ==============================================================================
+
+    @skip
+    def test_values_file_speed_log(self):
+        self._test_values_file_speed(use_log_db=True)